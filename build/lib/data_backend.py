@@ -0,0 +1,494 @@
+import os
+import json
+import time
+import queue
+import hashlib
+import argparse
+import threading
+import http.client
+import http.server
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import measured_power
+
+# Backends find measurements for measured_power.get_power_from_grid (see
+# measured_power.set_backend). File backends map each measurement to its
+# path relative to the data folder (measured_power.get_power_relpath).
+# Mirrors serve the data folder over HTTP, with an index (INDEX_NAME)
+# mapping these paths to the size and SHA-256 checksum of each file.
+INDEX_NAME='index.json'
+
+
+class DataBackend(object):
+    """Base class for backends that provide FITS files: subclasses
+        implement get_fname, returning a local file for a measurement"""
+
+    def get_location(self,grid,power_type):
+        """String identifying a measurement in the backend (no I/O)"""
+
+        return measured_power.get_power_relpath(grid,power_type)
+
+
+    def get_fname(self,grid,power_type):
+        raise NotImplementedError
+
+
+    def get_power(self,grid,power_type,cache=None,lazy=False):
+        """Return measured power spectrum (see get_power_from_grid)"""
+
+        fname=self.get_fname(grid,power_type)
+        return measured_power.read_power_file(fname,power_type,cache=cache,
+                    lazy=lazy)
+
+
+    def prefetch(self,grids,power_types,workers=8):
+        """Make measurements available locally (nothing to do by default).
+            Returns list of errors, as (index,location,exception)."""
+
+        return []
+
+
+class LocalBackend(DataBackend):
+    """FITS files in a local folder (default: data/ in $SHERWOOD)"""
+
+    def __init__(self,data_dir=None):
+
+        if data_dir is None:
+            data_dir=measured_power.get_repo_dir()+'/data/'
+        self.data_dir=data_dir
+
+
+    def get_fname(self,grid,power_type):
+        return os.path.join(self.data_dir,
+                    measured_power.get_power_relpath(grid,power_type))
+
+
+class ArchiveBackend(DataBackend):
+    """Consolidated binary store (see power_store.py), memory-mapped once.
+        Arrays are read-only views of the mapped file, so cache and lazy
+        options are ignored."""
+
+    def __init__(self,fname=None):
+
+        self.store=measured_power.get_power_store(fname)
+
+
+    def get_location(self,grid,power_type):
+        return '{}:{}'.format(self.store.fname,
+                    measured_power.get_power_relpath(grid,power_type))
+
+
+    def get_power(self,grid,power_type,cache=None,lazy=False):
+        return self.store.get_power(grid,power_type)
+
+
+class ConnectionPool(object):
+    """Pool of persistent (keep-alive) HTTP connections to a single host,
+        that can be shared by threads. Connections are reused for many
+        requests, and replaced if the server closed them. Inputs:
+      - base_url: http:// or https:// URL (with an optional path prefix)
+      - max_idle: maximum number of idle connections kept open
+      - timeout: timeout (in seconds) of each connection"""
+
+    def __init__(self,base_url,max_idle=8,timeout=30):
+
+        url=urllib.parse.urlsplit(base_url)
+        if url.scheme=='http':
+            self.connection_class=http.client.HTTPConnection
+        elif url.scheme=='https':
+            self.connection_class=http.client.HTTPSConnection
+        else:
+            raise ValueError('unsupported URL',base_url)
+        self.host=url.hostname
+        self.port=url.port
+        self.prefix=url.path.rstrip('/')
+        self.timeout=timeout
+        self.max_idle=max_idle
+        self.idle=queue.LifoQueue()
+        # counters, to check that connections are reused
+        self.lock=threading.Lock()
+        self.connections=0
+        self.requests=0
+
+
+    def _acquire(self,fresh=False):
+        if not fresh:
+            try:
+                return self.idle.get_nowait(),True
+            except queue.Empty:
+                pass
+        with self.lock:
+            self.connections+=1
+        return self.connection_class(self.host,self.port,
+                    timeout=self.timeout),False
+
+
+    def _release(self,conn):
+        if self.idle.qsize()<self.max_idle:
+            self.idle.put(conn)
+        else:
+            conn.close()
+
+
+    def get(self,path,out):
+        """Download path (relative to the base URL) into file object out,
+            and return the number of bytes written. Raises OSError if the
+            server does not return the file."""
+
+        for attempt in range(2):
+            conn,reused=self._acquire(fresh=attempt>0)
+            try:
+                conn.request('GET',self.prefix+'/'+urllib.parse.quote(path))
+                response=conn.getresponse()
+            except (http.client.HTTPException,ConnectionError):
+                conn.close()
+                # the server may have closed an idle connection, and then
+                # the other idle connections are probably stale as well:
+                # drop them, and retry once with a new connection
+                if reused and attempt==0:
+                    self.close()
+                    continue
+                raise
+            break
+        with self.lock:
+            self.requests+=1
+
+        if response.status!=200:
+            response.read()
+            self._release(conn)
+            raise OSError('HTTP {} for {}'.format(response.status,path))
+        nbytes=0
+        try:
+            for block in iter(lambda: response.read(1<<16),b''):
+                out.write(block)
+                nbytes+=len(block)
+        except Exception:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        return nbytes
+
+
+    def close(self):
+        """Close all idle connections"""
+
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class HTTPBackend(DataBackend):
+    """FITS files downloaded from an HTTP mirror of the data folder, and
+        kept in a content-addressed cache on disk (files are stored by
+        checksum, so identical files are stored once and files updated in
+        the mirror are never confused with old ones). When the cache goes
+        over its size budget, least recently used files are removed.
+        Inputs:
+      - base_url: URL of the mirror (see serve_mirror)
+      - cache_dir: folder for the cache (default: $SHERWOOD_CACHE, or
+        ~/.cache/sherwood)
+      - max_bytes: size budget of the cache
+      - max_connections: number of keep-alive connections kept open"""
+
+    def __init__(self,base_url,cache_dir=None,max_bytes=1024**3,
+                max_connections=8,timeout=30):
+
+        if cache_dir is None:
+            cache_dir=os.environ.get('SHERWOOD_CACHE',
+                        os.path.join(os.path.expanduser('~'),'.cache',
+                        'sherwood'))
+        self.base_url=base_url
+        self.cache_dir=cache_dir
+        self.max_bytes=max_bytes
+        self.pool=ConnectionPool(base_url,max_idle=max_connections,
+                    timeout=timeout)
+        os.makedirs(os.path.join(cache_dir,'objects'),exist_ok=True)
+        # index of the mirror, downloaded on first use
+        self.index=None
+        self.lock=threading.Lock()
+        # one lock per checksum, so each file is downloaded once
+        self.fetch_locks={}
+        self.nbytes=sum(os.path.getsize(fname)
+                    for fname in self.list_objects())
+        # counters to monitor the cache
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+
+
+    def get_location(self,grid,power_type):
+        return '{}/{}'.format(self.base_url.rstrip('/'),
+                    measured_power.get_power_relpath(grid,power_type))
+
+
+    def get_index(self):
+        """Index of the mirror, mapping paths to size and checksum"""
+
+        with self.lock:
+            if self.index is None:
+                tmp=_BytesWriter()
+                self.pool.get(INDEX_NAME,tmp)
+                self.index=json.loads(b''.join(tmp.blocks).decode())
+            return self.index
+
+
+    def get_object_fname(self,sha256):
+        return os.path.join(self.cache_dir,'objects',sha256[:2],
+                    sha256+'.fits')
+
+
+    def list_objects(self):
+        objects_dir=os.path.join(self.cache_dir,'objects')
+        return [os.path.join(objects_dir,sub,fname)
+                for sub in sorted(os.listdir(objects_dir))
+                for fname in sorted(os.listdir(os.path.join(objects_dir,sub)))
+                if fname.endswith('.fits')]
+
+
+    def get_fname(self,grid,power_type):
+        """Local file with a measurement, downloaded if not in the cache"""
+
+        relpath=measured_power.get_power_relpath(grid,power_type)
+        entry=self.get_index().get(relpath)
+        if entry is None:
+            raise KeyError('no measurement in mirror',relpath)
+        fname=self.get_object_fname(entry['sha256'])
+        with self.lock:
+            lock=self.fetch_locks.setdefault(entry['sha256'],threading.Lock())
+        with lock:
+            if os.path.exists(fname):
+                with self.lock:
+                    self.hits+=1
+                # mark as recently used (modification time is kept, since
+                # PowerCache uses it to validate its entries)
+                os.utime(fname,(time.time(),os.stat(fname).st_mtime))
+            else:
+                self._download(relpath,entry,fname)
+        return fname
+
+
+    def _download(self,relpath,entry,fname):
+        os.makedirs(os.path.dirname(fname),exist_ok=True)
+        tmp_fname='{}.{}.{}.tmp'.format(fname,os.getpid(),
+                    threading.get_ident())
+        try:
+            with open(tmp_fname,'wb') as f:
+                writer=_HashWriter(f)
+                nbytes=self.pool.get(relpath,writer)
+            if writer.sha.hexdigest()!=entry['sha256']:
+                raise OSError('checksum mismatch for '+relpath)
+            os.replace(tmp_fname,fname)
+        finally:
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+        with self.lock:
+            self.misses+=1
+            self.nbytes+=nbytes
+        self.evict(keep=fname)
+
+
+    def evict(self,keep=None):
+        """Remove least recently used files until the cache fits in the
+            budget (the file in keep is never removed)"""
+
+        with self.lock:
+            if self.nbytes<=self.max_bytes:
+                return
+            objects=[]
+            for fname in self.list_objects():
+                if fname==keep: continue
+                try:
+                    stat=os.stat(fname)
+                except FileNotFoundError:
+                    continue
+                objects.append((stat.st_atime,stat.st_size,fname))
+            for atime,size,fname in sorted(objects):
+                if self.nbytes<=self.max_bytes:
+                    break
+                try:
+                    os.remove(fname)
+                except FileNotFoundError:
+                    continue
+                self.nbytes-=size
+                self.evictions+=1
+
+
+    def prefetch(self,grids,power_types,workers=8):
+        """Download measurements missing from the cache, in parallel
+            threads (sharing the connection pool).
+            - power_types: single power type, or list with one per grid
+            Returns list of errors, as (index,location,exception)."""
+
+        if isinstance(power_types,str):
+            power_types=[power_types]*len(grids)
+        assert len(power_types)==len(grids),'need one power type per grid'
+        self.get_index()
+
+        def fetch(args):
+            grid,power_type=args
+            try:
+                self.get_fname(grid,power_type)
+            except Exception as err:
+                return err
+            return None
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results=list(pool.map(fetch,zip(grids,power_types)))
+        return [(i,self.get_location(grids[i],power_types[i]),err)
+                for i,err in enumerate(results) if err is not None]
+
+
+    def get_stats(self):
+        """Return dictionary with cache and connection counters"""
+
+        return {'hits':self.hits,'misses':self.misses,
+                'evictions':self.evictions,'nbytes':self.nbytes,
+                'max_bytes':self.max_bytes,
+                'connections':self.pool.connections,
+                'requests':self.pool.requests}
+
+
+class _BytesWriter(object):
+    def __init__(self):
+        self.blocks=[]
+
+    def write(self,block):
+        self.blocks.append(block)
+
+
+class _HashWriter(object):
+    """Write to file object, computing the SHA-256 checksum on the way"""
+
+    def __init__(self,out):
+        self.out=out
+        self.sha=hashlib.sha256()
+
+    def write(self,block):
+        self.sha.update(block)
+        self.out.write(block)
+
+
+def get_index(data_dir=None):
+    """Index of a data folder: size and checksum of each FITS file,
+        indexed by path relative to the folder"""
+
+    import unpickle
+    if data_dir is None:
+        data_dir=measured_power.get_repo_dir()+'/data/'
+    index={}
+    for power_type in measured_power.ALL_POWER_TYPES:
+        type_dir=os.path.join(data_dir,power_type)
+        for fname in sorted(os.listdir(type_dir)):
+            if not fname.endswith('.fits'): continue
+            full_fname=os.path.join(type_dir,fname)
+            index[power_type+'/'+fname]={
+                    'size':os.path.getsize(full_fname),
+                    'sha256':unpickle.get_checksum(full_fname)}
+    return index
+
+
+class _MirrorHandler(http.server.SimpleHTTPRequestHandler):
+    # keep connections open between requests
+    protocol_version='HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.lstrip('/')==INDEX_NAME:
+            body=self.server.index_bytes
+            self.send_response(200)
+            self.send_header('Content-Type','application/json')
+            self.send_header('Content-Length',str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            super().do_GET()
+
+    def log_message(self,*args):
+        pass
+
+
+class _MirrorServer(http.server.ThreadingHTTPServer):
+    daemon_threads=True
+
+
+def serve_mirror(data_dir=None,host='127.0.0.1',port=0,background=True):
+    """HTTP server for a data folder and its index, that can be used as
+        a mirror (or as a stand-in for one in tests).
+        - port: 0 to pick any free port (see server.url)
+        - background: serve from a daemon thread, and return the server
+          (stop it with server.shutdown())"""
+
+    if data_dir is None:
+        data_dir=measured_power.get_repo_dir()+'/data/'
+    index_bytes=json.dumps(get_index(data_dir)).encode()
+    handler=lambda *args,**kwargs: _MirrorHandler(*args,directory=data_dir,
+                **kwargs)
+    server=_MirrorServer((host,port),handler)
+    server.index_bytes=index_bytes
+    server.url='http://{}:{}'.format(*server.server_address[:2])
+    if background:
+        threading.Thread(target=server.serve_forever,daemon=True).start()
+    else:
+        server.serve_forever()
+    return server
+
+
+def check_mirror(max_bytes=None,workers=8):
+    """Serve the local data folder, read every measurement through an
+        HTTPBackend (in a temporary cache) and compare it with the local
+        files. Returns dictionary with timings and counters."""
+
+    import tempfile
+    import numpy as np
+    import power_catalog
+
+    catalog=power_catalog.PowerCatalog()
+    keys=catalog.keys()
+    grids=[catalog.index[key]['grid'] for key in keys]
+    power_types=[key[0] for key in keys]
+    server=serve_mirror()
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            backend=HTTPBackend(server.url,cache_dir=cache_dir,
+                        max_bytes=(max_bytes or 1024**3))
+            t0=time.perf_counter()
+            errors=backend.prefetch(grids,power_types,workers=workers)
+            prefetch_time=time.perf_counter()-t0
+            assert not errors,errors
+            n_diff=0
+            for key,grid,power_type in zip(keys,grids,power_types):
+                power=backend.get_power(grid,power_type)
+                local=catalog.index[key]
+                for name,value in local.items():
+                    if isinstance(value,np.ndarray):
+                        if not np.array_equal(value,power[name],equal_nan=True):
+                            n_diff+=1
+            stats=backend.get_stats()
+            backend.pool.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+    stats.update(n_files=len(keys),n_diff=n_diff,prefetch_time=prefetch_time)
+    return stats
+
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(description='Serve or check a mirror')
+    parser.add_argument('command',choices=['serve','check'])
+    parser.add_argument('--data-dir',default=None)
+    parser.add_argument('--host',default='127.0.0.1')
+    parser.add_argument('--port',type=int,default=8000)
+    parser.add_argument('--max-bytes',type=int,default=None,
+                help='cache budget when checking (default: 1 GB)')
+    args=parser.parse_args()
+
+    if args.command=='serve':
+        print('serving',args.data_dir or 'data/','on port',args.port)
+        serve_mirror(args.data_dir,host=args.host,port=args.port,
+                    background=False)
+    else:
+        print(check_mirror(max_bytes=args.max_bytes))
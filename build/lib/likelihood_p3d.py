@@ -0,0 +1,155 @@
+import numpy as np
+import sherwood_simulation as she_sim
+import measured_power
+
+# order of power types within each (k,mu) bin of the data vector
+P3D_TYPES=['flux_p3d','cross_p3d','halo_p3d']
+
+
+def get_skewers_from_halos(halos):
+    """Grid of skewers (flux) matching the base grid of a HaloGrid"""
+
+    return she_sim.Grid(simulation=halos.sim,snapshot_num=halos.snapshot_num,
+                n_xy=halos.n_xy,n_z=halos.n_z,axis=halos.axis)
+
+
+def get_gaussian_covariance(P_F,P_X,P_H,counts):
+    """Gaussian covariance of (P_F,P_X,P_H) in each bin, from the number of
+        modes (counts), with Cov(P_ab,P_cd)=(P_ac*P_bd+P_ad*P_bc)/counts.
+        P_H should include shot noise. Returns array of shape (...,3,3)."""
+
+    cov=np.empty(np.shape(P_F)+(3,3))
+    cov[...,0,0]=2*P_F**2
+    cov[...,0,1]=cov[...,1,0]=2*P_F*P_X
+    cov[...,0,2]=cov[...,2,0]=2*P_X**2
+    cov[...,1,1]=P_F*P_H+P_X**2
+    cov[...,1,2]=cov[...,2,1]=2*P_X*P_H
+    cov[...,2,2]=2*P_H**2
+    return cov/np.asarray(counts)[...,np.newaxis,np.newaxis]
+
+
+class JointLikelihood(object):
+    """Gaussian likelihood for joint flux, cross and halo P3D measurements.
+      - halos: list of HaloGrid objects (the flux is measured in the same
+        base grid), each one is treated as an independent measurement
+      - power_types: subset of P3D_TYPES to include in the data vector
+      - catalog: PowerCatalog to get measurements from (optional)
+      - k_max_hMpc: only use bins with k below this value (optional)
+    The data vector contains, for each measurement and each valid (k,mu)
+    bin, the power types in the order of P3D_TYPES. The covariance is
+    block diagonal, with one block per bin, and the Cholesky factors of
+    the blocks are computed only once (the full matrix is never built)."""
+
+    def __init__(self,halos,power_types=P3D_TYPES,catalog=None,
+                k_max_hMpc=None):
+
+        for power_type in power_types:
+            assert power_type in P3D_TYPES,'unknown power type '+power_type
+        self.halos=list(halos)
+        self.power_types=[pt for pt in P3D_TYPES if pt in power_types]
+        # index of power types within the 3x3 covariance of each bin
+        cov_index=[P3D_TYPES.index(pt) for pt in self.power_types]
+
+        self.masks=[]
+        # wavenumber and mu of valid bins, for each measurement
+        self.k_hMpc=[]
+        self.mu=[]
+        data=[]
+        cov_blocks=[]
+        for halos in self.halos:
+            skewers=get_skewers_from_halos(halos)
+            grids={'flux_p3d':skewers,'cross_p3d':halos,'halo_p3d':halos}
+            if catalog is None:
+                power={pt:measured_power.get_power_from_grid(grids[pt],pt,
+                            use_cache=True) for pt in P3D_TYPES}
+            else:
+                power={pt:catalog.get_power(grids[pt],pt) for pt in P3D_TYPES}
+            shape=power['flux_p3d']['p3d_hMpc'].shape
+            for pt in P3D_TYPES:
+                assert power[pt]['p3d_hMpc'].shape==shape,'inconsistent bins'
+
+            # use bins that are valid and non-empty in all measurements
+            mask=np.ones(shape,dtype=bool)
+            for pt in P3D_TYPES:
+                mask&=measured_power.get_valid_mask(power[pt])
+                mask&=(power[pt]['counts']>0)
+            if k_max_hMpc is not None:
+                mask&=(power['flux_p3d']['k_hMpc']<k_max_hMpc)
+            self.masks.append(mask)
+            self.k_hMpc.append(power['flux_p3d']['k_hMpc'][mask])
+            self.mu.append(power['flux_p3d']['mu'][mask])
+
+            # (n_bins,n_types) array of measured power in valid bins
+            P={pt:power[pt]['p3d_hMpc'][mask] for pt in P3D_TYPES}
+            data.append(np.stack([P[pt] for pt in self.power_types],axis=-1))
+
+            # (n_bins,3,3) covariance, restricted to types used
+            cov=get_gaussian_covariance(P['flux_p3d'],P['cross_p3d'],
+                        P['halo_p3d'],power['cross_p3d']['counts'][mask])
+            cov_blocks.append(cov[:,cov_index][:,:,cov_index])
+
+        self.data=np.concatenate([d.ravel() for d in data])
+        self.n_data=len(self.data)
+        self.n_types=len(self.power_types)
+
+        # (n_bins,n_types,n_types) blocks of the covariance (no dense matrix)
+        self.cov_blocks=np.concatenate(cov_blocks)
+        self.n_bins=len(self.cov_blocks)
+
+        # cache Cholesky factors (L) of each block, and their inverse to
+        # whiten residuals bin by bin
+        self.chol=np.linalg.cholesky(self.cov_blocks)
+        self.inv_chol=np.linalg.inv(self.chol)
+        self.log_det=2*np.sum(np.log(np.diagonal(self.chol,axis1=1,axis2=2)))
+        self.whitened_data=self.whiten(self.data)
+
+
+    def whiten(self,vector):
+        """Multiply (batch of) data vector(s) by the inverse Cholesky factor
+            of the covariance, one (k,mu) bin at a time"""
+
+        vector=np.asarray(vector)
+        binned=vector.reshape(vector.shape[:-1]+(self.n_bins,self.n_types))
+        return np.einsum('bij,...bj->...bi',self.inv_chol,binned)
+
+
+    def get_vector(self,arrays):
+        """Pack model arrays into a (batch of) data vector(s).
+            - arrays: list (one per measurement) of dictionaries with
+              arrays of shape (...,n_k,n_mu) for each power type
+            Returns array of shape (...,n_data)."""
+
+        assert len(arrays)==len(self.masks),'need one entry per measurement'
+        vectors=[]
+        for mask,model in zip(self.masks,arrays):
+            stacked=np.stack([np.asarray(model[pt])[...,mask]
+                                for pt in self.power_types],axis=-1)
+            vectors.append(stacked.reshape(stacked.shape[:-2]+(-1,)))
+        return np.concatenate(vectors,axis=-1)
+
+
+    def get_vector_from_bins(self,arrays):
+        """Same as get_vector, but for models evaluated only in valid bins
+            (i.e., at self.k_hMpc and self.mu), with shape (...,n_bins)"""
+
+        assert len(arrays)==len(self.masks),'need one entry per measurement'
+        vectors=[]
+        for model in arrays:
+            stacked=np.stack([np.asarray(model[pt])
+                                for pt in self.power_types],axis=-1)
+            vectors.append(stacked.reshape(stacked.shape[:-2]+(-1,)))
+        return np.concatenate(vectors,axis=-1)
+
+
+    def get_chi2(self,model_vector):
+        """Chi2 of a model vector, or of a batch with shape (n_models,n_data)"""
+
+        residual=self.whiten(model_vector)-self.whitened_data
+        return np.sum(residual**2,axis=(-2,-1))
+
+
+    def get_log_like(self,model_vector):
+        """Log-likelihood (including normalization) of model vector(s)"""
+
+        norm=-0.5*(self.log_det+self.n_data*np.log(2*np.pi))
+        return norm-0.5*self.get_chi2(model_vector)
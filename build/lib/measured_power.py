@@ -0,0 +1,634 @@
+import os
+import json
+import mmap
+import struct
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import sherwood_simulation as she_sim
+import instrument
+
+# types of power spectra stored under data/ (one sub-folder each)
+ALL_POWER_TYPES=['flux_p1d','flux_p3d','halo_p3d','cross_p3d']
+
+# names of FITS columns, and of the corresponding keys in power dictionaries
+COLUMN_KEYS={'P3D_HMPC':'p3d_hMpc','K_HMPC':'k_hMpc','MU':'mu',
+            'COUNTS':'counts','KP_HMPC':'kp_hMpc','P1D_HMPC':'p1d_hMpc'}
+
+# consolidated binary store: magic string, followed by the length (uint64)
+# of a JSON metadata table, the table itself, and then the aligned arrays
+STORE_MAGIC=b'SHERP3D1'
+STORE_ALIGN=64
+
+
+def get_repo_dir():
+    """ Return directory of this repository, using environment variable """
+
+    assert ('SHERWOOD' in os.environ),'Define SHERWOOD environ'
+    return os.environ['SHERWOOD']
+
+
+def get_power_fname(grid,power_type,pickle=False):
+    """ Find out (full path) filename for a given measured power spectrum """
+
+    # get full path to repo data
+    if pickle:
+        data_dir=get_repo_dir()+'/pickled_data/'
+        extension='p'
+    else:
+        data_dir=get_repo_dir()+'/data/'
+        extension='fits'
+
+    return '{}/{}'.format(data_dir,get_power_relpath(grid,power_type,extension))
+
+
+def get_power_relpath(grid,power_type,extension='fits'):
+    """ Path of a measured power spectrum, relative to the data folder """
+
+    # get nametag from grid
+    nametag=grid.get_nametag()
+
+    if power_type == "flux_p1d":
+        return 'flux_p1d/p1d_{}.{}'.format(nametag,extension)
+    elif power_type == "flux_p3d":
+        return 'flux_p3d/p3d_{}_20_16_20.{}'.format(nametag,extension)
+    elif power_type == "cross_p3d":
+        return 'cross_p3d/cross_{}_20_16_20.{}'.format(nametag,extension)
+    elif power_type == "halo_p3d":
+        # only one mu bin when not adding RSDs
+        n_mu = (16 if grid.add_rsd else 1)
+        return 'halo_p3d/halo_{}_20_{}_20.{}'.format(nametag,n_mu,extension)
+    else:
+        raise ValueError("unknown power spectrum type",power_type)
+
+
+def get_grid_from_header(header,power_type):
+    """Setup Grid (or HaloGrid) object from the metadata in a FITS header"""
+
+    # setup simulation object 
+    sim = she_sim.SherwoodSimulation(L_hMpc=header['L_HMPC'],
+                n_part=header['N_PART'])
+    # setup grid object
+    if "flux" in power_type: 
+        grid = she_sim.Grid(simulation=sim,snapshot_num=header['SNAPSHOT_NUM'],
+                    n_xy=header['N_XY'],n_z=header['N_Z'],axis=header['AXIS'])
+    else:
+        logMh_min=header['LOGMH_MIN']
+        logMh_max=header['LOGMH_MAX']
+        add_rsd=header['ADD_RSD']
+        grid=she_sim.HaloGrid(simulation=sim,
+                    snapshot_num=header['SNAPSHOT_NUM'],
+                    n_xy=header['N_XY'],n_z=header['N_Z'],axis=header['AXIS'],
+                    logMh_min=logMh_min,logMh_max=logMh_max,add_rsd=add_rsd)
+
+    return grid
+
+
+def get_power_metadata(header,power_type):
+    """Collect power type, grid and extra metadata from a FITS header"""
+
+    # collect information to return
+    power={'power_type':power_type,
+            'grid':get_grid_from_header(header,power_type)}
+    
+    # extra metadata depending on power type
+    if "flux" not in power_type:
+        power['shot_noise']=header['SHOT_NOISE']
+    if power_type != "halo_p3d":
+        power['mean_flux']=header['MEAN_FLUX']
+    if power_type != "flux_p1d":
+        power['n_k_bins']=header['N_K_BINS']
+        power['n_mu_bins']=header['N_MU_BINS']
+        power['k_hMpc_max']=header['K_HMPC_MAX']
+
+    return power
+
+
+def get_column_names(power_type):
+    """FITS columns stored for a given power type"""
+
+    if power_type == "flux_p1d":
+        return ['KP_HMPC','P1D_HMPC']
+    else:
+        return ['P3D_HMPC','K_HMPC','MU','COUNTS']
+
+
+class LazyPower(Mapping):
+    """Power read from a FITS file, where the header is parsed on setup but
+        each column is only read the first time it is accessed. It can be
+        used as the dictionary returned by read_fits_power. By default
+        the file is opened for each column read, but it can be kept open
+        by using the object as a context manager:
+            with read_fits_power(fname,power_type,lazy=True) as power:
+                ... """
+
+    def __init__(self,fname,power_type):
+
+        self.fname=fname
+        self.power_type=power_type
+        # open FITS file (only while inside the context manager)
+        self.hdul=None
+
+        # parse header and collect metadata
+        import fitsio
+        with instrument.stage('LazyPower.header'):
+            with fitsio.FITS(fname) as hdul:
+                header=hdul[power_type.upper()].read_header()
+                self.metadata=get_power_metadata(header,power_type)
+
+        # map keys in dictionary to FITS columns (not read yet)
+        self.columns={COLUMN_KEYS[name]:name
+                        for name in get_column_names(power_type)}
+        self.arrays={}
+
+
+    def __enter__(self):
+        if self.hdul is None:
+            import fitsio
+            self.hdul=fitsio.FITS(self.fname)
+        return self
+
+
+    def __exit__(self,*args):
+        self.close()
+
+
+    def close(self):
+        """Close FITS file, if open (columns already read are kept)"""
+
+        if self.hdul is not None:
+            self.hdul.close()
+            self.hdul=None
+
+
+    def _read_column(self,key):
+        name=self.columns[key]
+        with instrument.stage('LazyPower.column'):
+            if self.hdul is not None:
+                array=self.hdul[self.power_type.upper()][name][:]
+            else:
+                import fitsio
+                with fitsio.FITS(self.fname) as hdul:
+                    array=hdul[self.power_type.upper()][name][:]
+        instrument.add_bytes(self.fname,array.nbytes)
+        return array
+
+
+    def __getitem__(self,key):
+        if key in self.metadata:
+            return self.metadata[key]
+        if key not in self.columns:
+            raise KeyError(key)
+        if key not in self.arrays:
+            self.arrays[key]=self._read_column(key)
+        return self.arrays[key]
+
+
+    def __iter__(self):
+        yield from self.metadata
+        yield from self.columns
+
+
+    def __len__(self):
+        return len(self.metadata)+len(self.columns)
+
+
+    def load(self):
+        """Read all columns not read yet (single open of the file)"""
+
+        with self:
+            for key in self.columns:
+                self[key]
+        return self
+
+
+def read_fits_power(fname,power_type,lazy=False):
+    """Read measured power from FITS file, and return dictionary.
+        - lazy: return LazyPower instead, that reads columns on demand"""
+
+    if lazy:
+        return LazyPower(fname,power_type)
+
+    # imported on first use, to keep the import of this module fast
+    import fitsio
+    with instrument.stage('read_fits_power'):
+        # read FITS file
+        with instrument.stage('read_fits_power.open'):
+            hdul = fitsio.FITS(fname)
+            hdu = hdul[power_type.upper()]
+        with instrument.stage('read_fits_power.header'):
+            header = hdu.read_header()
+            # collect metadata to return
+            power=get_power_metadata(header,power_type)
+
+        # actual power measurements
+        with instrument.stage('read_fits_power.columns'):
+            if power_type == "flux_p1d":
+                power['kp_hMpc']=hdu['KP_HMPC'][:]
+                power['p1d_hMpc']=hdu['P1D_HMPC'][:]
+            else:
+                power['p3d_hMpc']=hdu['P3D_HMPC'][:]
+                power['k_hMpc']=hdu['K_HMPC'][:]
+                power['mu']=hdu['MU'][:]
+                power['counts']=hdu['COUNTS'][:]
+
+        hdul.close()
+
+    if instrument.enabled:
+        instrument.add_bytes(fname,sum(power[COLUMN_KEYS[name]].nbytes
+                                for name in get_column_names(power_type)))
+
+    return power
+
+
+def assert_sim(sim1,sim2):
+    assert sim1.L_hMpc==sim2.L_hMpc, 'inconsistent L_hMpc'
+    assert sim1.n_part==sim2.n_part, 'inconsistent n_part'
+
+
+def assert_grid(grid1,grid2,power_type):
+    # grids are value types, check field by field only if they differ
+    if grid1==grid2:
+        return
+    # assert simulation metadata
+    assert_sim(grid1.sim,grid2.sim)
+    # and extra metadata in grid
+    assert grid1.snapshot_num==grid2.snapshot_num, 'inconsistent snapshot_num'
+    assert grid1.n_xy==grid2.n_xy, 'inconsistent n_xy'
+    assert grid1.n_z==grid2.n_z, 'inconsistent n_z'
+    assert grid1.axis==grid2.axis, 'inconsistent axis'
+    if "flux" not in power_type:
+        assert grid1.add_rsd==grid2.add_rsd, 'inconsistent add_rsd'
+        assert grid1.logMh_min==grid2.logMh_min, 'inconsistent logMh_min'
+        assert grid1.logMh_max==grid2.logMh_max, 'inconsistent logMh_max'
+
+
+def _read_only_power(power):
+    """Return shallow copy of power dictionary, with read-only array views"""
+
+    view={}
+    for key,value in power.items():
+        if isinstance(value,np.ndarray):
+            value=value.view()
+            value.flags.writeable=False
+        view[key]=value
+    return view
+
+
+class PowerCache(object):
+    """Bounded LRU cache of power dictionaries read from FITS files. Inputs:
+      - max_bytes: budget for the (approximate) size of cached arrays
+    Entries are invalidated when the modification time or the size of the
+    file change. Cached arrays are returned as read-only views."""
+
+    def __init__(self,max_bytes=64*1024**2):
+
+        self.max_bytes=max_bytes
+        # map (fname,power_type) to (mtime,size,nbytes,power)
+        self.entries=OrderedDict()
+        self.nbytes=0
+        # counters to monitor performance of the cache
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+        self.invalidations=0
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def clear(self):
+        """Remove all entries (counters are not reset)"""
+
+        self.entries.clear()
+        self.nbytes=0
+
+
+    def get_stats(self):
+        """Return dictionary with cache counters and current size"""
+
+        return {'hits':self.hits,'misses':self.misses,
+                'evictions':self.evictions,'invalidations':self.invalidations,
+                'entries':len(self.entries),'nbytes':self.nbytes,
+                'max_bytes':self.max_bytes}
+
+
+    def _remove(self,key):
+        entry=self.entries.pop(key)
+        self.nbytes-=entry[2]
+
+
+    def read_fits_power(self,fname,power_type):
+        """Same as read_fits_power, but using the cache when possible"""
+
+        stat=os.stat(fname)
+        key=(fname,power_type)
+        if key in self.entries:
+            mtime,size,nbytes,power=self.entries[key]
+            if mtime==stat.st_mtime_ns and size==stat.st_size:
+                self.hits+=1
+                self.entries.move_to_end(key)
+                return _read_only_power(power)
+            # file has changed since it was cached
+            self.invalidations+=1
+            self._remove(key)
+
+        self.misses+=1
+        power=read_fits_power(fname,power_type)
+        # cached arrays can not be modified, even by the cache owner
+        for value in power.values():
+            if isinstance(value,np.ndarray):
+                value.flags.writeable=False
+        nbytes=sum(v.nbytes for v in power.values() if isinstance(v,np.ndarray))
+
+        # entries larger than the budget are never stored
+        if nbytes<=self.max_bytes:
+            self.entries[key]=(stat.st_mtime_ns,stat.st_size,nbytes,power)
+            self.nbytes+=nbytes
+            # evict least recently used entries until we fit in budget
+            while self.nbytes>self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions+=1
+
+        return _read_only_power(power)
+
+
+# cache shared by all callers of get_power_from_grid(...,use_cache=True)
+default_cache=PowerCache()
+
+# backend used by get_power_from_grid (see data_backend.py), None to read
+# files from the local copy of the repository in $SHERWOOD
+_backend=None
+
+
+def set_backend(backend):
+    """Set backend used to find measurements (None for local files)"""
+
+    global _backend
+    _backend=backend
+
+
+def get_backend():
+    """Return backend in use, None for local files. If the environment
+        variable SHERWOOD_MIRROR is set (and no backend has been set), an
+        HTTPBackend reading from that URL is set up on first use."""
+
+    global _backend
+    if _backend is None and os.environ.get('SHERWOOD_MIRROR'):
+        import data_backend
+        _backend=data_backend.HTTPBackend(os.environ['SHERWOOD_MIRROR'])
+    return _backend
+
+
+def read_power_file(fname,power_type,cache=None,lazy=False):
+    """Read power from FITS file, with a PowerCache (optional) or lazily"""
+
+    if lazy:
+        return read_fits_power(fname,power_type,lazy=True)
+    elif cache is None:
+        return read_fits_power(fname,power_type)
+    else:
+        return cache.read_fits_power(fname,power_type)
+
+
+def get_power_from_grid(grid,power_type,use_cache=False,cache=None,
+            lazy=False):
+    """Return measured power spectrum corresponding to input grid.
+        - use_cache: use default_cache (read-only arrays)
+        - cache: use this PowerCache object instead (read-only arrays)
+        - lazy: return LazyPower, reading columns on demand (no cache)
+        Measurements are found through the backend set with set_backend,
+        if any, or read from the local copy of the repository."""
+
+    with instrument.stage('get_power_from_grid'):
+        if use_cache and cache is None:
+            cache=default_cache
+        backend=get_backend()
+        if backend is not None:
+            power=backend.get_power(grid,power_type,cache=cache,lazy=lazy)
+        else:
+            # get filename for corresponding FITS file
+            with instrument.stage('get_power_from_grid.fname'):
+                fname = get_power_fname(grid,power_type,pickle=False)
+            # get measured power and grid metadata
+            power=read_power_file(fname,power_type,cache=cache,lazy=lazy)
+
+        # make sure that grid metadata is consistent
+        with instrument.stage('get_power_from_grid.assert_grid'):
+            assert_grid(grid,power['grid'],power_type)
+
+    return power
+
+
+class PowerStore(object):
+    """Memory-mapped reader of the consolidated binary store, written by
+        power_store.py. Arrays are returned as read-only views of the
+        mapped file, without any copy, and the file stays mapped as long
+        as any of these views is alive."""
+
+    def __init__(self,fname=None):
+
+        if fname is None:
+            fname=get_repo_dir()+'/data/power_store.bin'
+        self.fname=fname
+
+        # single open + mmap for the whole suite of measurements
+        with open(fname,'rb') as f:
+            self.mmap=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        magic=self.mmap[:len(STORE_MAGIC)]
+        assert magic==STORE_MAGIC,'not a power store '+fname
+        n0=len(STORE_MAGIC)
+        table_size,=struct.unpack('<Q',self.mmap[n0:n0+8])
+        self.table=json.loads(self.mmap[n0+8:n0+8+table_size].decode())
+
+        # index entries by power type and grid nametag
+        self.index={}
+        for entry in self.table:
+            power_type=entry['power_type']
+            grid=get_grid_from_header(entry['header'],power_type)
+            self.index[(power_type,grid.get_nametag())]=entry
+
+
+    def __len__(self):
+        return len(self.table)
+
+
+    def get_entry_power(self,entry):
+        """Return power dictionary for an entry of the metadata table"""
+
+        power=get_power_metadata(entry['header'],entry['power_type'])
+        for name,col in entry['columns'].items():
+            dtype=np.dtype(col['dtype'])
+            count=int(np.prod(col['shape']))
+            array=np.frombuffer(self.mmap,dtype=dtype,count=count,
+                        offset=col['offset'])
+            power[COLUMN_KEYS[name]]=array.reshape(col['shape'])
+
+        return power
+
+
+    def get_power(self,grid,power_type):
+        """Return measured power spectrum corresponding to input grid"""
+
+        key=(power_type,grid.get_nametag())
+        if key not in self.index:
+            raise KeyError('no measurement in store',key)
+        power=self.get_entry_power(self.index[key])
+
+        # make sure that grid metadata is consistent
+        assert_grid(grid,power['grid'],power_type)
+
+        return power
+
+
+# stores already mapped, indexed by filename
+_open_stores={}
+
+
+def get_power_store(fname=None):
+    """Return (shared) PowerStore object, mapping the file only once"""
+
+    if fname is None:
+        fname=get_repo_dir()+'/data/power_store.bin'
+    if fname not in _open_stores:
+        _open_stores[fname]=PowerStore(fname)
+    return _open_stores[fname]
+
+
+def get_power_from_store(grid,power_type,fname=None):
+    """Return measured power spectrum from the consolidated binary store"""
+
+    return get_power_store(fname).get_power(grid,power_type)
+
+
+def _timed_read(grid,power_type):
+    """Read power for a grid, and return (power,error,fname,wall time)"""
+
+    t0=time.perf_counter()
+    fname=None
+    try:
+        backend=get_backend()
+        if backend is None:
+            fname=get_power_fname(grid,power_type,pickle=False)
+        else:
+            fname=backend.get_location(grid,power_type)
+        power=get_power_from_grid(grid,power_type)
+        error=None
+    except Exception as err:
+        power=None
+        error=err
+    return power,error,fname,time.perf_counter()-t0
+
+
+def read_many(grids,power_types,workers=8):
+    """Read measured power for a list of grids, using a pool of threads.
+        - grids: list of Grid (or HaloGrid) objects
+        - power_types: single power type, or list with one per grid
+        - workers: number of threads (fitsio releases the GIL during I/O)
+    Returns list of power dictionaries (in the same order as grids, None
+    when reading failed) and a report with errors and timings."""
+
+    if isinstance(power_types,str):
+        power_types=[power_types]*len(grids)
+    assert len(power_types)==len(grids),'need one power type per grid'
+
+    t0=time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results=list(pool.map(_timed_read,grids,power_types))
+    wall_time=time.perf_counter()-t0
+
+    powers=[power for power,_,_,_ in results]
+    report={'fnames':[fname for _,_,fname,_ in results],
+            'times':[dt for _,_,_,dt in results],
+            'errors':[(i,fname,error) for i,(_,error,fname,_)
+                        in enumerate(results) if error is not None],
+            'wall_time':wall_time,'workers':workers}
+    # total time spent reading, if files had been read one at a time
+    report['serial_time']=sum(report['times'])
+
+    return powers,report
+
+
+def get_valid_mask(power):
+    """Boolean (n_k,n_mu) mask of bins to use: non-empty (mu is not NaN)
+        and below the maximum wavenumber of the measurement"""
+
+    return ~np.isnan(power['mu']) & ~(power['k_hMpc']>power['k_hMpc_max'])
+
+
+def get_masked_power(power,mask=None):
+    """Return masked arrays (masking invalid bins) of k, mu, P and counts.
+        - mask: boolean mask of valid bins (default: get_valid_mask)"""
+
+    if mask is None:
+        mask=get_valid_mask(power)
+
+    return {key:np.ma.MaskedArray(power[key],mask=~mask)
+                for key in ['k_hMpc','mu','p3d_hMpc','counts']}
+
+
+def get_flat_power(power,mask=None):
+    """Return compact 1D arrays of k, mu, P and counts in valid bins, and
+        the (i_k,i_mu) indices of these bins in the original grid.
+        - mask: boolean mask of valid bins (default: get_valid_mask)"""
+
+    if mask is None:
+        mask=get_valid_mask(power)
+
+    flat={key:power[key][mask] for key in ['k_hMpc','mu','p3d_hMpc','counts']}
+    indices=np.nonzero(mask)
+    flat['i_k']=indices[0]
+    if len(indices)>1:
+        flat['i_mu']=indices[1]
+
+    return flat
+
+
+def get_gaussian_error(power):
+    """Gaussian errors on auto-power from number of modes in each bin.
+        These are only approximated errorbars for cross-correlations!"""
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return power['p3d_hMpc']/np.sqrt(0.5*power['counts'])
+
+
+def get_cross_error(data_F,data_X,data_H):
+    """Gaussian errors on cross-power, from flux, cross and halo power"""
+
+    P_F=data_F['p3d_hMpc']
+    P_X=data_X['p3d_hMpc']
+    P_H=data_H['p3d_hMpc']
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return np.sqrt(P_X**2+P_F*P_H)/np.sqrt(data_X['counts'])
+
+
+def get_halo_power_no_shot_noise(data_H):
+    """Halo power after subtracting shot noise"""
+
+    return data_H['p3d_hMpc']-data_H['shot_noise']
+
+
+def get_cross_coefficient(data_F,data_X,data_H):
+    """Cross-correlation coefficient -P_X/sqrt(P_F*(P_H-shot_noise)).
+        The sign is flipped, since flux and halo are anti-correlated."""
+
+    P_F=data_F['p3d_hMpc']
+    P_X=data_X['p3d_hMpc']
+    P_H=get_halo_power_no_shot_noise(data_H)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return -P_X/np.sqrt(P_F*P_H)
+
+
+def get_power_from_pickle(grid=None,power_type=None,fname=None):
+    """Return measured power spectrum from pickled file"""
+
+    if fname is None:
+        fname = get_power_fname(grid,power_type,pickle=True)
+    print('will unpickle from file',fname)
+    import pickle
+    return pickle.load(open(fname,"rb"))
+
+
@@ -0,0 +1,101 @@
+import numpy as np
+import model_density
+
+
+def _as_params(param,k_hMpc):
+    """Reshape parameter (scalar or array of n_params) to broadcast against
+        arrays with the shape of k_hMpc, returning (n_params,)+k.shape"""
+
+    param=np.asarray(param,dtype=float)
+    return param.reshape(param.shape+(1,)*np.ndim(k_hMpc))
+
+
+class KaiserModel(object):
+    """Linear (Kaiser) model for flux, halo and cross P3D, over full (k,mu)
+        grids and batches of parameters. Each tracer a has an amplitude
+            T_a(k,mu) = b_a (1+beta_a mu^2) exp(-0.5 (k mu sigma_a)^2)
+        and P_ab = T_a T_b P_L(k), where sigma_a sets an optional
+        (Gaussian) non-linear damping along the line of sight.
+        Parameters can be scalars or arrays of length n_params, and then
+        the output has shape (n_params,)+k_hMpc.shape. Linear power is
+        cached for each (z,k_hMpc) grid, so parameter scans only cost
+        elementwise operations."""
+
+    def __init__(self,linear_model=None):
+
+        if linear_model is None:
+            linear_model=model_density.get_linear_density_model()
+        self.linear_model=linear_model
+        # linear power, indexed by redshift and content of k array
+        self.linP_cache={}
+
+
+    def get_linP(self,z,k_hMpc):
+        """Linear power on input grid (cached)"""
+
+        k_hMpc=np.asarray(k_hMpc,dtype=float)
+        key=(z,k_hMpc.shape,k_hMpc.tobytes())
+        if key not in self.linP_cache:
+            linP=self.linear_model.linP_hMpc_batch(z,k_hMpc)
+            linP.flags.writeable=False
+            self.linP_cache[key]=linP
+        return self.linP_cache[key]
+
+
+    def get_tracer_amplitude(self,k_hMpc,mu,bias,beta,sigma_hMpc=0.0):
+        """Kaiser amplitude (with damping) of a tracer, (n_params,)+k.shape"""
+
+        mu2=np.asarray(mu)**2
+        bias=_as_params(bias,k_hMpc)
+        beta=_as_params(beta,k_hMpc)
+        T=bias*(1+beta*mu2)
+        sigma_hMpc=_as_params(sigma_hMpc,k_hMpc)
+        if np.any(sigma_hMpc!=0):
+            T=T*np.exp(-0.5*(sigma_hMpc*k_hMpc)**2*mu2)
+        return T
+
+
+    def get_beta_halo(self,z,b_H,beta_H=None):
+        """RSD parameter for halos, using f(z)/b_H if not specified"""
+
+        if beta_H is None:
+            return model_density.f_of_z(z)/np.asarray(b_H,dtype=float)
+        return beta_H
+
+
+    def flux_p3d(self,z,k_hMpc,mu,b_F,beta_F,sigma_F=0.0):
+        """Linear flux power spectrum"""
+
+        T_F=self.get_tracer_amplitude(k_hMpc,mu,b_F,beta_F,sigma_F)
+        return T_F**2*self.get_linP(z,k_hMpc)
+
+
+    def halo_p3d(self,z,k_hMpc,mu,b_H,beta_H=None,sigma_H=0.0,
+                shot_noise=0.0):
+        """Linear halo power spectrum (plus constant shot noise)"""
+
+        beta_H=self.get_beta_halo(z,b_H,beta_H)
+        T_H=self.get_tracer_amplitude(k_hMpc,mu,b_H,beta_H,sigma_H)
+        return T_H**2*self.get_linP(z,k_hMpc)+_as_params(shot_noise,k_hMpc)
+
+
+    def cross_p3d(self,z,k_hMpc,mu,b_F,beta_F,b_H,beta_H=None,sigma_F=0.0,
+                sigma_H=0.0):
+        """Linear flux-halo cross power spectrum"""
+
+        beta_H=self.get_beta_halo(z,b_H,beta_H)
+        T_F=self.get_tracer_amplitude(k_hMpc,mu,b_F,beta_F,sigma_F)
+        T_H=self.get_tracer_amplitude(k_hMpc,mu,b_H,beta_H,sigma_H)
+        return T_F*T_H*self.get_linP(z,k_hMpc)
+
+
+    def get_p3d(self,z,k_hMpc,mu,b_F,beta_F,b_H,beta_H=None,sigma_F=0.0,
+                sigma_H=0.0,shot_noise=0.0):
+        """Dictionary with flux, cross and halo P3D sharing parameters"""
+
+        beta_H=self.get_beta_halo(z,b_H,beta_H)
+        T_F=self.get_tracer_amplitude(k_hMpc,mu,b_F,beta_F,sigma_F)
+        T_H=self.get_tracer_amplitude(k_hMpc,mu,b_H,beta_H,sigma_H)
+        linP=self.get_linP(z,k_hMpc)
+        return {'flux_p3d':T_F**2*linP,'cross_p3d':T_F*T_H*linP,
+                'halo_p3d':T_H**2*linP+_as_params(shot_noise,k_hMpc)}
@@ -0,0 +1,125 @@
+import numpy as np
+import sherwood_simulation as she_sim
+import measured_power
+import model_density
+
+# size of the figure made by render_ratio
+FIGSIZE=[8,6]
+
+
+def get_linear_power(data_F,data_X,model=None):
+    """Linear matter power on the full (k,mu) grids of flux and cross"""
+
+    if model is None:
+        model=model_density.get_linear_density_model()
+    z=data_F['grid'].get_z()
+    P_L_F=model.linP_hMpc_batch(z=z,k_hMpc=data_F['k_hMpc'])
+    P_L_X=model.linP_hMpc_batch(z=z,k_hMpc=data_X['k_hMpc'])
+    return P_L_F,P_L_X
+
+
+def render_ratio(fig,data_F,data_X,data_H,P_L_F,P_L_X,downsample=5):
+    """Draw flux and cross P3D divided by the linear power, in figure fig
+        (cleared first, so it can be reused)"""
+
+    import matplotlib.pyplot as plt
+    with plt.rc_context({'font.size': 10}):
+        fig.clf()
+        # two panels,top flux p3d and bottom cross
+        axs=fig.subplots(2,sharex=True,sharey=False)
+        z=data_F['grid'].get_z()
+        fig.suptitle('Flux and cross power spectra at z={}'.format(z))
+
+        # short-cuts for convenience
+        n_mu=data_F['n_mu_bins']
+        cm=plt.get_cmap('jet')
+        mu_edges = np.linspace(0., 1.,n_mu + 1)
+
+        # identify bins we want to keep in plot (all mu bins at once)
+        keep=measured_power.get_valid_mask(data_F)
+
+        # plot flux_p3d
+        ratio_F=data_F['p3d_hMpc']/P_L_F
+        error_F=measured_power.get_gaussian_error(data_F)/P_L_F
+        for i in range(0,n_mu,downsample):
+            col=cm(i/n_mu)
+            k_mu=data_F['k_hMpc'][keep[:,i],i]
+            low=(ratio_F-error_F)[keep[:,i],i]
+            high=(ratio_F+error_F)[keep[:,i],i]
+            label=r"%.2f $\leq \mu \leq$ %.2f" % (mu_edges[i],mu_edges[i+1])
+            kwargs={'color':col}
+            axs[0].fill_between(k_mu,low,high,alpha=.3,label=label,**kwargs)
+            axs[0].plot(k_mu,low,lw=3,alpha=.1,**kwargs)
+            axs[0].plot(k_mu,high,lw=3,alpha=.1,**kwargs)
+
+        axs[0].set_ylabel(ylabel=r"$P_F(k,\mu) / P_L(k)$")
+        axs[0].set_xscale("log")
+        axs[0].set_xlim([0.03,20])
+        axs[0].legend(loc=1,fancybox=True)
+
+        # plot cross_p3d (get cross-power and errorbars)
+        ratio_X=-data_X['p3d_hMpc']/P_L_X
+        error_X=measured_power.get_cross_error(data_F,data_X,data_H)/P_L_X
+        for i in range(0,n_mu,downsample):
+            col=cm(i/n_mu)
+            k_mu=data_X['k_hMpc'][keep[:,i],i]
+            high=(ratio_X+error_X)[keep[:,i],i]
+            low=(ratio_X-error_X)[keep[:,i],i]
+            label=r"%.2f $\leq \mu \leq$ %.2f" % (mu_edges[i],mu_edges[i+1])
+            axs[1].fill_between(k_mu,high,low,alpha=.3,label=label,color=col)
+            axs[1].plot(k_mu,high,lw=3,alpha=.1,color=col)
+            axs[1].plot(k_mu,low,lw=3,alpha=.1,color=col)
+
+        axs[1].set_ylabel(ylabel=r"$-P_X(k,\mu) / P_L(k)$")
+        axs[1].set_xlabel(r"$k \, [h/Mpc]$")
+        axs[1].set_xscale("log")
+        axs[1].set_xlim([0.03,20])
+        axs[1].legend(loc=1,fancybox=True)
+
+        fig.tight_layout()
+    return fig
+
+
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    # specify simulation from Sherwood suite
+    L_hMpc=160
+    n_part=2048
+    sim = she_sim.SherwoodSimulation(L_hMpc=L_hMpc,n_part=n_part)
+
+    # specify grid of skewers
+    snapshot_num=9
+    n_xy=1024
+    n_z=2048
+    z=she_sim.redshift_from_snapshot(snapshot_num)
+    # combined measurement
+    axis=0
+    skewers=she_sim.Grid(simulation=sim,snapshot_num=snapshot_num,
+                                n_xy=n_xy,n_z=n_z,axis=axis)
+
+    # mass bin
+    all_mass=True
+    if all_mass:
+        logMh_min=None
+        logMh_max=None
+    else:
+        logMh_min=11.5
+        logMh_max=14.0
+    halos=she_sim.HaloGrid(simulation=sim,snapshot_num=snapshot_num,
+                          logMh_min=logMh_min,logMh_max=logMh_max,
+                          n_xy=n_xy,n_z=n_z,axis=axis,add_rsd=True)
+
+    # get P3D measurements (standard binning)
+    data_F=measured_power.get_power_from_grid(grid=skewers,
+                power_type="flux_p3d")
+    data_X=measured_power.get_power_from_grid(grid=halos,power_type="cross_p3d")
+    data_H=measured_power.get_power_from_grid(grid=halos,power_type="halo_p3d")
+
+    # linear matter power (on the full (k,mu) grid of each measurement)
+    P_L_F,P_L_X=get_linear_power(data_F,data_X)
+
+    fig=plt.figure(figsize=FIGSIZE)
+    render_ratio(fig,data_F,data_X,data_H,P_L_F,P_L_X)
+    plt.savefig('flux_cross_z{}.png'.format(z))
+    plt.show()
+    plt.close()
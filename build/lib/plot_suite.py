@@ -0,0 +1,154 @@
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import measured_power
+import power_catalog
+import likelihood_p3d
+import fit_suite
+import plot_data
+import plot_ratio
+
+# figures made for each configuration: (module rendering it, file prefix)
+FIGURES={'measured_p3d':(plot_data,'measured_p3d'),
+            'ratio':(plot_ratio,'flux_cross')}
+
+# figures kept by each worker process, cleared and reused for each plot
+_figures={}
+
+
+def get_configs(data_dir=None):
+    """List of HaloGrid objects with flux, cross and halo measurements"""
+
+    catalog=power_catalog.PowerCatalog(data_dir=data_dir,
+                power_types=likelihood_p3d.P3D_TYPES)
+    return fit_suite.get_suite_configs(catalog)
+
+
+def get_output_fnames(halos,out_dir):
+    """Dictionary with output file for each figure of a configuration"""
+
+    return {kind:os.path.join(out_dir,'{}_{}.png'.format(prefix,
+                halos.get_nametag())) for kind,(module,prefix) in FIGURES.items()}
+
+
+def get_input_fnames(halos):
+    """Files that the figures of a configuration depend on (including the
+        code making them)"""
+
+    skewers=likelihood_p3d.get_skewers_from_halos(halos)
+    fnames=[measured_power.get_power_fname(skewers,'flux_p3d'),
+            measured_power.get_power_fname(halos,'cross_p3d'),
+            measured_power.get_power_fname(halos,'halo_p3d'),
+            '{}/data/linear_pk/lin_{}.dat'.format(
+                measured_power.get_repo_dir(),halos.snapshot_num)]
+    fnames+=[module.__file__ for module,prefix in FIGURES.values()]
+    return fnames
+
+
+def is_up_to_date(out_fname,in_fnames):
+    """Whether output exists and is newer than all inputs"""
+
+    if not os.path.exists(out_fname):
+        return False
+    mtime=os.path.getmtime(out_fname)
+    return all(os.path.getmtime(fname)<=mtime for fname in in_fnames)
+
+
+def load_config(halos):
+    """Load all data needed by the figures of a configuration (once)"""
+
+    skewers=likelihood_p3d.get_skewers_from_halos(halos)
+    data={'data_F':measured_power.get_power_from_grid(skewers,'flux_p3d'),
+            'data_X':measured_power.get_power_from_grid(halos,'cross_p3d'),
+            'data_H':measured_power.get_power_from_grid(halos,'halo_p3d')}
+    data['P_L_F'],data['P_L_X']=plot_ratio.get_linear_power(data['data_F'],
+                data['data_X'])
+    return data
+
+
+def get_pyplot():
+    """Import pyplot when the first figure is made (not when the module is
+        imported), to render without a display, also in worker processes"""
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def get_figure(kind):
+    """Figure of a given kind, created only once per process"""
+
+    if kind not in _figures:
+        module,prefix=FIGURES[kind]
+        _figures[kind]=get_pyplot().figure(figsize=module.FIGSIZE)
+    return _figures[kind]
+
+
+def render_config(halos,out_fnames):
+    """Render figures of a configuration, for the outputs in out_fnames
+        (dictionary indexed by kind of figure)"""
+
+    data=load_config(halos)
+    for kind,fname in out_fnames.items():
+        fig=get_figure(kind)
+        if kind=='measured_p3d':
+            plot_data.render_measured_p3d(fig,data['data_F'],data['data_X'],
+                        data['data_H'])
+        else:
+            plot_ratio.render_ratio(fig,data['data_F'],data['data_X'],
+                        data['data_H'],data['P_L_F'],data['P_L_X'])
+        # write to temporary file, so outputs are never incomplete
+        tmp_fname=fname+'.tmp.png'
+        fig.savefig(tmp_fname)
+        os.replace(tmp_fname,fname)
+    return list(out_fnames.values())
+
+
+def plot_suite(out_dir='figures',workers=None,force=False,data_dir=None):
+    """Render figures for all configurations, in parallel processes.
+        Outputs newer than their inputs are not rendered again, unless
+        force is set. Returns list of files written."""
+
+    os.makedirs(out_dir,exist_ok=True)
+    todo=[]
+    for halos in get_configs(data_dir):
+        in_fnames=get_input_fnames(halos)
+        out_fnames={kind:fname for kind,fname in
+                    get_output_fnames(halos,out_dir).items()
+                    if force or not is_up_to_date(fname,in_fnames)}
+        if out_fnames:
+            todo.append((halos,out_fnames))
+    print('{} configurations to render'.format(len(todo)))
+    if not todo:
+        return []
+
+    written=[]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures={pool.submit(render_config,halos,out_fnames):halos
+                    for halos,out_fnames in todo}
+        for future in as_completed(futures):
+            try:
+                written+=future.result()
+            except Exception as err:
+                print('failed',futures[future].get_nametag(),err)
+    return written
+
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(
+                description='Render figures for all configurations')
+    parser.add_argument('--out-dir',default='figures')
+    parser.add_argument('--workers',type=int,default=None,
+                help='number of processes (default: number of CPUs)')
+    parser.add_argument('--force',action='store_true',
+                help='render all figures, even if they are up to date')
+    parser.add_argument('--data-dir',default=None)
+    args=parser.parse_args()
+
+    t0=time.perf_counter()
+    written=plot_suite(out_dir=args.out_dir,workers=args.workers,
+                force=args.force,data_dir=args.data_dir)
+    print('wrote {} figures in {:.1f} s'.format(len(written),
+                time.perf_counter()-t0))
@@ -0,0 +1,134 @@
+import os
+import measured_power
+
+# fields of the index key, after the power type
+KEY_FIELDS=['L_hMpc','n_part','snapshot_num','axis','n_xy','n_z',
+            'logMh_min','logMh_max','add_rsd']
+
+
+def get_power_key(grid,power_type):
+    """Tuple identifying a measurement, used as key in the catalog index.
+        Flux grids have no mass bin or RSD flag (stored as None)."""
+
+    if "flux" in power_type:
+        logMh_min=None
+        logMh_max=None
+        add_rsd=None
+    else:
+        logMh_min=grid.logMh_min
+        logMh_max=grid.logMh_max
+        add_rsd=grid.add_rsd
+
+    return (power_type,grid.sim.L_hMpc,grid.sim.n_part,grid.snapshot_num,
+            grid.axis,grid.n_xy,grid.n_z,logMh_min,logMh_max,add_rsd)
+
+
+def _match(value,criterion):
+    """Check whether a key field satisfies a selection criterion:
+        - (min,max) tuple: inclusive range, None for open-ended
+        - callable: returns True for values to keep
+        - anything else: equality"""
+
+    if isinstance(criterion,tuple):
+        if value is None:
+            return False
+        vmin,vmax=criterion
+        if vmin is not None and value < vmin: return False
+        if vmax is not None and value > vmax: return False
+        return True
+    elif callable(criterion):
+        return criterion(value)
+    else:
+        return value == criterion
+
+
+class PowerCatalog(object):
+    """In-memory catalog of all measurements under data/. Inputs:
+      - data_dir: folder with the FITS files (default: $SHERWOOD/data)
+      - power_types: list of power types to load (default: all of them)
+    All files are read once when the catalog is set up, and lookups or
+    selections never touch the filesystem again. Power dictionaries are
+    shared between calls, so they should not be modified by the caller."""
+
+    def __init__(self,data_dir=None,power_types=None):
+
+        if data_dir is None:
+            data_dir=measured_power.get_repo_dir()+'/data/'
+        if power_types is None:
+            power_types=measured_power.ALL_POWER_TYPES
+
+        self.data_dir=data_dir
+        self.power_types=power_types
+
+        # index mapping key tuples to power dictionaries
+        self.index={}
+        # filename where each entry was read from
+        self.fnames={}
+
+        for power_type in power_types:
+            type_dir=os.path.join(data_dir,power_type)
+            for fname in sorted(os.listdir(type_dir)):
+                if not fname.endswith('.fits'): continue
+                fname=os.path.join(type_dir,fname)
+                power=measured_power.read_fits_power(fname,power_type)
+                key=get_power_key(power['grid'],power_type)
+                assert key not in self.index,'duplicated entry '+fname
+                self.index[key]=power
+                self.fnames[key]=fname
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def __contains__(self,key):
+        return key in self.index
+
+
+    def keys(self):
+        """List of keys in the index"""
+
+        return list(self.index.keys())
+
+
+    def get_power(self,grid,power_type):
+        """Return measured power spectrum corresponding to input grid"""
+
+        key=get_power_key(grid,power_type)
+        if key not in self.index:
+            raise KeyError('no measurement in catalog',key)
+
+        return self.index[key]
+
+
+    def get_many(self,grids,power_type):
+        """Return list of measured power spectra for a list of grids"""
+
+        return [self.get_power(grid,power_type) for grid in grids]
+
+
+    def select_keys(self,power_type=None,**criteria):
+        """Return (sorted) keys of entries satisfying all criteria. Each
+            criterion refers to a key field (e.g. n_xy=(512,None) means
+            n_xy>=512, snapshot_num=9 means equality)."""
+
+        for field in criteria:
+            assert field in KEY_FIELDS,'unknown key field '+field
+
+        keys=[]
+        for key in self.index:
+            if power_type is not None and key[0]!=power_type: continue
+            fields=dict(zip(KEY_FIELDS,key[1:]))
+            if all(_match(fields[f],c) for f,c in criteria.items()):
+                keys.append(key)
+
+        # sort using the string representation, since some fields are None
+        return sorted(keys,key=str)
+
+
+    def select(self,power_type=None,**criteria):
+        """Return list of power dictionaries satisfying all criteria.
+            See select_keys for the format of the criteria."""
+
+        return [self.index[key] for key in self.select_keys(power_type,
+                                                            **criteria)]
@@ -0,0 +1,187 @@
+import time
+import numpy as np
+import measured_power
+import power_catalog
+
+# P1D is the integral of P3D over the transverse wavenumbers,
+#   P1D(kp) = 1/(2 pi) int_kp^k_max dk k P3D(k,mu=kp/k)
+# computed with Gauss-Legendre quadrature in ln(k). Quadrature nodes, and
+# the matrices that project (k,mu) grids, are computed once per grid.
+# Wavenumbers below k_min_hMpc (for kp=0) do not contribute.
+K_MIN_HMPC=1.e-4
+
+# quadrature rules and projection matrices already computed
+_quadratures={}
+_matrices={}
+
+
+def get_quadrature(kp_hMpc,k_max_hMpc,n_quad=256,k_min_hMpc=K_MIN_HMPC):
+    """Nodes and weights to integrate P3D for each kp, cached for each grid
+        and returned as read-only. Rows with kp>=k_max have zero weights.
+        Returns (k_hMpc,mu,weights), all with shape (n_kp,n_quad)."""
+
+    kp_hMpc=np.asarray(kp_hMpc,dtype=float)
+    key=(kp_hMpc.tobytes(),float(k_max_hMpc),n_quad,float(k_min_hMpc))
+    if key not in _quadratures:
+        x,w=np.polynomial.legendre.leggauss(n_quad)
+        lnk_min=np.log(np.clip(kp_hMpc,k_min_hMpc,k_max_hMpc))
+        half=0.5*(np.log(k_max_hMpc)-lnk_min)[:,np.newaxis]
+        lnk=lnk_min[:,np.newaxis]+half*(x+1)
+        k_hMpc=np.exp(lnk)
+        mu=np.clip(kp_hMpc[:,np.newaxis]/k_hMpc,0.0,1.0)
+        # dk k = dlnk k^2
+        weights=half*w*k_hMpc**2/(2*np.pi)
+        for array in [k_hMpc,mu,weights]:
+            array.flags.writeable=False
+        _quadratures[key]=(k_hMpc,mu,weights)
+    return _quadratures[key]
+
+
+def _get_interp_weights(nodes,x):
+    """Left node and weight for linear interpolation (constant outside)"""
+
+    if len(nodes)==1:
+        return np.zeros(x.shape,dtype=int),np.zeros(x.shape)
+    i=np.clip(np.searchsorted(nodes,x,side='right')-1,0,len(nodes)-2)
+    w=np.clip((x-nodes[i])/(nodes[i+1]-nodes[i]),0.0,1.0)
+    return i,w
+
+
+def get_projection_matrix(kp_hMpc,k_nodes,mu_nodes,k_max_hMpc=None,
+            n_quad=256):
+    """Dense (n_kp,n_k*n_mu) matrix projecting P3D tabulated on (k,mu)
+        nodes (flattened as k*n_mu+mu) onto P1D at kp, interpolating P3D
+        linearly in (ln k,mu) between nodes. Outside of the nodes P3D is
+        constant, and it vanishes above k_max (default: last k node).
+        Cached for each grid, and returned as read-only."""
+
+    kp_hMpc=np.asarray(kp_hMpc,dtype=float)
+    k_nodes=np.asarray(k_nodes,dtype=float)
+    mu_nodes=np.asarray(mu_nodes,dtype=float)
+    if k_max_hMpc is None:
+        k_max_hMpc=k_nodes[-1]
+    key=(kp_hMpc.tobytes(),k_nodes.tobytes(),mu_nodes.tobytes(),
+                float(k_max_hMpc),n_quad)
+    if key not in _matrices:
+        k,mu,weights=get_quadrature(kp_hMpc,k_max_hMpc,n_quad)
+        ik,wk=_get_interp_weights(np.log(k_nodes),np.log(k))
+        imu,wmu=_get_interp_weights(mu_nodes,mu)
+        n_mu=len(mu_nodes)
+        rows=np.broadcast_to(np.arange(len(kp_hMpc))[:,np.newaxis],k.shape)
+        matrix=np.zeros([len(kp_hMpc),len(k_nodes)*n_mu])
+        # add quadrature weights to the 4 corners of each (k,mu) cell
+        for dk,fk in [(0,1-wk),(1,wk)]:
+            for dmu,fmu in [(0,1-wmu),(1,wmu)]:
+                column=(np.minimum(ik+dk,len(k_nodes)-1)*n_mu
+                            +np.minimum(imu+dmu,n_mu-1))
+                np.add.at(matrix,(rows,column),weights*fk*fmu)
+        matrix.flags.writeable=False
+        _matrices[key]=matrix
+    return _matrices[key]
+
+
+def project_grid(p3d,kp_hMpc,k_nodes,mu_nodes,k_max_hMpc=None,n_quad=256):
+    """P1D at kp for P3D tabulated on (k,mu) nodes, with shape
+        (...,n_k,n_mu) for a batch of models. Uses a single matrix product
+        for all of them. Returns array (...,n_kp), NaN for kp>=k_max."""
+
+    p3d=np.asarray(p3d,dtype=float)
+    n_k,n_mu=len(k_nodes),len(mu_nodes)
+    assert p3d.shape[-2:]==(n_k,n_mu),'inconsistent grid'
+    matrix=get_projection_matrix(kp_hMpc,k_nodes,mu_nodes,k_max_hMpc,n_quad)
+    p1d=p3d.reshape(-1,n_k*n_mu)@matrix.T
+    p1d=p1d.reshape(p3d.shape[:-2]+(len(kp_hMpc),))
+    if k_max_hMpc is None:
+        k_max_hMpc=k_nodes[-1]
+    return np.where(np.asarray(kp_hMpc)<k_max_hMpc,p1d,np.nan)
+
+
+def project_model(model,kp_hMpc,k_max_hMpc,n_quad=256):
+    """P1D at kp for a P3D model, a function of (k_hMpc,mu) arrays with
+        shape (n_kp,n_quad) returning arrays (...,n_kp,n_quad), for example
+        for a batch of parameters. The model is evaluated once on all
+        quadrature nodes. Returns array (...,n_kp), NaN for kp>=k_max."""
+
+    k,mu,weights=get_quadrature(kp_hMpc,k_max_hMpc,n_quad)
+    p1d=np.einsum('...ij,ij->...i',model(k,mu),weights)
+    return np.where(np.asarray(kp_hMpc)<k_max_hMpc,p1d,np.nan)
+
+
+def get_measured_grid(powers):
+    """Tabulate P3D measurements with the same binning on common nodes:
+        k bins valid in all of them (at the count-weighted mean of ln k
+        over measurements) and centers of mu wedges (equally spaced in
+        0<mu<1). Empty mu bins are filled by interpolation in mu.
+        Returns (k_nodes,mu_nodes,p3d) with p3d (n_powers,n_k,n_mu)."""
+
+    masks=np.stack([measured_power.get_valid_mask(power)&(power['counts']>0)
+                for power in powers])
+    values=np.stack([power['p3d_hMpc'] for power in powers])
+    n_mu=values.shape[2]
+    mu_nodes=(np.arange(n_mu)+0.5)/n_mu
+    rows=np.all(np.any(masks,axis=2),axis=0)
+    p3d=np.where(masks,values,np.nan)[:,rows]
+    for i in range(p3d.shape[0]):
+        for j in range(p3d.shape[1]):
+            ok=np.isfinite(p3d[i,j])
+            p3d[i,j]=np.interp(mu_nodes,mu_nodes[ok],p3d[i,j,ok])
+
+    weights=np.where(masks,np.stack([power['counts'] for power in powers]),0)
+    lnk=np.log(np.nan_to_num(np.stack([power['k_hMpc'] for power in powers]),
+                nan=1.0))
+    lnk_nodes=np.sum((weights*lnk)[:,rows],axis=(0,2))/np.sum(
+                weights[:,rows],axis=(0,2))
+    return np.exp(lnk_nodes),mu_nodes,p3d
+
+
+def project_power_many(powers,kp_hMpc,k_max_hMpc=None,n_quad=256):
+    """P1D at kp for a list of P3D measurements with the same binning
+        (see get_measured_grid), using a single matrix product. By default
+        P3D vanishes above the last valid k bin.
+        Returns array (n_powers,n_kp)."""
+
+    k_nodes,mu_nodes,p3d=get_measured_grid(powers)
+    return project_grid(p3d,kp_hMpc,k_nodes,mu_nodes,k_max_hMpc,n_quad)
+
+
+def compare_p1d(skewers,catalog=None,n_quad=256):
+    """Project flux P3D measured in a grid of skewers, and compare it with
+        the flux P1D measured in the same skewers. Returns dictionary with
+        kp_hMpc, p1d_hMpc (measured), p1d_proj_hMpc and ratio."""
+
+    if catalog is None:
+        p1d=measured_power.get_power_from_grid(skewers,'flux_p1d')
+        p3d=measured_power.get_power_from_grid(skewers,'flux_p3d')
+    else:
+        p1d=catalog.get_power(skewers,'flux_p1d')
+        p3d=catalog.get_power(skewers,'flux_p3d')
+    kp_hMpc=p1d['kp_hMpc']
+    proj=project_power_many([p3d],kp_hMpc,n_quad=n_quad)[0]
+    return {'grid':skewers,'kp_hMpc':kp_hMpc,'p1d_hMpc':p1d['p1d_hMpc'],
+            'p1d_proj_hMpc':proj,'ratio':proj/p1d['p1d_hMpc']}
+
+
+if __name__ == '__main__':
+    catalog=power_catalog.PowerCatalog(power_types=['flux_p1d','flux_p3d'])
+    print('projected / measured flux P1D, at kp [h/Mpc]:')
+    kp_print=[0.1,0.5,1.0,2.0,5.0]
+    for key in catalog.select_keys('flux_p1d'):
+        skewers=catalog.index[key]['grid']
+        if power_catalog.get_power_key(skewers,'flux_p3d') not in catalog.index:
+            continue
+        comparison=compare_p1d(skewers,catalog=catalog)
+        kp=comparison['kp_hMpc']
+        ratio=[np.interp(k,kp,comparison['ratio']) for k in kp_print]
+        print('  {:24s}'.format(skewers.get_nametag()),
+                ' '.join('{:.3f}'.format(r) for r in ratio))
+
+    # time projections of a batch of models on a measured grid
+    power=catalog.index[catalog.select_keys('flux_p3d')[0]]
+    kp=catalog.get_power(power['grid'],'flux_p1d')['kp_hMpc']
+    k_nodes,mu_nodes,p3d=get_measured_grid([power])
+    models=p3d*np.random.default_rng(0).uniform(0.5,2,(1000,1,1))
+    project_grid(models[:1],kp,k_nodes,mu_nodes)
+    t0=time.perf_counter()
+    project_grid(models,kp,k_nodes,mu_nodes)
+    print('projected {} models in {:.2f} ms'.format(len(models),
+                1e3*(time.perf_counter()-t0)))
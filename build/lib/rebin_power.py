@@ -0,0 +1,195 @@
+import numpy as np
+import measured_power
+
+# P3D arrays rebinned, and combined with count-weighted means
+REBIN_KEYS=['k_hMpc','mu','p3d_hMpc']
+
+# rebinning matrices already computed, indexed by binning scheme
+_matrices={}
+
+
+def get_groups(n_bins,groups=1):
+    """Coarse bin of each of the n_bins fine bins, as an array of indices.
+        - groups: number of consecutive fine bins to merge (int), or array
+          with the coarse bin of each fine bin (-1 to drop a fine bin)"""
+
+    if np.ndim(groups)==0:
+        return np.arange(n_bins)//int(groups)
+    groups=np.asarray(groups,dtype=int)
+    assert groups.shape==(n_bins,),'need one group per bin'
+    return groups
+
+
+def get_rebin_matrix(n_k,n_mu,k_groups=1,mu_groups=1):
+    """Dense (n_coarse,n_fine) matrix with ones where a fine bin (k,mu),
+        flattened as k*n_mu+mu, contributes to a coarse bin. Cached for
+        each binning scheme, and returned as read-only.
+        Returns (matrix,(n_k_coarse,n_mu_coarse))."""
+
+    k_groups=get_groups(n_k,k_groups)
+    mu_groups=get_groups(n_mu,mu_groups)
+    key=(n_k,n_mu,k_groups.tobytes(),mu_groups.tobytes())
+    if key not in _matrices:
+        n_kc=k_groups.max()+1
+        n_muc=mu_groups.max()+1
+        # coarse bin of each fine bin (or -1 if dropped)
+        coarse=k_groups[:,np.newaxis]*n_muc+mu_groups[np.newaxis,:]
+        coarse[k_groups<0,:]=-1
+        coarse[:,mu_groups<0]=-1
+        coarse=coarse.ravel()
+        matrix=np.zeros([n_kc*n_muc,n_k*n_mu])
+        use=(coarse>=0)
+        matrix[coarse[use],np.nonzero(use)[0]]=1.0
+        matrix.flags.writeable=False
+        _matrices[key]=(matrix,(n_kc,n_muc))
+    return _matrices[key]
+
+
+def _get_weights(power):
+    """Number of modes in valid bins (zero elsewhere), as (n_k,n_mu)"""
+
+    mask=measured_power.get_valid_mask(power)
+    counts=np.where(mask,power['counts'],0.0)
+    return counts.reshape(counts.shape[0],-1)
+
+
+def _stack_inputs(powers,columns):
+    """Array (n_columns,n_powers,n_fine) with counts times each column
+        (columns are functions of the power dictionary), zero in invalid
+        bins. Also returns the (n_powers,n_fine) weights."""
+
+    weights=np.stack([_get_weights(power).ravel() for power in powers])
+    inputs=np.empty((len(columns),)+weights.shape)
+    for i,column in enumerate(columns):
+        values=np.stack([np.reshape(column(power),-1) for power in powers])
+        # NaN in empty bins would propagate through the product
+        inputs[i]=np.where(weights>0,weights*values,0.0)
+    return inputs,weights
+
+
+def rebin_many(powers,k_groups=1,mu_groups=1):
+    """Rebin a list of P3D measurements (all with the same binning),
+        combining bins with count-weighted means of k, mu and P, and
+        adding the counts. Uses a single matrix product for all of them.
+        Returns list of power dictionaries with the new binning."""
+
+    powers=list(powers)
+    n_k=powers[0]['k_hMpc'].shape[0]
+    n_mu=powers[0]['k_hMpc'].size//n_k
+    for power in powers:
+        assert power['k_hMpc'].size==n_k*n_mu,'inconsistent binning'
+    matrix,shape=get_rebin_matrix(n_k,n_mu,k_groups,mu_groups)
+
+    columns=[lambda power,key=key:power[key] for key in REBIN_KEYS]
+    inputs,weights=_stack_inputs(powers,columns)
+    # counts and weighted sums, for all measurements at once
+    stacked=np.concatenate([weights[np.newaxis],inputs])
+    sums=stacked.reshape(-1,n_k*n_mu)@matrix.T
+    sums=sums.reshape((len(REBIN_KEYS)+1,len(powers))+shape)
+    counts=sums[0]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        means=sums[1:]/counts
+
+    rebinned=[]
+    for i,power in enumerate(powers):
+        new=dict(power)
+        for j,key in enumerate(REBIN_KEYS):
+            new[key]=means[j,i]
+        new['counts']=counts[i]
+        new['n_k_bins']=shape[0]
+        new['n_mu_bins']=shape[1]
+        rebinned.append(new)
+    return rebinned
+
+
+def rebin_power(power,k_groups=1,mu_groups=1):
+    """Rebin a single P3D measurement (see rebin_many)"""
+
+    return rebin_many([power],k_groups=k_groups,mu_groups=mu_groups)[0]
+
+
+def get_legendre_wedge_average(ell,mu_edges):
+    """Average of Legendre polynomial of order ell (0, 2 or 4) in each mu
+        wedge, computed exactly from its integral"""
+
+    if ell==0:
+        integral=lambda mu:mu
+    elif ell==2:
+        integral=lambda mu:0.5*(mu**3-mu)
+    elif ell==4:
+        integral=lambda mu:(7*mu**5-10*mu**3+3*mu)/8
+    else:
+        raise ValueError('unsupported multipole',ell)
+    mu_edges=np.asarray(mu_edges,dtype=float)
+    return np.diff(integral(mu_edges))/np.diff(mu_edges)
+
+
+def get_multipole_matrix(n_k,n_mu,ells=(0,2,4),k_groups=1):
+    """Dense matrix projecting (n_k,n_mu) wedges, flattened, onto k groups
+        (first block of rows) and onto each multipole (one block of rows
+        per ell). Wedges are equally spaced in 0<mu<1. Cached for each
+        scheme, and returned as read-only.
+        Returns (matrix,n_k_coarse)."""
+
+    k_groups=get_groups(n_k,k_groups)
+    key=('multipoles',n_k,n_mu,tuple(ells),k_groups.tobytes())
+    if key not in _matrices:
+        # all wedges of a k bin (group) are combined
+        sums,(n_kc,n_muc)=get_rebin_matrix(n_k,n_mu,k_groups,
+                        mu_groups=np.zeros(n_mu,dtype=int))
+        mu_edges=np.linspace(0.0,1.0,n_mu+1)
+        blocks=[sums]
+        for ell in ells:
+            L=get_legendre_wedge_average(ell,mu_edges)
+            # same mu wedges in every k bin of the flattened array
+            blocks.append(sums*(2*ell+1)*np.tile(L,n_k))
+        matrix=np.concatenate(blocks)
+        matrix.flags.writeable=False
+        _matrices[key]=(matrix,n_kc)
+    return _matrices[key]
+
+
+def get_multipoles_many(powers,ells=(0,2,4),k_groups=1):
+    """Legendre multipoles of a list of P3D measurements, from their mu
+        wedges, as a sum over modes:
+            P_ell(k) = (2 ell+1) sum_j N_j P_j <L_ell>_j / sum_j N_j
+        where j runs over valid wedges (and k bins in the same k group),
+        N_j are the counts and <L_ell>_j the average of the Legendre
+        polynomial in each wedge. Uses a single matrix product for all
+        measurements. Returns list of dictionaries with power_type, grid,
+        k_hMpc (count-weighted mean), counts, and p{ell}_hMpc for each
+        ell."""
+
+    powers=list(powers)
+    n_k=powers[0]['k_hMpc'].shape[0]
+    n_mu=powers[0]['k_hMpc'].size//n_k
+    for power in powers:
+        assert power['k_hMpc'].size==n_k*n_mu,'inconsistent binning'
+    matrix,n_kc=get_multipole_matrix(n_k,n_mu,ells,k_groups)
+
+    columns=[lambda power:power['k_hMpc'],lambda power:power['p3d_hMpc']]
+    inputs,weights=_stack_inputs(powers,columns)
+    stacked=np.concatenate([weights[np.newaxis],inputs])
+    sums=stacked.reshape(-1,n_k*n_mu)@matrix.T
+    sums=sums.reshape(3,len(powers),len(ells)+1,n_kc)
+    # counts and k are summed with the first block, P with the others
+    counts=sums[0,:,0]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        k_hMpc=sums[1,:,0]/counts
+        poles=sums[2,:,1:]/counts[:,np.newaxis]
+
+    multipoles=[]
+    for i,power in enumerate(powers):
+        multipole={'power_type':power['power_type'],'grid':power['grid'],
+                    'k_hMpc':k_hMpc[i],'counts':counts[i]}
+        for j,ell in enumerate(ells):
+            multipole['p{}_hMpc'.format(ell)]=poles[i,j]
+        multipoles.append(multipole)
+    return multipoles
+
+
+def get_multipoles(power,ells=(0,2,4),k_groups=1):
+    """Legendre multipoles of a single P3D measurement (see
+        get_multipoles_many)"""
+
+    return get_multipoles_many([power],ells=ells,k_groups=k_groups)[0]
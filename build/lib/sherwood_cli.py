@@ -0,0 +1,151 @@
+import os
+import sys
+import argparse
+
+# Command line interface (installed as sherwood-p3d). Library modules are
+# only imported by the subcommand that needs them, so that the startup of
+# short jobs does not pay for numpy, fitsio or matplotlib (see
+# bench_import.py).
+POWER_TYPES=['flux_p1d','flux_p3d','halo_p3d','cross_p3d']
+
+
+def list_files(data_dir,power_types=POWER_TYPES):
+    """List of (power_type,fname) for all FITS files in data_dir"""
+
+    files=[]
+    for power_type in power_types:
+        type_dir=os.path.join(data_dir,power_type)
+        if not os.path.isdir(type_dir): continue
+        for fname in sorted(os.listdir(type_dir)):
+            if fname.endswith('.fits'):
+                files.append((power_type,os.path.join(type_dir,fname)))
+    return files
+
+
+def get_data_dir(args):
+    import measured_power
+    if args.data_dir is not None:
+        return args.data_dir
+    return os.path.join(measured_power.get_repo_dir(),'data')
+
+
+def find_file(data_dir,power_type,nametag):
+    """FITS file of a measurement, from power type and grid nametag"""
+
+    import measured_power
+    for pt,fname in list_files(data_dir,[power_type]):
+        power=measured_power.read_fits_power(fname,pt,lazy=True)
+        if power['grid'].get_nametag()==nametag:
+            return fname
+    raise KeyError('no measurement',power_type,nametag)
+
+
+def cmd_list(args):
+    """Print power type, grid nametag and redshift of each measurement
+        (only headers are read)"""
+
+    import measured_power
+    power_types=args.power_type or POWER_TYPES
+    for power_type,fname in list_files(get_data_dir(args),power_types):
+        grid=measured_power.read_fits_power(fname,power_type,lazy=True)['grid']
+        if args.snapshot is not None and grid.snapshot_num!=args.snapshot:
+            continue
+        print('{:10s} {:40s} z={}'.format(power_type,grid.get_nametag(),
+                    grid.get_z()))
+    return 0
+
+
+def cmd_show(args):
+    """Print metadata and column shapes of a measurement, given its file or
+        its power type and grid nametag"""
+
+    import numpy as np
+    import measured_power
+    if len(args.target)==1:
+        fname=args.target[0]
+        power_type=os.path.basename(os.path.dirname(os.path.abspath(fname)))
+    elif len(args.target)==2:
+        power_type,nametag=args.target
+        fname=find_file(get_data_dir(args),power_type,nametag)
+    else:
+        print('show takes a file, or a power type and a nametag')
+        return 2
+    if power_type not in POWER_TYPES:
+        print('unknown power type',power_type)
+        return 2
+
+    with measured_power.read_fits_power(fname,power_type,lazy=True) as power:
+        print('file:',fname)
+        for key,value in power.metadata.items():
+            print('  {}: {}'.format(key,value))
+        print('  z: {}'.format(power['grid'].get_z()))
+        for key in power.columns:
+            array=power[key]
+            print('  {}: shape {}, {} finite'.format(key,array.shape,
+                        np.sum(np.isfinite(array))))
+    return 0
+
+
+def cmd_export(args):
+    """Export all measurements to a long-format table"""
+
+    import export_power
+    export_power.export_suite(args.path,fmt=args.format,
+                data_dir=args.data_dir,chunk_rows=args.chunk_rows)
+    print('exported suite to',args.path)
+    return 0
+
+
+def cmd_plot(args):
+    """Render figures for all configurations (see plot_suite.py)"""
+
+    import plot_suite
+    written=plot_suite.plot_suite(out_dir=args.out_dir,workers=args.workers,
+                force=args.force,data_dir=args.data_dir)
+    print('wrote {} figures'.format(len(written)))
+    return 0
+
+
+def get_parser():
+    parser=argparse.ArgumentParser(prog='sherwood-p3d',
+                description='Power spectra measured in the Sherwood suite')
+    parser.add_argument('--repo-dir',default=None,
+                help='copy of the repository (default: $SHERWOOD)')
+    parser.add_argument('--data-dir',default=None,
+                help='folder with FITS files (default: REPO_DIR/data)')
+    subparsers=parser.add_subparsers(dest='command',required=True)
+
+    sub=subparsers.add_parser('list',help='list measurements')
+    sub.add_argument('--power-type',action='append',choices=POWER_TYPES,
+                help='only this power type (can be repeated)')
+    sub.add_argument('--snapshot',type=int,default=None)
+    sub.set_defaults(func=cmd_list)
+
+    sub=subparsers.add_parser('show',help='show metadata of a measurement')
+    sub.add_argument('target',nargs='+',
+                help='FITS file, or power type and grid nametag')
+    sub.set_defaults(func=cmd_show)
+
+    sub=subparsers.add_parser('export',help='export suite to a table')
+    sub.add_argument('path')
+    sub.add_argument('--format',default=None,choices=['parquet','npz','csv'])
+    sub.add_argument('--chunk-rows',type=int,default=65536)
+    sub.set_defaults(func=cmd_export)
+
+    sub=subparsers.add_parser('plot',help='render figures for all configs')
+    sub.add_argument('--out-dir',default='figures')
+    sub.add_argument('--workers',type=int,default=None)
+    sub.add_argument('--force',action='store_true')
+    sub.set_defaults(func=cmd_plot)
+    return parser
+
+
+def main(argv=None):
+    args=get_parser().parse_args(argv)
+    if args.repo_dir is not None:
+        os.environ['SHERWOOD']=os.path.abspath(args.repo_dir)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
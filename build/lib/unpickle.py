@@ -0,0 +1,223 @@
+import os
+import json
+import pickle
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import fitsio
+import measured_power
+
+
+class PickledObject(object):
+    """Plain container for objects in pickled measurements. The pickles
+        were written by the measurement pipeline (measured_p3d, halo_grid,
+        etc.), that is not needed to read their attributes."""
+    pass
+
+
+class MeasurementUnpickler(pickle.Unpickler):
+    """Unpickler that only trusts numpy, and maps any other class to a
+        PickledObject with the same attributes"""
+
+    def find_class(self,module,name):
+        if module.split('.')[0]=='numpy':
+            return super().find_class(module,name)
+        return PickledObject
+
+
+def read_pickle(pickle_fname):
+    """Read pickled measurement, without the measurement pipeline"""
+
+    with open(pickle_fname,'rb') as f:
+        return MeasurementUnpickler(f).load()
+
+
+def get_fits_content(data,power_type):
+    """Header keywords and columns to write to FITS, from pickled data"""
+
+    # main simulation grid (renamed for cross)
+    if power_type == "cross_p3d":
+        grid=data.halos
+    else:
+        grid=data.grid
+
+    # sim metadata
+    metadata={'L_HMPC':grid.sim.L_hMpc}
+    metadata['N_PART']=grid.sim.n_part
+
+    # grid metadata
+    metadata['SNAPSHOT_NUM']=grid.snapshot_num
+    metadata['N_XY']=grid.n_xy
+    metadata['N_Z']=grid.n_z
+    metadata['AXIS']=grid.axis
+    if "flux" not in power_type:
+        metadata['ADD_RSD']=grid.add_rsd
+        metadata['LOGMH_MIN']=grid.logMh_min
+        metadata['LOGMH_MAX']=grid.logMh_max
+        metadata['SHOT_NOISE']=data.shot_noise
+    if power_type != "halo_p3d":
+        metadata['MEAN_FLUX']=data.mean_flux
+
+    # power metadata
+    if power_type != "flux_p1d":
+        metadata['N_K_BINS']=data.n_k_bins
+        metadata['N_MU_BINS']=data.n_mu_bins
+        metadata['K_HMPC_MAX']=data.k_hMpc_max
+
+    # power spectrum measurement
+    power={}
+    if power_type == "flux_p1d":
+        power['P1D_HMPC']=data.p1d_hMpc
+        power['KP_HMPC']=data.kp_hMpc
+    else:
+        power['P3D_HMPC']=data.p3d_hMpc
+        power['K_HMPC']=data.k_hMpc
+        power['MU']=data.mu
+        power['COUNTS']=data.counts
+
+    return metadata,power
+
+
+def from_pickle_to_fits(pickle_fname,fits_fname,power_type):
+    """Convert pickled measurement to FITS file"""
+
+    # open pickled file to read
+    data=read_pickle(pickle_fname)
+    metadata,power=get_fits_content(data,power_type)
+
+    # open FITS file to write (in temporary file, in case we are killed)
+    tmp_fname=fits_fname+'.tmp'
+    fits = fitsio.FITS(tmp_fname,'rw',clobber=True)
+    extname=power_type.upper()
+    cols=list(power.values())
+    names=list(power.keys())
+    fits.write(cols, names=names, header=metadata, extname=extname)
+    fits.close()
+    os.replace(tmp_fname,fits_fname)
+
+
+def verify_fits(pickle_fname,fits_fname,power_type):
+    """Compare all columns and header keywords of FITS file with pickle.
+        Return list of differences (empty if round-trip is exact)."""
+
+    metadata,power=get_fits_content(read_pickle(pickle_fname),power_type)
+
+    problems=[]
+    with fitsio.FITS(fits_fname) as hdul:
+        hdu=hdul[power_type.upper()]
+        header=hdu.read_header()
+        for key,value in metadata.items():
+            if key not in header:
+                problems.append(key)
+            elif isinstance(value,float):
+                # FITS headers store floats with 15 significant digits
+                if not np.isclose(header[key],value,rtol=1e-14,atol=0):
+                    problems.append(key)
+            elif header[key]!=value:
+                problems.append(key)
+        for name,array in power.items():
+            if name not in hdu.get_colnames():
+                problems.append(name)
+                continue
+            # FITS drops trailing axes of length 1, e.g. (20,1) -> (20,)
+            array=np.asarray(array)
+            column=hdu[name][:]
+            if array.size!=column.size or not np.array_equal(
+                    array.reshape(column.shape),column,equal_nan=True):
+                problems.append(name)
+
+    return problems
+
+
+def get_checksum(fname):
+    """SHA-256 checksum of a file"""
+
+    sha=hashlib.sha256()
+    with open(fname,'rb') as f:
+        for block in iter(lambda: f.read(1<<20),b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def convert_file(pickle_fname,fits_fname,power_type,force=False,
+            verify_all=False):
+    """Convert (if needed) and verify one file, and return manifest entry"""
+
+    # skip files whose output is newer than the input (incremental rebuild)
+    up_to_date=(os.path.exists(fits_fname) and
+        os.path.getmtime(fits_fname)>=os.path.getmtime(pickle_fname))
+    converted=(force or not up_to_date)
+    if converted:
+        from_pickle_to_fits(pickle_fname,fits_fname,power_type)
+
+    entry={'power_type':power_type,'pickle':os.path.basename(pickle_fname),
+            'fits':os.path.basename(fits_fname),'converted':converted,
+            'pickle_sha256':get_checksum(pickle_fname),
+            'fits_sha256':get_checksum(fits_fname)}
+    if converted or verify_all:
+        entry['problems']=verify_fits(pickle_fname,fits_fname,power_type)
+
+    return entry
+
+
+def list_pickles(repo_dir):
+    """Return list of (pickle_fname,fits_fname,power_type) to convert"""
+
+    files=[]
+    for power_type in measured_power.ALL_POWER_TYPES:
+        pickle_dir='{}/pickled_data/{}/'.format(repo_dir,power_type)
+        fits_dir='{}/data/{}/'.format(repo_dir,power_type)
+        for fname in sorted(os.listdir(pickle_dir)):
+            pre, suff = os.path.splitext(fname)
+            if suff!='.p': continue
+            files.append((pickle_dir+fname,'{}/{}.fits'.format(fits_dir,pre),
+                            power_type))
+    return files
+
+
+def convert_all(repo_dir=None,workers=4,force=False,verify_all=False,
+            manifest_fname=None):
+    """Convert all pickled measurements to FITS, in parallel processes,
+        and write manifest (JSON) with checksums and verification results"""
+
+    if repo_dir is None:
+        repo_dir=measured_power.get_repo_dir()
+    if manifest_fname is None:
+        manifest_fname=repo_dir+'/data/manifest.json'
+
+    files=list_pickles(repo_dir)
+    n=len(files)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        entries=list(pool.map(convert_file,*zip(*files),[force]*n,
+                        [verify_all]*n))
+
+    with open(manifest_fname,'w') as f:
+        json.dump(entries,f,indent=1)
+
+    return entries
+
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(
+                description='Convert pickled measurements to FITS files')
+    parser.add_argument('--repo-dir',default=None,
+                help='repository folder (default: $SHERWOOD)')
+    parser.add_argument('--workers',type=int,default=4)
+    parser.add_argument('--force',action='store_true',
+                help='convert all files, even if FITS file is up to date')
+    parser.add_argument('--verify-all',action='store_true',
+                help='also verify files that were not converted')
+    parser.add_argument('--manifest',default=None,
+                help='output manifest (default: data/manifest.json)')
+    args=parser.parse_args()
+
+    entries=convert_all(repo_dir=args.repo_dir,workers=args.workers,
+                force=args.force,verify_all=args.verify_all,
+                manifest_fname=args.manifest)
+    n_converted=sum(entry['converted'] for entry in entries)
+    failed=[entry['fits'] for entry in entries if entry.get('problems')]
+    print('{} files, {} converted, {} failed verification'.format(
+                len(entries),n_converted,len(failed)))
+    for fname in failed:
+        print('  failed:',fname)
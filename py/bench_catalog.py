@@ -0,0 +1,41 @@
+import time
+import numpy as np
+import measured_power
+import power_catalog
+
+# compare lookup latency of the catalog with the per-call path
+n_repeat=20
+
+# cold: scan and load the whole data/ tree
+t0=time.perf_counter()
+catalog=power_catalog.PowerCatalog()
+t_cold=time.perf_counter()-t0
+print('cold catalog setup: {} entries in {:.3f} s'.format(len(catalog),t_cold))
+
+# list of (grid,power_type) requests, covering every file
+requests=[(power['grid'],key[0]) for key,power in catalog.index.items()]
+
+# warm: repeated lookups from the in-memory index
+times=[]
+for i in range(n_repeat):
+    for grid,power_type in requests:
+        t0=time.perf_counter()
+        catalog.get_power(grid,power_type)
+        times.append(time.perf_counter()-t0)
+t_warm=np.median(times)
+
+# current path: filename + FITS read + grid check on every call
+times=[]
+for i in range(n_repeat):
+    for grid,power_type in requests:
+        t0=time.perf_counter()
+        measured_power.get_power_from_grid(grid,power_type)
+        times.append(time.perf_counter()-t0)
+t_call=np.median(times)
+
+print('median latency per lookup:')
+print('  get_power_from_grid: {:.2f} us'.format(1e6*t_call))
+print('  catalog (warm): {:.2f} us'.format(1e6*t_warm))
+print('  speedup: {:.0f}x'.format(t_call/t_warm))
+print('  catalog setup equivalent to {:.1f} per-call reads'.format(
+            t_cold/t_call))
@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+# Startup cost of library modules (and of the command line interface),
+# measured in fresh interpreters. Each entry has the budget (in ms, on top
+# of an empty interpreter) and modules that it should not import.
+HEAVY=['fitsio','matplotlib','pyarrow']
+BUDGETS={'sherwood_simulation':(20,HEAVY+['numpy']),
+        'sherwood_cli':(20,HEAVY+['numpy']),
+        'instrument':(20,HEAVY+['numpy']),
+        'model_density':(250,HEAVY),
+        'measured_power':(250,HEAVY),
+        'power_catalog':(250,HEAVY),
+        'likelihood_p3d':(250,HEAVY),
+        'model_p3d':(250,HEAVY),
+        'plot_data':(250,HEAVY),
+        'plot_ratio':(250,HEAVY),
+        'plot_suite':(250,HEAVY),
+        'unpickle':(250,HEAVY),
+        'data_backend':(250,HEAVY),
+        'export_power':(250,HEAVY),
+        'convergence':(250,HEAVY)}
+
+# run in the child: import module and report time and loaded modules
+_CHILD="""import sys,time,json
+t0=time.perf_counter()
+{}
+dt=time.perf_counter()-t0
+print(json.dumps({{'ms':1e3*dt,'modules':sorted(sys.modules)}}))"""
+
+
+def time_import(module,py_dir):
+    """Time to import module in a fresh interpreter (ms), and set of
+        modules loaded by then"""
+
+    code=_CHILD.format('import '+module if module else 'pass')
+    env=dict(os.environ,PYTHONPATH=py_dir)
+    output=subprocess.run([sys.executable,'-c',code],env=env,check=True,
+                capture_output=True,text=True).stdout
+    result=json.loads(output)
+    return result['ms'],set(result['modules'])
+
+
+def run_all(repeat=5,only=None):
+    """Median import time of each module, and heavy modules it loaded"""
+
+    py_dir=os.path.dirname(os.path.abspath(__file__))
+    results={}
+    for module,(budget_ms,forbidden) in BUDGETS.items():
+        if only and module not in only: continue
+        times=[]
+        for i in range(repeat):
+            ms,modules=time_import(module,py_dir)
+            times.append(ms)
+        loaded=[name for name in forbidden if name in modules]
+        results[module]={'median_ms':float(np.median(times)),
+                'min_ms':float(np.min(times)),'budget_ms':budget_ms,
+                'loaded':loaded}
+    return results
+
+
+def check(results):
+    """List of modules over budget or importing forbidden modules"""
+
+    return [module for module,result in results.items()
+            if result['median_ms']>result['budget_ms'] or result['loaded']]
+
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(
+                description='Time imports in fresh interpreters')
+    parser.add_argument('--repeat',type=int,default=5)
+    parser.add_argument('--only',nargs='*',default=None)
+    parser.add_argument('--output',default=None,help='write results to JSON')
+    args=parser.parse_args()
+
+    results=run_all(repeat=args.repeat,only=args.only)
+    for module,result in results.items():
+        print('{:20s} {:7.1f} ms (budget {:4d} ms) {}'.format(module,
+                result['median_ms'],result['budget_ms'],
+                'loaded '+','.join(result['loaded']) if result['loaded'] else ''))
+    if args.output:
+        with open(args.output,'w') as f:
+            json.dump(results,f,indent=2)
+    failed=check(results)
+    if failed:
+        print('over startup budget:',', '.join(failed))
+        sys.exit(1)
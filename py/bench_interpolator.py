@@ -0,0 +1,50 @@
+import os
+import time
+import tempfile
+import numpy as np
+import model_density
+
+# accuracy and throughput of the interpolation methods in PowerInterpolator
+n_repeat=2000
+fname=os.environ['SHERWOOD']+'/data/linear_pk/lin_9.dat'
+
+# accuracy: interpolate from every other point, compare with the rest
+data=np.loadtxt(fname)
+k_all=data[:,0]
+P_all=data[:,1]
+tmp_dir=tempfile.TemporaryDirectory()
+half_fname=os.path.join(tmp_dir.name,'lin_9_half.dat')
+np.savetxt(half_fname,data[::2])
+k_test=k_all[1:-1:2]
+P_test=P_all[1:-1:2]
+# only compare in the range of scales that are measured
+in_range=(k_test>0.03) & (k_test<30)
+print('max relative error at held-out points (0.03 < k < 30 h/Mpc):')
+for method in ['linear','spline']:
+    interp=model_density.PowerInterpolator(half_fname,method=method)
+    err=np.abs(interp.P_hMpc(k_test)/P_test-1)[in_range]
+    print('  {}: {:.2e}'.format(method,err.max()))
+tmp_dir.cleanup()
+
+# agreement of the spline with the current (linear) behaviour
+linear=model_density.PowerInterpolator(fname)
+k_grid=np.exp(np.random.default_rng(1).uniform(np.log(0.03),np.log(30),
+                                                    [20,16]))
+P_linear=linear.P_hMpc(k_grid)
+print('max relative difference with linear method (full table):')
+for method in ['spline']:
+    interp=model_density.PowerInterpolator(fname,method=method)
+    print('  {}: {:.2e}'.format(method,
+                np.max(np.abs(interp.P_hMpc(k_grid)/P_linear-1))))
+
+# throughput on a fixed (n_k,n_mu) grid
+print('time per evaluation on a {} grid:'.format(k_grid.shape))
+for method,memo_size in [('linear',0),('spline',0),('linear',8)]:
+    interp=model_density.PowerInterpolator(fname,method=method,
+                                                memo_size=memo_size)
+    t0=time.perf_counter()
+    for i in range(n_repeat):
+        interp.P_hMpc(k_grid)
+    dt=(time.perf_counter()-t0)/n_repeat
+    label=method+(' (memo)' if memo_size else '')
+    print('  {}: {:.2f} us'.format(label,1e6*dt))
@@ -0,0 +1,43 @@
+import time
+import numpy as np
+import sherwood_simulation as she_sim
+import measured_power
+import model_density
+
+# compare per-call and batched evaluation of the linear power
+n_repeat=200
+
+model=model_density.LinearDensityModel()
+
+# (n_k,n_mu) grid from a P3D measurement, at all snapshots
+sim=she_sim.SherwoodSimulation(L_hMpc=160,n_part=2048)
+skewers=she_sim.Grid(simulation=sim,snapshot_num=9,n_xy=1024,n_z=2048)
+data=measured_power.get_power_from_grid(skewers,'flux_p3d')
+k_grid=data['k_hMpc']
+n_k,n_mu=k_grid.shape
+zs=model.redshifts
+
+def per_call():
+    P_L=np.empty([len(zs),n_k,n_mu])
+    for iz,z in enumerate(zs):
+        for i in range(n_mu):
+            P_L[iz,:,i]=model.linP_hMpc(z=z,k_hMpc=k_grid[:,i])
+    return P_L
+
+def batched():
+    return model.linP_hMpc_batch(zs[:,np.newaxis,np.newaxis],k_grid)
+
+# check that both paths agree (including NaN in empty bins)
+P_call=per_call()
+P_batch=batched()
+assert np.allclose(P_call,P_batch,rtol=1e-12,atol=0.0,equal_nan=True)
+print('max relative difference: {:.2e}'.format(
+            np.nanmax(np.abs(P_batch/P_call-1))))
+
+for label,func in [('per-call (z, mu) loop',per_call),('batched',batched)]:
+    t0=time.perf_counter()
+    for i in range(n_repeat):
+        func()
+    dt=(time.perf_counter()-t0)/n_repeat
+    print('{}: {:.1f} us per evaluation of {} redshifts x {} bins'.format(
+                label,1e6*dt,len(zs),n_k*n_mu))
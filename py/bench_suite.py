@@ -0,0 +1,299 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+import numpy as np
+import sherwood_simulation as she_sim
+import measured_power
+import model_density
+import unpickle
+
+# benchmarks of the data loading and modeling hot paths, on the data/ tree.
+# Each benchmark is a list of calls (function, files it reads). In cold
+# conditions, the files are evicted from the page cache and the in-process
+# caches are cleared before each call. In warm conditions, all calls are
+# run once before timing.
+CONDITIONS=['cold','warm']
+# latency percentiles to report
+PERCENTILES=[50,90,99]
+# benchmarks that can not run in this repository, with the reason
+UNSUPPORTED={'get_power_from_pickle':'pickles need the measurement '
+            'pipeline (measured_p1d, measured_p3d, measured_cross), use '
+            'compare:pickle (unpickle.read_pickle) instead'}
+
+
+def evict_files(fnames):
+    """Ask the OS to drop cached pages of files (best effort)"""
+
+    if not hasattr(os,'posix_fadvise'):
+        return
+    for fname in fnames:
+        fd=os.open(fname,os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd,0,0,os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def clear_caches():
+    """Clear caches kept in the process"""
+
+    measured_power.default_cache.clear()
+    measured_power._open_stores.clear()
+    model_density._shared_models.clear()
+
+
+def get_suite(data_dir=None):
+    """List of (grid,power_type,fname) for all FITS files in the suite"""
+
+    if data_dir is None:
+        data_dir=measured_power.get_repo_dir()+'/data/'
+    suite=[]
+    for power_type,fname in measured_power.list_fits_files(data_dir):
+        with measured_power.read_fits_power(fname,power_type,lazy=True) as p:
+            suite.append((p['grid'],power_type,fname))
+    return suite
+
+
+def get_linear_files():
+    """Files read when setting up LinearDensityModel"""
+
+    basedir=measured_power.get_repo_dir()+'/data/linear_pk/'
+    fnames=[basedir+'params.ini']
+    for snap in range(8,12):
+        for ext in ['dat','npz']:
+            fname=basedir+'lin_{}.{}'.format(snap,ext)
+            if os.path.exists(fname):
+                fnames.append(fname)
+    return fnames
+
+
+def get_plot_ratio_grids():
+    """Flux skewers and halo grid used in plot_ratio.py"""
+
+    sim=she_sim.SherwoodSimulation(L_hMpc=160,n_part=2048)
+    skewers=she_sim.Grid(simulation=sim,snapshot_num=9,n_xy=1024,n_z=2048,
+                axis=0)
+    halos=she_sim.HaloGrid(simulation=sim,snapshot_num=9,logMh_min=None,
+                logMh_max=None,n_xy=1024,n_z=2048,axis=0,add_rsd=True)
+    return skewers,halos
+
+
+def get_benchmarks(suite):
+    """Dictionary of benchmarks, each one a list of (function,fnames)"""
+
+    bench={}
+    bench['get_power_fname']=[
+            (lambda g=grid,pt=pt: measured_power.get_power_fname(g,pt),[])
+            for grid,pt,fname in suite]
+    bench['read_fits_power']=[
+            (lambda f=fname,pt=pt: measured_power.read_fits_power(f,pt),[fname])
+            for grid,pt,fname in suite]
+    bench['get_power_from_grid']=[
+            (lambda g=grid,pt=pt: measured_power.get_power_from_grid(g,pt),
+                [fname]) for grid,pt,fname in suite]
+    bench['get_power_from_grid(use_cache)']=[
+            (lambda g=grid,pt=pt: measured_power.get_power_from_grid(g,pt,
+                use_cache=True),[fname]) for grid,pt,fname in suite]
+
+    # only measurements that also have a pickled file
+    pickled=[(grid,pt,fname,measured_power.get_power_fname(grid,pt,
+                pickle=True)) for grid,pt,fname in suite]
+    pickled=[entry for entry in pickled if os.path.exists(entry[3])]
+    # same measurements, from FITS and from pickle (without the old pipeline)
+    bench['compare:fits']=[
+            (lambda f=fname,pt=pt: measured_power.read_fits_power(f,pt),[fname])
+            for grid,pt,fname,pickle_fname in pickled]
+    bench['compare:pickle']=[
+            (lambda f=pickle_fname: unpickle.read_pickle(f),[pickle_fname])
+            for grid,pt,fname,pickle_fname in pickled]
+
+    linear_files=get_linear_files()
+    bench['LinearDensityModel.__init__']=[
+            (model_density.LinearDensityModel,linear_files)]
+
+    # linP_hMpc for each mu bin of a P3D measurement, at all snapshots
+    model=model_density.LinearDensityModel()
+    skewers,halos=get_plot_ratio_grids()
+    k_grid=measured_power.get_power_from_grid(skewers,'flux_p3d')['k_hMpc']
+    bench['linP_hMpc']=[
+            (lambda z=z,k=k_grid[:,i]: model.linP_hMpc(z=z,k_hMpc=k),[])
+            for z in model.redshifts for i in range(k_grid.shape[1])]
+
+    # load all measurements, in a single call
+    def load_suite():
+        for grid,pt,fname in suite:
+            measured_power.get_power_from_grid(grid,pt)
+    bench['suite_load']=[(load_suite,[fname for grid,pt,fname in suite])]
+
+    # mu-binned linear power for the data in plot_ratio.py (including setup)
+    def plot_ratio_linP():
+        z=skewers.get_z()
+        data_F=measured_power.get_power_from_grid(skewers,'flux_p3d')
+        data_X=measured_power.get_power_from_grid(halos,'cross_p3d')
+        linear=model_density.LinearDensityModel()
+        return (linear.linP_hMpc_batch(z=z,k_hMpc=data_F['k_hMpc']),
+                linear.linP_hMpc_batch(z=z,k_hMpc=data_X['k_hMpc']))
+    plot_files=[measured_power.get_power_fname(skewers,'flux_p3d'),
+                measured_power.get_power_fname(halos,'cross_p3d')]
+    bench['plot_ratio_linP']=[(plot_ratio_linP,plot_files+linear_files)]
+
+    return bench
+
+
+def time_calls(calls,condition,n_repeat):
+    """Return latency (in seconds) of each call, repeated n_repeat times"""
+
+    if condition=='warm':
+        for func,fnames in calls:
+            func()
+    times=[]
+    for it in range(n_repeat):
+        for func,fnames in calls:
+            if condition=='cold':
+                evict_files(fnames)
+                clear_caches()
+            t0=time.perf_counter()
+            func()
+            times.append(time.perf_counter()-t0)
+    return np.array(times)
+
+
+def get_peak_memory(calls,condition):
+    """Peak memory (bytes) allocated by Python during one pass of calls"""
+
+    if condition=='cold':
+        clear_caches()
+    tracemalloc.start()
+    try:
+        for func,fnames in calls:
+            func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmark(calls,condition,n_repeat):
+    """Dictionary with throughput, latency percentiles and peak memory"""
+
+    times=time_calls(calls,condition,n_repeat)
+    result={'n_calls':len(times),'total_s':float(times.sum()),
+            'throughput_per_s':float(len(times)/times.sum()),
+            'mean_us':1e6*float(times.mean()),'max_us':1e6*float(times.max())}
+    for q,value in zip(PERCENTILES,np.percentile(times,PERCENTILES)):
+        result['p{}_us'.format(q)]=1e6*float(value)
+    result['peak_memory_bytes']=get_peak_memory(calls,condition)
+    return result
+
+
+def run_all(n_repeat=5,only=None,data_dir=None):
+    """Run all benchmarks (whose name contains only, if given), and return
+        dictionary with metadata and results keyed by name/condition"""
+
+    suite=get_suite(data_dir)
+    benchmarks=get_benchmarks(suite)
+    results={}
+    for name,reason in UNSUPPORTED.items():
+        if only is not None and only not in name:
+            continue
+        for condition in CONDITIONS:
+            results['{}/{}'.format(name,condition)]={'unsupported':reason}
+    for name,calls in benchmarks.items():
+        if only is not None and only not in name:
+            continue
+        for condition in CONDITIONS:
+            key='{}/{}'.format(name,condition)
+            try:
+                results[key]=run_benchmark(calls,condition,n_repeat)
+            except Exception as err:
+                results[key]={'skipped':'{}: {}'.format(
+                                type(err).__name__,err)}
+                print('benchmark {} failed: {}'.format(key,
+                                results[key]['skipped']),file=sys.stderr)
+    clear_caches()
+
+    meta={'time':time.strftime('%Y-%m-%dT%H:%M:%S'),'n_repeat':n_repeat,
+            'n_files':len(suite),'python':platform.python_version(),
+            'numpy':np.__version__,'platform':platform.platform()}
+    return {'meta':meta,'results':results}
+
+
+def compare(results,baseline,metric='p50_us',tolerance=0.25):
+    """Compare metric with baseline, return list of (key,ratio,regression)"""
+
+    rows=[]
+    for key,result in results['results'].items():
+        old=baseline['results'].get(key,{})
+        if metric not in result or metric not in old:
+            continue
+        ratio=result[metric]/old[metric]
+        rows.append((key,ratio,ratio>1+tolerance))
+    return rows
+
+
+def print_results(results):
+    print('{:42s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s}'.format('benchmark',
+            'calls','calls/s','p50 (us)','p99 (us)','peak (KiB)'))
+    for key,result in results['results'].items():
+        if 'unsupported' in result:
+            print('{:42s} unsupported ({})'.format(key,result['unsupported']))
+            continue
+        if 'skipped' in result:
+            print('{:42s} FAILED ({})'.format(key,result['skipped']))
+            continue
+        print('{:42s} {:8d} {:10.1f} {:10.1f} {:10.1f} {:10.1f}'.format(key,
+                result['n_calls'],result['throughput_per_s'],
+                result['p50_us'],result['p99_us'],
+                result['peak_memory_bytes']/1024))
+
+    # FITS vs pickle read of the same measurements
+    for condition in CONDITIONS:
+        fits=results['results'].get('compare:fits/'+condition,{})
+        pick=results['results'].get('compare:pickle/'+condition,{})
+        if 'p50_us' in fits and 'p50_us' in pick:
+            print('{} read, pickle / FITS (p50): {:.2f}'.format(condition,
+                    pick['p50_us']/fits['p50_us']))
+
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(
+                description='Benchmark data loading and modeling hot paths')
+    parser.add_argument('--repeat',type=int,default=5,
+                help='number of timed passes over the calls of a benchmark')
+    parser.add_argument('--only',default=None,
+                help='only run benchmarks whose name contains this string')
+    parser.add_argument('--output',default='bench_results.json')
+    parser.add_argument('--baseline',default='bench_baseline.json')
+    parser.add_argument('--save-baseline',action='store_true',
+                help='store results as the new baseline')
+    parser.add_argument('--tolerance',type=float,default=0.25,
+                help='relative slowdown of p50 latency flagged as regression')
+    args=parser.parse_args()
+
+    results=run_all(n_repeat=args.repeat,only=args.only)
+    print_results(results)
+    with open(args.output,'w') as f:
+        json.dump(results,f,indent=1)
+    print('wrote results to',args.output)
+
+    if args.save_baseline:
+        with open(args.baseline,'w') as f:
+            json.dump(results,f,indent=1)
+        print('stored baseline in',args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline=json.load(f)
+        rows=compare(results,baseline,tolerance=args.tolerance)
+        regressions=[row for row in rows if row[2]]
+        print('compared {} benchmarks with {} ({} regressions)'.format(
+                len(rows),args.baseline,len(regressions)))
+        for key,ratio,regression in rows:
+            print('  {:42s} {:6.2f}x{}'.format(key,ratio,
+                    '  REGRESSION' if regression else ''))
+        if regressions:
+            sys.exit(1)
+    if any('skipped' in result for result in results['results'].values()):
+        sys.exit(1)
@@ -0,0 +1,211 @@
+import numpy as np
+import measured_power
+import power_catalog
+import likelihood_p3d
+
+# fields of the catalog key that set the resolution of a measurement, and
+# that are allowed to differ within a group of measurements compared
+RESOLUTION_FIELDS=['n_part','n_xy','n_z']
+
+
+def get_group_key(key):
+    """Key of the group of a catalog key: power type and all key fields
+        except the resolution fields"""
+
+    fields=dict(zip(power_catalog.KEY_FIELDS,key[1:]))
+    return (key[0],)+tuple(fields[f] for f in power_catalog.KEY_FIELDS
+                if f not in RESOLUTION_FIELDS)
+
+
+def get_resolution(key):
+    """Dictionary with the resolution fields of a catalog key"""
+
+    fields=dict(zip(power_catalog.KEY_FIELDS,key[1:]))
+    return {f:fields[f] for f in RESOLUTION_FIELDS}
+
+
+def compare_powers(powers,k_max_hMpc=None,errors=None):
+    """Compare all pairs (i<j) of P3D measurements with the same binning,
+        in a single vectorized pass. Bins are aligned by index, and a bin
+        is used in a pair if it is valid and non-empty in both. Errors
+        (one array per measurement, default measured_power.get_gaussian_error)
+        are treated as independent in the significance, so that it is
+        conservative for measurements from the same initial conditions.
+        Returns dictionary with pairs (i,j), mask, and arrays with shape
+        (n_pairs,n_k,n_mu): ratio P_j/P_i, diff P_j-P_i and significance
+        diff/sigma (NaN in bins not used), and per pair summaries:
+        n_bins, chi2 (sum of significance squared), mean_ratio (ratio of
+        count weighted sums of P_j and P_i, robust to bins with P_i close
+        to zero) and max_abs_sig."""
+
+    shape=powers[0]['p3d_hMpc'].shape
+    for power in powers:
+        assert power['p3d_hMpc'].shape==shape,'inconsistent binning'
+    # (n_powers,n_k,n_mu) arrays (halo power without RSD has no mu axis)
+    stack=lambda arrays:np.stack(arrays).reshape(len(powers),shape[0],-1)
+    P=stack([power['p3d_hMpc'] for power in powers])
+    counts=stack([power['counts'] for power in powers])
+    mask=stack([measured_power.get_valid_mask(power)&(power['counts']>0)
+                for power in powers])
+    if k_max_hMpc is not None:
+        mask&=stack([power['k_hMpc']<k_max_hMpc for power in powers])
+    if errors is None:
+        errors=[measured_power.get_gaussian_error(power) for power in powers]
+    var=stack(errors)**2
+
+    i,j=np.triu_indices(len(powers),1)
+    use=mask[i]&mask[j]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        ratio=np.where(use,P[j]/P[i],np.nan)
+        diff=np.where(use,P[j]-P[i],np.nan)
+        sig=np.where(use,diff/np.sqrt(var[i]+var[j]),np.nan)
+        # weight each bin by the (smaller) number of modes in the pair
+        weights=np.where(use,np.minimum(counts[i],counts[j]),0.0)
+        mean_ratio=(np.sum(weights*np.where(use,P[j],0.0),axis=(1,2))
+                    /np.sum(weights*np.where(use,P[i],0.0),axis=(1,2)))
+    finite=np.isfinite(sig)
+    return {'pairs':np.stack([i,j],axis=1),'mask':use,'ratio':ratio,
+            'diff':diff,'significance':sig,
+            'n_bins':np.sum(finite,axis=(1,2)),
+            'chi2':np.sum(np.where(finite,sig**2,0.0),axis=(1,2)),
+            'mean_ratio':mean_ratio,
+            'max_abs_sig':np.max(np.where(finite,np.abs(sig),0.0),axis=(1,2))}
+
+
+class ConvergenceEngine(object):
+    """Compare P3D measurements of the same box, snapshot, axis, mass bin
+        and RSD option, measured at different resolutions (n_part, n_xy,
+        n_z). Measurements are grouped by the key fields that do not set
+        the resolution, and all pairs in a group are compared at once (see
+        compare_powers). Results are computed once per group. Inputs:
+      - catalog: PowerCatalog to get measurements from (optional)
+      - power_types: power types to compare (default: flux, halo, cross)
+      - k_max_hMpc: only use bins with k below this value (optional)"""
+
+    def __init__(self,catalog=None,power_types=likelihood_p3d.P3D_TYPES,
+                k_max_hMpc=None):
+
+        if catalog is None:
+            catalog=power_catalog.PowerCatalog(power_types=power_types)
+        self.catalog=catalog
+        self.k_max_hMpc=k_max_hMpc
+
+        # catalog keys in each group, sorted by (n_part,n_xy,n_z). This is
+        # not a resolution order: members can differ in several fields.
+        self.members={}
+        for power_type in power_types:
+            for key in catalog.select_keys(power_type):
+                self.members.setdefault(get_group_key(key),[]).append(key)
+        for keys in self.members.values():
+            keys.sort(key=lambda key:tuple(get_resolution(key).values()))
+        # results of compare_powers, indexed by group key
+        self.results={}
+
+
+    def get_error(self,key):
+        """Gaussian error of a measurement. For cross power, it uses the
+            flux and halo power of the same grid if they are in the
+            catalog (see measured_power.get_cross_error)."""
+
+        power=self.catalog.index[key]
+        if key[0]=='cross_p3d':
+            halos=power['grid']
+            skewers=likelihood_p3d.get_skewers_from_halos(halos)
+            flux_key=power_catalog.get_power_key(skewers,'flux_p3d')
+            halo_key=power_catalog.get_power_key(halos,'halo_p3d')
+            if flux_key in self.catalog and halo_key in self.catalog:
+                return measured_power.get_cross_error(
+                        self.catalog.index[flux_key],power,
+                        self.catalog.index[halo_key])
+        return measured_power.get_gaussian_error(power)
+
+
+    def get_groups(self,min_members=2):
+        """Keys of groups with at least min_members measurements"""
+
+        return sorted([group for group,keys in self.members.items()
+                    if len(keys)>=min_members],key=str)
+
+
+    def get_group(self,group):
+        """Comparison of all pairs in a group (cached), with the catalog
+            keys of the members, their grids, the resolution fields that
+            differ in the group, and the fields that differ in each pair"""
+
+        if group not in self.results:
+            keys=self.members[group]
+            powers=[self.catalog.index[key] for key in keys]
+            errors=[self.get_error(key) for key in keys]
+            result=compare_powers(powers,k_max_hMpc=self.k_max_hMpc,
+                        errors=errors)
+            resolutions=[get_resolution(key) for key in keys]
+            result['keys']=keys
+            result['grids']=[power['grid'] for power in powers]
+            result['fields']=[f for f in RESOLUTION_FIELDS
+                    if len(set(res[f] for res in resolutions))>1]
+            result['pair_fields']=[[f for f in RESOLUTION_FIELDS
+                    if resolutions[i][f]!=resolutions[j][f]]
+                    for i,j in result['pairs']]
+            self.results[group]=result
+        return self.results[group]
+
+
+    def get_matrix(self,group,stat='chi2'):
+        """Symmetric (n_members,n_members) matrix of a per pair summary
+            (chi2, n_bins, max_abs_sig) or, for mean_ratio, the ratio of
+            column over row (NaN on the diagonal)"""
+
+        result=self.get_group(group)
+        n=len(result['keys'])
+        matrix=np.full([n,n],np.nan)
+        i,j=result['pairs'].T
+        values=result[stat]
+        matrix[i,j]=values
+        matrix[j,i]=1/values if stat=='mean_ratio' else values
+        return matrix
+
+
+    def get_convergence_matrix(self,stat='chi2',min_members=2):
+        """Matrices of a per pair summary (see get_matrix) for all groups,
+            as a dictionary indexed by group key, with the grids of the
+            members (rows and columns of the matrix)"""
+
+        return {group:{'grids':self.get_group(group)['grids'],
+                'matrix':self.get_matrix(group,stat)}
+                for group in self.get_groups(min_members)}
+
+
+    def get_table(self,min_members=2):
+        """List of dictionaries (one per pair in all groups) with the
+            nametags of both grids (first and second, in the order of the
+            group members), the fields that differ and summaries"""
+
+        rows=[]
+        for group in self.get_groups(min_members):
+            result=self.get_group(group)
+            for p,(i,j) in enumerate(result['pairs']):
+                rows.append({'power_type':group[0],
+                    'first':result['grids'][i].get_nametag(),
+                    'second':result['grids'][j].get_nametag(),
+                    'fields':result['pair_fields'][p],
+                    'n_bins':int(result['n_bins'][p]),
+                    'chi2_per_bin':result['chi2'][p]/max(result['n_bins'][p],1),
+                    'mean_ratio':result['mean_ratio'][p],
+                    'max_abs_sig':result['max_abs_sig'][p]})
+        return rows
+
+
+if __name__ == '__main__':
+    import time
+    t0=time.perf_counter()
+    engine=ConvergenceEngine()
+    t1=time.perf_counter()
+    table=engine.get_table()
+    t2=time.perf_counter()
+    print('{} groups, {} pairs (catalog {:.2f} s, comparisons {:.1f} ms)'.format(
+            len(engine.get_groups()),len(table),t1-t0,1e3*(t2-t1)))
+    for row in table:
+        print('{:9s} {:34s} vs {:34s} {:12s} n={:3d} chi2/n={:7.2f} '
+                '<ratio>={:.3f} max|sig|={:5.1f}'.format(row['power_type'],
+                row['first'],row['second'],','.join(row['fields']),row['n_bins'],
+                row['chi2_per_bin'],row['mean_ratio'],row['max_abs_sig']))
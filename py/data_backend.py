@@ -0,0 +1,592 @@
+import os
+import json
+import time
+import queue
+import hashlib
+import argparse
+import warnings
+import threading
+import http.client
+import http.server
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import measured_power
+
+# Backends find measurements for measured_power.get_power_from_grid (see
+# measured_power.set_backend). File backends map each measurement to its
+# path relative to the data folder (measured_power.get_power_relpath).
+# Mirrors serve the data folder over HTTP, with an index (INDEX_NAME)
+# mapping these paths to the size and SHA-256 checksum of each file.
+INDEX_NAME='index.json'
+
+
+class DataBackend(object):
+    """Base class for backends that provide FITS files: subclasses
+        implement list_files, and get_file returning a local file for a
+        path relative to the data folder"""
+
+    def get_location(self,grid,power_type):
+        """String identifying a measurement in the backend (no I/O)"""
+
+        return measured_power.get_power_relpath(grid,power_type)
+
+
+    def list_files(self,power_types=None):
+        """Sorted list of (power_type,relpath) of all measurements"""
+
+        raise NotImplementedError
+
+
+    def get_file(self,relpath):
+        raise NotImplementedError
+
+
+    def read_file(self,relpath,power_type,cache=None,lazy=False):
+        """Return power read from a path relative to the data folder"""
+
+        fname=self.get_file(relpath)
+        return measured_power.read_power_file(fname,power_type,cache=cache,
+                    lazy=lazy)
+
+
+    def get_fname(self,grid,power_type):
+        return self.get_file(measured_power.get_power_relpath(grid,power_type))
+
+
+    def get_power(self,grid,power_type,cache=None,lazy=False):
+        """Return measured power spectrum (see get_power_from_grid)"""
+
+        relpath=measured_power.get_power_relpath(grid,power_type)
+        return self.read_file(relpath,power_type,cache=cache,lazy=lazy)
+
+
+    def prefetch(self,grids,power_types,workers=8):
+        """Make measurements available locally (nothing to do by default).
+            Returns list of errors, as (index,location,exception)."""
+
+        return []
+
+
+def _filter_relpaths(relpaths,power_types=None):
+    """Sorted list of (power_type,relpath), for the power types requested"""
+
+    if power_types is None:
+        power_types=measured_power.ALL_POWER_TYPES
+    files=[(relpath.split('/')[0],relpath) for relpath in relpaths]
+    return sorted([(power_type,relpath) for power_type,relpath in files
+                if power_type in power_types],
+                key=lambda f:(power_types.index(f[0]),f[1]))
+
+
+class LocalBackend(DataBackend):
+    """FITS files in a local folder (default: data/ in $SHERWOOD)"""
+
+    def __init__(self,data_dir=None):
+
+        if data_dir is None:
+            data_dir=measured_power.get_repo_dir()+'/data/'
+        self.data_dir=data_dir
+
+
+    def list_files(self,power_types=None):
+        return [(power_type,power_type+'/'+os.path.basename(fname))
+                for power_type,fname in measured_power.list_fits_files(
+                self.data_dir,power_types)]
+
+
+    def get_file(self,relpath):
+        return os.path.join(self.data_dir,relpath)
+
+
+class ArchiveBackend(DataBackend):
+    """Consolidated binary store (see power_store.py), memory-mapped once.
+        Arrays are read-only views of the mapped file, so cache and lazy
+        options are ignored. The local file of every measurement is the
+        store itself."""
+
+    def __init__(self,fname=None):
+
+        self.store=measured_power.get_power_store(fname)
+        self.entries={entry['power_type']+'/'+entry['fname']:entry
+                    for entry in self.store.table}
+
+
+    def get_location(self,grid,power_type):
+        return '{}:{}'.format(self.store.fname,
+                    measured_power.get_power_relpath(grid,power_type))
+
+
+    def list_files(self,power_types=None):
+        return _filter_relpaths(self.entries,power_types)
+
+
+    def get_file(self,relpath):
+        if relpath not in self.entries:
+            raise KeyError('no measurement in store',relpath)
+        return self.store.fname
+
+
+    def read_file(self,relpath,power_type,cache=None,lazy=False):
+        if relpath not in self.entries:
+            raise KeyError('no measurement in store',relpath)
+        return self.store.get_entry_power(self.entries[relpath])
+
+
+    def get_power(self,grid,power_type,cache=None,lazy=False):
+        return self.store.get_power(grid,power_type)
+
+
+class ConnectionPool(object):
+    """Pool of persistent (keep-alive) HTTP connections to a single host,
+        that can be shared by threads. Connections are reused for many
+        requests, and replaced if the server closed them. Inputs:
+      - base_url: http:// or https:// URL (with an optional path prefix)
+      - max_idle: maximum number of idle connections kept open
+      - timeout: timeout (in seconds) of each connection"""
+
+    def __init__(self,base_url,max_idle=8,timeout=30):
+
+        url=urllib.parse.urlsplit(base_url)
+        if url.scheme=='http':
+            self.connection_class=http.client.HTTPConnection
+        elif url.scheme=='https':
+            self.connection_class=http.client.HTTPSConnection
+        else:
+            raise ValueError('unsupported URL',base_url)
+        self.host=url.hostname
+        self.port=url.port
+        self.prefix=url.path.rstrip('/')
+        self.timeout=timeout
+        self.max_idle=max_idle
+        self.idle=queue.LifoQueue()
+        # counters, to check that connections are reused
+        self.lock=threading.Lock()
+        self.connections=0
+        self.requests=0
+
+
+    def _acquire(self,fresh=False):
+        if not fresh:
+            try:
+                return self.idle.get_nowait(),True
+            except queue.Empty:
+                pass
+        with self.lock:
+            self.connections+=1
+        return self.connection_class(self.host,self.port,
+                    timeout=self.timeout),False
+
+
+    def _release(self,conn):
+        if self.idle.qsize()<self.max_idle:
+            self.idle.put(conn)
+        else:
+            conn.close()
+
+
+    def get(self,path,out):
+        """Download path (relative to the base URL) into file object out,
+            and return the number of bytes written. Raises OSError if the
+            server does not return the file."""
+
+        for attempt in range(2):
+            conn,reused=self._acquire(fresh=attempt>0)
+            try:
+                conn.request('GET',self.prefix+'/'+urllib.parse.quote(path))
+                response=conn.getresponse()
+            except (http.client.HTTPException,ConnectionError):
+                conn.close()
+                # the server may have closed an idle connection, and then
+                # the other idle connections are probably stale as well:
+                # drop them, and retry once with a new connection
+                if reused and attempt==0:
+                    self.close()
+                    continue
+                raise
+            break
+        with self.lock:
+            self.requests+=1
+
+        if response.status!=200:
+            response.read()
+            self._release(conn)
+            raise OSError('HTTP {} for {}'.format(response.status,path))
+        nbytes=0
+        try:
+            for block in iter(lambda: response.read(1<<16),b''):
+                out.write(block)
+                nbytes+=len(block)
+        except Exception:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        return nbytes
+
+
+    def close(self):
+        """Close all idle connections"""
+
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class HTTPBackend(DataBackend):
+    """FITS files downloaded from an HTTP mirror of the data folder, and
+        kept in a content-addressed cache on disk (files are stored by
+        checksum, so identical files are stored once and files updated in
+        the mirror are never confused with old ones). When the cache goes
+        over its size budget, least recently used files are removed,
+        except for files being read (see read_file). Inputs:
+      - base_url: URL of the mirror (see serve_mirror)
+      - cache_dir: folder for the cache (default: $SHERWOOD_CACHE, or
+        ~/.cache/sherwood)
+      - max_bytes: size budget of the cache
+      - max_connections: number of keep-alive connections kept open"""
+
+    def __init__(self,base_url,cache_dir=None,max_bytes=1024**3,
+                max_connections=8,timeout=30):
+
+        if cache_dir is None:
+            cache_dir=os.environ.get('SHERWOOD_CACHE',
+                        os.path.join(os.path.expanduser('~'),'.cache',
+                        'sherwood'))
+        self.base_url=base_url
+        self.cache_dir=cache_dir
+        self.max_bytes=max_bytes
+        self.pool=ConnectionPool(base_url,max_idle=max_connections,
+                    timeout=timeout)
+        os.makedirs(os.path.join(cache_dir,'objects'),exist_ok=True)
+        # index of the mirror, downloaded on first use
+        self.index=None
+        self.lock=threading.Lock()
+        # one lock per checksum, so each file is downloaded once
+        self.fetch_locks={}
+        # number of users of each file, that can not be evicted
+        self.pinned={}
+        self.nbytes=sum(os.path.getsize(fname)
+                    for fname in self.list_objects())
+        # counters to monitor the cache
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+
+
+    def get_location(self,grid,power_type):
+        return '{}/{}'.format(self.base_url.rstrip('/'),
+                    measured_power.get_power_relpath(grid,power_type))
+
+
+    def get_index(self):
+        """Index of the mirror, mapping paths to size and checksum"""
+
+        with self.lock:
+            if self.index is None:
+                tmp=_BytesWriter()
+                self.pool.get(INDEX_NAME,tmp)
+                self.index=json.loads(b''.join(tmp.blocks).decode())
+            return self.index
+
+
+    def get_object_fname(self,sha256):
+        return os.path.join(self.cache_dir,'objects',sha256[:2],
+                    sha256+'.fits')
+
+
+    def list_objects(self):
+        objects_dir=os.path.join(self.cache_dir,'objects')
+        return [os.path.join(objects_dir,sub,fname)
+                for sub in sorted(os.listdir(objects_dir))
+                for fname in sorted(os.listdir(os.path.join(objects_dir,sub)))
+                if fname.endswith('.fits')]
+
+
+    def list_files(self,power_types=None):
+        return _filter_relpaths(self.get_index(),power_types)
+
+
+    def get_file(self,relpath):
+        """Local file with a measurement, downloaded if not in the cache.
+            The file can be evicted by later downloads if the cache is over
+            budget: use read_file to read it safely."""
+
+        fname=self._pin(relpath)
+        self._unpin(fname)
+        return fname
+
+
+    def read_file(self,relpath,power_type,cache=None,lazy=False):
+        """Return power read from a measurement, that is not evicted from
+            the cache until it has been read (with lazy, only the header
+            is read before the file can be evicted)"""
+
+        fname=self._pin(relpath)
+        try:
+            return measured_power.read_power_file(fname,power_type,
+                        cache=cache,lazy=lazy)
+        finally:
+            self._unpin(fname)
+
+
+    def _pin(self,relpath):
+        """Make sure a measurement is in the cache, and keep it there until
+            _unpin is called. Returns local filename."""
+
+        entry=self.get_index().get(relpath)
+        if entry is None:
+            raise KeyError('no measurement in mirror',relpath)
+        fname=self.get_object_fname(entry['sha256'])
+        with self.lock:
+            lock=self.fetch_locks.setdefault(entry['sha256'],threading.Lock())
+            self.pinned[fname]=self.pinned.get(fname,0)+1
+        try:
+            with lock:
+                if os.path.exists(fname):
+                    with self.lock:
+                        self.hits+=1
+                    # mark as recently used (modification time is kept,
+                    # since PowerCache uses it to validate its entries)
+                    os.utime(fname,(time.time(),os.stat(fname).st_mtime))
+                else:
+                    self._download(relpath,entry,fname)
+        except BaseException:
+            self._unpin(fname)
+            raise
+        return fname
+
+
+    def _unpin(self,fname):
+        with self.lock:
+            self.pinned[fname]-=1
+            if self.pinned[fname]==0:
+                del self.pinned[fname]
+
+
+    def _download(self,relpath,entry,fname):
+        os.makedirs(os.path.dirname(fname),exist_ok=True)
+        tmp_fname='{}.{}.{}.tmp'.format(fname,os.getpid(),
+                    threading.get_ident())
+        try:
+            with open(tmp_fname,'wb') as f:
+                writer=_HashWriter(f)
+                nbytes=self.pool.get(relpath,writer)
+            if writer.sha.hexdigest()!=entry['sha256']:
+                raise OSError('checksum mismatch for '+relpath)
+            os.replace(tmp_fname,fname)
+        finally:
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+        with self.lock:
+            self.misses+=1
+            self.nbytes+=nbytes
+        self.evict()
+
+
+    def evict(self):
+        """Remove least recently used files until the cache fits in the
+            budget (files in use are never removed)"""
+
+        with self.lock:
+            if self.nbytes<=self.max_bytes:
+                return
+            objects=[]
+            for fname in self.list_objects():
+                if fname in self.pinned: continue
+                try:
+                    stat=os.stat(fname)
+                except FileNotFoundError:
+                    continue
+                objects.append((stat.st_atime,stat.st_size,fname))
+            for atime,size,fname in sorted(objects):
+                if self.nbytes<=self.max_bytes:
+                    break
+                try:
+                    os.remove(fname)
+                except FileNotFoundError:
+                    continue
+                self.nbytes-=size
+                self.evictions+=1
+
+
+    def prefetch(self,grids,power_types,workers=8):
+        """Download measurements missing from the cache, in parallel
+            threads (sharing the connection pool).
+            - power_types: single power type, or list with one per grid
+            Returns list of errors, as (index,location,exception)."""
+
+        if isinstance(power_types,str):
+            power_types=[power_types]*len(grids)
+        assert len(power_types)==len(grids),'need one power type per grid'
+        index=self.get_index()
+        # files that do not fit in the cache would just evict each other
+        entries={index[relpath]['sha256']:index[relpath]['size']
+                for relpath in set(map(measured_power.get_power_relpath,
+                grids,power_types)) if relpath in index}
+        if sum(entries.values())>self.max_bytes:
+            warnings.warn('prefetching {} bytes in a cache of {} bytes: most '
+                    'files will be evicted before they are used'.format(
+                    sum(entries.values()),self.max_bytes))
+
+        def fetch(args):
+            grid,power_type=args
+            try:
+                self.get_fname(grid,power_type)
+            except Exception as err:
+                return err
+            return None
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results=list(pool.map(fetch,zip(grids,power_types)))
+        return [(i,self.get_location(grids[i],power_types[i]),err)
+                for i,err in enumerate(results) if err is not None]
+
+
+    def get_stats(self):
+        """Return dictionary with cache and connection counters"""
+
+        return {'hits':self.hits,'misses':self.misses,
+                'evictions':self.evictions,'nbytes':self.nbytes,
+                'max_bytes':self.max_bytes,
+                'connections':self.pool.connections,
+                'requests':self.pool.requests}
+
+
+class _BytesWriter(object):
+    def __init__(self):
+        self.blocks=[]
+
+    def write(self,block):
+        self.blocks.append(block)
+
+
+class _HashWriter(object):
+    """Write to file object, computing the SHA-256 checksum on the way"""
+
+    def __init__(self,out):
+        self.out=out
+        self.sha=hashlib.sha256()
+
+    def write(self,block):
+        self.sha.update(block)
+        self.out.write(block)
+
+
+def get_index(data_dir=None):
+    """Index of a data folder: size and checksum of each FITS file,
+        indexed by path relative to the folder"""
+
+    if data_dir is None:
+        data_dir=measured_power.get_repo_dir()+'/data/'
+    index={}
+    for power_type,fname in measured_power.list_fits_files(data_dir):
+        index[power_type+'/'+os.path.basename(fname)]={
+                'size':os.path.getsize(fname),
+                'sha256':measured_power.get_checksum(fname)}
+    return index
+
+
+class _MirrorHandler(http.server.SimpleHTTPRequestHandler):
+    # keep connections open between requests
+    protocol_version='HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.lstrip('/')==INDEX_NAME:
+            body=self.server.index_bytes
+            self.send_response(200)
+            self.send_header('Content-Type','application/json')
+            self.send_header('Content-Length',str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            super().do_GET()
+
+    def log_message(self,*args):
+        pass
+
+
+class _MirrorServer(http.server.ThreadingHTTPServer):
+    daemon_threads=True
+
+
+def serve_mirror(data_dir=None,host='127.0.0.1',port=0,background=True):
+    """HTTP server for a data folder and its index, that can be used as
+        a mirror (or as a stand-in for one in tests).
+        - port: 0 to pick any free port (see server.url)
+        - background: serve from a daemon thread, and return the server
+          (stop it with server.shutdown())"""
+
+    if data_dir is None:
+        data_dir=measured_power.get_repo_dir()+'/data/'
+    index_bytes=json.dumps(get_index(data_dir)).encode()
+    handler=lambda *args,**kwargs: _MirrorHandler(*args,directory=data_dir,
+                **kwargs)
+    server=_MirrorServer((host,port),handler)
+    server.index_bytes=index_bytes
+    server.url='http://{}:{}'.format(*server.server_address[:2])
+    if background:
+        threading.Thread(target=server.serve_forever,daemon=True).start()
+    else:
+        server.serve_forever()
+    return server
+
+
+def check_mirror(max_bytes=None,workers=8):
+    """Serve the local data folder, read every measurement through an
+        HTTPBackend (in a temporary cache) and compare it with the local
+        files. Returns dictionary with timings and counters."""
+
+    import tempfile
+    import numpy as np
+    import power_catalog
+
+    catalog=power_catalog.PowerCatalog()
+    keys=catalog.keys()
+    grids=[catalog.index[key]['grid'] for key in keys]
+    power_types=[key[0] for key in keys]
+    server=serve_mirror()
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            backend=HTTPBackend(server.url,cache_dir=cache_dir,
+                        max_bytes=(max_bytes or 1024**3))
+            t0=time.perf_counter()
+            errors=backend.prefetch(grids,power_types,workers=workers)
+            prefetch_time=time.perf_counter()-t0
+            assert not errors,errors
+            n_diff=0
+            for key,grid,power_type in zip(keys,grids,power_types):
+                power=backend.get_power(grid,power_type)
+                local=catalog.index[key]
+                for name,value in local.items():
+                    if isinstance(value,np.ndarray):
+                        if not np.array_equal(value,power[name],equal_nan=True):
+                            n_diff+=1
+            stats=backend.get_stats()
+            backend.pool.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+    stats.update(n_files=len(keys),n_diff=n_diff,prefetch_time=prefetch_time)
+    return stats
+
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(description='Serve or check a mirror')
+    parser.add_argument('command',choices=['serve','check'])
+    parser.add_argument('--data-dir',default=None)
+    parser.add_argument('--host',default='127.0.0.1')
+    parser.add_argument('--port',type=int,default=8000)
+    parser.add_argument('--max-bytes',type=int,default=None,
+                help='cache budget when checking (default: 1 GB)')
+    args=parser.parse_args()
+
+    if args.command=='serve':
+        print('serving',args.data_dir or 'data/','on port',args.port)
+        serve_mirror(args.data_dir,host=args.host,port=args.port,
+                    background=False)
+    else:
+        print(check_mirror(max_bytes=args.max_bytes))
@@ -0,0 +1,361 @@
+import os
+import json
+import numpy as np
+import measured_power
+import model_density
+import power_catalog
+import likelihood_p3d
+import rebin_power
+
+# The suite samples redshift and halo mass in different simulations, so the
+# emulator is separable. For each power type it uses a table of normalized
+# power as a function of (z,k,mu), from the "evolution" series (all halos),
+# multiplied (for cross and halo) by a table with the ratio of the power in
+# a mass bin to that of all halos, as a function of (logMh,k,mu), from the
+# "mass" series. Power is normalized by P_L(z,k)(1+f(z) mu^2)^2, and the
+# shot noise is removed from (and added back to) the halo power.
+# Tables are interpolated in ln|value| (bias evolves roughly geometrically),
+# and mass bins are placed at the center of the bin in logMh.
+EVOLUTION_SERIES={'L_hMpc':80,'n_part':1024,'n_xy':512,'n_z':1024}
+MASS_SERIES={'L_hMpc':160,'n_part':2048,'n_xy':1024,'n_z':2048,
+            'snapshot_num':9,'axis':0}
+# power types with a dependence on halo mass
+MASS_TYPES=['cross_p3d','halo_p3d']
+
+
+def get_growth_rate(z):
+    """Linear growth rate f(z), interpolated between snapshot redshifts"""
+
+    z_nodes=np.array(sorted([2.0,2.4,2.8,3.2]))
+    f_nodes=np.array([model_density.f_of_z(zn) for zn in z_nodes])
+    return np.interp(z,z_nodes,f_nodes)
+
+
+def get_linear_power(linear_model,z,k_hMpc):
+    """Linear power at any redshift in the range of the snapshots, with
+        ln(P) interpolated linearly in z between the tabulated redshifts"""
+
+    z=np.asarray(z,dtype=float)
+    order=np.argsort(linear_model.redshifts)
+    redshifts=linear_model.redshifts[order]
+    i,w=rebin_power.get_interp_index(redshifts,z)
+    j=np.minimum(i+1,len(redshifts)-1)
+    lnk=np.log(np.asarray(k_hMpc,dtype=float))
+    # ln(P) at the two neighbouring redshifts, interpolated in ln(k)
+    lnk_nodes=linear_model.lnk
+    ik,wk=rebin_power.get_interp_index(lnk_nodes,lnk)
+    table=linear_model.lnP_table[order]
+    lnP_i=(1-wk)*table[i,ik]+wk*table[i,ik+1]
+    lnP_j=(1-wk)*table[j,ik]+wk*table[j,ik+1]
+    return np.exp((1-w)*lnP_i+w*lnP_j)
+
+
+def get_normalization(linear_model,z,k_hMpc,mu):
+    """Linear Kaiser power of matter, P_L(z,k)(1+f(z) mu^2)^2"""
+
+    f=get_growth_rate(z)
+    return get_linear_power(linear_model,z,k_hMpc)*(1+f*np.asarray(mu)**2)**2
+
+
+def _interp_table(table,nodes,coords):
+    """Multilinear interpolation of a 3D table, with nodes in each axis,
+        at coordinates (arrays that broadcast against each other)"""
+
+    coords=np.broadcast_arrays(*coords)
+    index=[rebin_power.get_interp_index(n,c) for n,c in zip(nodes,coords)]
+    result=0.0
+    # sum over the 8 corners of the cell
+    for corner in range(8):
+        weight=1.0
+        ijk=[]
+        for axis,(i,w) in enumerate(index):
+            if (corner>>axis)&1:
+                ijk.append(np.minimum(i+1,table.shape[axis]-1))
+                weight=weight*w
+            else:
+                ijk.append(i)
+                weight=weight*(1-w)
+        result=result+weight*table[tuple(ijk)]
+    return result
+
+
+def _interp_log(table,nodes,coords):
+    """Interpolate ln|table|, with the sign of the linear interpolation
+        (a few noisy bins change sign between nodes)"""
+
+    with np.errstate(divide='ignore'):
+        ln_abs=np.log(np.abs(table))
+    sign=np.sign(_interp_table(table,nodes,coords))
+    return sign*np.exp(_interp_table(ln_abs,nodes,coords))
+
+
+def get_normalized_power(power,linear_model):
+    """Normalized power (NaN in invalid bins) and its (n_k,n_mu) mask"""
+
+    z=power['grid'].get_z()
+    mask=measured_power.get_valid_mask(power)&(power['counts']>0)
+    P=power['p3d_hMpc']
+    if power['power_type']=='halo_p3d':
+        P=measured_power.get_halo_power_no_shot_noise(power)
+    norm=get_normalization(linear_model,z,np.nan_to_num(power['k_hMpc'],
+                nan=1.0),np.nan_to_num(power['mu']))
+    return np.where(mask,P/norm,np.nan),mask
+
+
+def _fill_tables(powers,linear_model):
+    """Stack normalized power of measurements on the same grid into a table
+        (n_nodes,n_k,n_mu), keeping k bins valid in all of them and filling
+        empty mu bins by interpolation in mu (see rebin_power.get_common_grid).
+        Returns (table,ln k nodes)."""
+
+    values=[get_normalized_power(power,linear_model)[0] for power in powers]
+    lnk,mu_nodes,table=rebin_power.get_common_grid(powers,np.stack(values))
+    return table,lnk
+
+
+def _get_evolution_powers(catalog,power_type):
+    """Measurements of the evolution series (one per snapshot, all halos,
+        with RSD), preferring axis 0. Returns list sorted by redshift."""
+
+    criteria=dict(EVOLUTION_SERIES)
+    if power_type!='flux_p3d':
+        criteria.update(logMh_min=None,logMh_max=None,add_rsd=True)
+    by_snap={}
+    for key in catalog.select_keys(power_type,**criteria):
+        power=catalog.index[key]
+        snap=power['grid'].snapshot_num
+        if snap not in by_snap or power['grid'].axis<by_snap[snap]['grid'].axis:
+            by_snap[snap]=power
+    return sorted(by_snap.values(),key=lambda power:power['grid'].get_z())
+
+
+def _get_mass_powers(catalog,power_type):
+    """Measurements of the mass series: all halos, and list of mass bins
+        sorted by the center of the bin"""
+
+    powers=catalog.select(power_type,add_rsd=True,**MASS_SERIES)
+    all_mass=[p for p in powers if p['grid'].logMh_min is None]
+    assert len(all_mass)==1,'need one measurement with all halos'
+    bins=[p for p in powers if p['grid'].logMh_min is not None]
+    return all_mass[0],sorted(bins,key=_get_logMh)
+
+
+def _get_logMh(power):
+    grid=power['grid']
+    return 0.5*(grid.logMh_min+grid.logMh_max)
+
+
+def build_tables(catalog=None,linear_model=None,exclude=()):
+    """Compute emulator tables from the measurements, and return them as
+        a dictionary of arrays (that can be stored with np.savez).
+        - exclude: list of grids not to use (for leave-one-out tests)"""
+
+    if catalog is None:
+        catalog=power_catalog.PowerCatalog(power_types=likelihood_p3d.P3D_TYPES)
+    if linear_model is None:
+        linear_model=model_density.get_linear_density_model()
+    exclude=set(exclude)
+
+    tables={}
+    sources=[]
+    for power_type in likelihood_p3d.P3D_TYPES:
+        powers=[p for p in _get_evolution_powers(catalog,power_type)
+                    if p['grid'] not in exclude]
+        table,lnk=_fill_tables(powers,linear_model)
+        tables['evol_z_'+power_type]=np.array([p['grid'].get_z()
+                    for p in powers])
+        tables['evol_lnk_'+power_type]=lnk
+        tables['evol_table_'+power_type]=table
+        if power_type=='halo_p3d':
+            tables['evol_shot']=np.array([p['shot_noise'] for p in powers])
+        sources+=[catalog.fnames[power_catalog.get_power_key(p['grid'],
+                    power_type)] for p in powers]
+
+        if power_type not in MASS_TYPES:
+            continue
+        all_mass,bins=_get_mass_powers(catalog,power_type)
+        bins=[p for p in bins if p['grid'] not in exclude]
+        table,lnk=_fill_tables([all_mass]+bins,linear_model)
+        tables['mass_logMh_'+power_type]=np.array([_get_logMh(p)
+                    for p in bins])
+        tables['mass_lnk_'+power_type]=lnk
+        # ratio to the power of all halos
+        tables['mass_table_'+power_type]=table[1:]/table[0]
+        if power_type=='halo_p3d':
+            tables['mass_shot']=np.array([p['shot_noise']
+                    for p in bins])/all_mass['shot_noise']
+        sources+=[catalog.fnames[power_catalog.get_power_key(p['grid'],
+                    power_type)] for p in [all_mass]+bins]
+
+    # input files, to check whether stored tables are up to date
+    tables['sources']=np.array(json.dumps({fname:os.stat(fname).st_mtime_ns
+                    for fname in sources}))
+    return tables
+
+
+def get_default_fname():
+    return measured_power.get_repo_dir()+'/data/p3d_emulator.npz'
+
+
+def is_up_to_date(tables):
+    """Whether all input files of stored tables are unchanged"""
+
+    sources=json.loads(str(tables['sources']))
+    for fname,mtime in sources.items():
+        if not os.path.exists(fname) or os.stat(fname).st_mtime_ns!=mtime:
+            return False
+    return True
+
+
+class P3DEmulator(object):
+    """Interpolate flux, cross and halo P3D to any redshift (between the
+        snapshots), halo mass (between the centers of the mass bins) and
+        (k,mu), from precomputed tables (see build_tables). Queries
+        broadcast arrays of z, k_hMpc, mu and logMh, and values outside of
+        the tables are kept constant. Inputs:
+      - tables: dictionary of arrays, from build_tables or a stored file
+      - linear_model: LinearDensityModel for the normalization"""
+
+    def __init__(self,tables,linear_model=None):
+
+        self.tables={key:np.asarray(value) for key,value in tables.items()}
+        if linear_model is None:
+            linear_model=model_density.get_linear_density_model()
+        self.linear_model=linear_model
+
+
+    def get_normalized(self,power_type,z,k_hMpc,mu,logMh=None):
+        """Normalized power (see get_normalized_power) at input points"""
+
+        lnk=np.log(k_hMpc)
+        mu=np.abs(mu)
+        table=self.tables['evol_table_'+power_type]
+        nodes=[self.tables['evol_z_'+power_type],
+                self.tables['evol_lnk_'+power_type],
+                rebin_power.get_mu_centers(table.shape[2])]
+        value=_interp_log(table,nodes,[z,lnk,mu])
+        if logMh is not None and power_type in MASS_TYPES:
+            table=self.tables['mass_table_'+power_type]
+            nodes=[self.tables['mass_logMh_'+power_type],
+                    self.tables['mass_lnk_'+power_type],
+                    rebin_power.get_mu_centers(table.shape[2])]
+            value=value*_interp_log(table,nodes,[logMh,lnk,mu])
+        return value
+
+
+    def get_shot_noise(self,z,logMh=None):
+        """Shot noise of halo power, interpolated in ln(shot noise)"""
+
+        i,w=rebin_power.get_interp_index(self.tables['evol_z_halo_p3d'],z)
+        ln_shot=np.log(self.tables['evol_shot'])
+        j=np.minimum(i+1,len(ln_shot)-1)
+        ln_value=(1-w)*ln_shot[i]+w*ln_shot[j]
+        if logMh is not None:
+            i,w=rebin_power.get_interp_index(
+                        self.tables['mass_logMh_halo_p3d'],logMh)
+            ln_ratio=np.log(self.tables['mass_shot'])
+            j=np.minimum(i+1,len(ln_ratio)-1)
+            ln_value=ln_value+(1-w)*ln_ratio[i]+w*ln_ratio[j]
+        return np.exp(ln_value)
+
+
+    def get_p3d(self,power_type,z,k_hMpc,mu,logMh=None):
+        """Emulated power (including shot noise for halos).
+            - logMh: center of halo mass bin (None for all halos)"""
+
+        norm=get_normalization(self.linear_model,z,k_hMpc,mu)
+        P=norm*self.get_normalized(power_type,z,k_hMpc,mu,logMh)
+        if power_type=='halo_p3d':
+            P=P+self.get_shot_noise(z,logMh)
+        return P
+
+
+    def get_all(self,z,k_hMpc,mu,logMh=None):
+        """Dictionary with emulated power for all power types"""
+
+        return {pt:self.get_p3d(pt,z,k_hMpc,mu,logMh)
+                    for pt in likelihood_p3d.P3D_TYPES}
+
+
+def get_emulator(fname=None,rebuild=False,catalog=None):
+    """Return emulator, reading tables from fname (default in data/) if
+        they are up to date, or building and storing them otherwise"""
+
+    if fname is None:
+        fname=get_default_fname()
+    if not rebuild and os.path.exists(fname):
+        with np.load(fname) as data:
+            tables={key:data[key] for key in data.files}
+        if is_up_to_date(tables):
+            return P3DEmulator(tables)
+
+    tables=build_tables(catalog=catalog)
+    tmp_fname='{}.{}.tmp.npz'.format(os.path.splitext(fname)[0],os.getpid())
+    np.savez(tmp_fname,**tables)
+    os.replace(tmp_fname,fname)
+    return P3DEmulator(tables)
+
+
+def leave_one_out(catalog=None,linear_model=None):
+    """Accuracy of the interpolation in z and in mass: each inner node of
+        the tables is removed, and the normalized power interpolated from
+        the rest is compared with the measurement in its valid bins.
+        Returns list of dictionaries with the relative errors."""
+
+    if catalog is None:
+        catalog=power_catalog.PowerCatalog(power_types=likelihood_p3d.P3D_TYPES)
+    if linear_model is None:
+        linear_model=model_density.get_linear_density_model()
+
+    tests=[]
+    for power_type in likelihood_p3d.P3D_TYPES:
+        powers=_get_evolution_powers(catalog,power_type)
+        tests+=[('z',power_type,p) for p in powers[1:-1]]
+        if power_type in MASS_TYPES:
+            all_mass,bins=_get_mass_powers(catalog,power_type)
+            tests+=[('logMh',power_type,p) for p in bins[1:-1]]
+
+    report=[]
+    for series,power_type,power in tests:
+        grid=power['grid']
+        emulator=P3DEmulator(build_tables(catalog,linear_model,
+                    exclude=[grid]),linear_model=linear_model)
+        value,mask=get_normalized_power(power,linear_model)
+        k=power['k_hMpc'][mask]
+        mu=power['mu'][mask]
+        if series=='z':
+            coord=grid.get_z()
+            pred=emulator.get_normalized(power_type,coord,k,mu)
+            true=value[mask]
+        else:
+            # compare ratio to all halos (the emulator normalization)
+            coord=_get_logMh(power)
+            pred=(emulator.get_normalized(power_type,grid.get_z(),k,mu,coord)
+                    /emulator.get_normalized(power_type,grid.get_z(),k,mu))
+            all_mass,bins=_get_mass_powers(catalog,power_type)
+            all_value,all_mask=get_normalized_power(all_mass,linear_model)
+            true=value[mask]/all_value[mask]
+        rel_err=np.abs(pred/true-1)
+        # relative Gaussian error of an auto-power, for reference
+        sigma=np.sqrt(2/power['counts'][mask])
+        finite=np.isfinite(rel_err)
+        report.append({'series':series,'power_type':power_type,
+                'nametag':grid.get_nametag(),'coord':coord,
+                'n_bins':int(finite.sum()),
+                'median_rel_err':float(np.median(rel_err[finite])),
+                'p90_rel_err':float(np.percentile(rel_err[finite],90)),
+                'median_err_over_sigma':float(np.median(
+                        (rel_err/sigma)[finite]))})
+    return report
+
+
+if __name__ == '__main__':
+    emulator=get_emulator(rebuild=True)
+    print('stored emulator tables in',get_default_fname())
+    print('leave-one-out validation (relative errors in valid bins):')
+    for row in leave_one_out():
+        print('  {:5s} {:9s} {:36s} {:6.2f} median {:.3f} p90 {:.3f}'
+                ' median/sigma {:.2f}'.format(row['series'],
+                row['power_type'],row['nametag'],row['coord'],
+                row['median_rel_err'],row['p90_rel_err'],
+                row['median_err_over_sigma']))
@@ -0,0 +1,328 @@
+import os
+import sys
+import glob
+import json
+from collections import deque
+import numpy as np
+import measured_power
+
+# columns that are constant for each measurement (dictionary-encoded)
+CONFIG_COLUMNS=['power_type','L_hMpc','n_part','snapshot_num','axis','n_xy',
+            'n_z','logMh_min','logMh_max','add_rsd','shot_noise','mean_flux',
+            'n_k_bins','n_mu_bins','k_hMpc_max']
+# columns with one value per (k,mu) bin. For P1D, k is k_parallel, and mu
+# and counts are NaN. i_mu is -1 for one-dimensional arrays.
+ROW_COLUMNS=['i_k','i_mu','k_hMpc','mu','power','counts']
+
+
+def get_config(power):
+    """Dictionary with config columns of a measurement (None if missing)"""
+
+    grid=power['grid']
+    config={'power_type':power['power_type'],'L_hMpc':grid.sim.L_hMpc,
+            'n_part':grid.sim.n_part,'snapshot_num':grid.snapshot_num,
+            'axis':grid.axis,'n_xy':grid.n_xy,'n_z':grid.n_z}
+    for key in CONFIG_COLUMNS:
+        if key not in config:
+            config[key]=getattr(grid,key,power.get(key))
+    return config
+
+
+def flatten_power(power):
+    """Return dictionary of row columns (1D arrays) for a measurement"""
+
+    if power['power_type']=='flux_p1d':
+        k=power['kp_hMpc']
+        P=power['p1d_hMpc']
+        mu=np.full(k.shape,np.nan)
+        counts=np.full(k.shape,np.nan)
+    else:
+        k=power['k_hMpc']
+        P=power['p3d_hMpc']
+        mu=power['mu']
+        counts=power['counts']
+
+    # indices of each bin, computed for all of them at once
+    indices=np.indices(k.shape).reshape(k.ndim,-1)
+    i_k=indices[0]
+    i_mu=indices[1] if k.ndim>1 else np.full(k.size,-1)
+    return {'i_k':i_k,'i_mu':i_mu,'k_hMpc':k.ravel(),'mu':mu.ravel(),
+            'power':P.ravel(),'counts':counts.ravel()}
+
+
+def _encode(values,counts):
+    """Dictionary-encode values, each one repeated counts times.
+        Returns (codes,categories)."""
+
+    categories=[]
+    index={}
+    segment_codes=np.empty(len(values),dtype=np.int32)
+    for i,value in enumerate(values):
+        key=json.dumps(value)
+        if key not in index:
+            index[key]=len(categories)
+            categories.append(value)
+        segment_codes[i]=index[key]
+    return np.repeat(segment_codes,counts),categories
+
+
+def iter_chunks(data_dir=None,chunk_rows=65536):
+    """Generator of chunks (dictionaries of columns) of the long-format
+        table, with up to chunk_rows rows. Files are read one at a time,
+        so memory is bounded by the chunk size (and one measurement).
+        Config columns are returned as (codes,categories) tuples."""
+
+    # rows (and config of each measurement) waiting to be yielded
+    pending=deque()
+    n_pending=0
+
+    def _make_chunk(n_rows):
+        nonlocal n_pending
+        chunk={key:[] for key in ROW_COLUMNS}
+        # configs of each segment of rows (and number of rows in segment)
+        configs=[]
+        counts=[]
+        n=0
+        while n<n_rows:
+            config,rows=pending[0]
+            n_use=min(n_rows-n,len(rows['i_k']))
+            for key in ROW_COLUMNS:
+                chunk[key].append(rows[key][:n_use])
+            configs.append(config)
+            counts.append(n_use)
+            n+=n_use
+            if n_use==len(rows['i_k']):
+                pending.popleft()
+            else:
+                pending[0]=(config,{key:rows[key][n_use:] for key in rows})
+        n_pending-=n_rows
+        chunk={key:np.concatenate(chunk[key]) for key in ROW_COLUMNS}
+        for key in CONFIG_COLUMNS:
+            chunk[key]=_encode([config[key] for config in configs],counts)
+        return chunk
+
+    backend=measured_power.get_data_backend(data_dir)
+    for power_type,relpath in backend.list_files():
+        power=backend.read_file(relpath,power_type)
+        rows=flatten_power(power)
+        pending.append((get_config(power),rows))
+        n_pending+=len(rows['i_k'])
+        while n_pending>=chunk_rows:
+            yield _make_chunk(chunk_rows)
+
+    if n_pending>0:
+        yield _make_chunk(n_pending)
+
+
+def _decode(codes,categories):
+    """Inverse of _encode, returning list of values"""
+
+    return [categories[code] for code in codes]
+
+
+# value types of config columns in Parquet (same schema for all chunks)
+PARQUET_TYPES={'power_type':'string','L_hMpc':'int64','n_part':'int64',
+            'snapshot_num':'int64','axis':'int64','n_xy':'int64',
+            'n_z':'int64','logMh_min':'float64','logMh_max':'float64',
+            'add_rsd':'bool','shot_noise':'float64','mean_flux':'float64',
+            'n_k_bins':'int64','n_mu_bins':'int64','k_hMpc_max':'float64'}
+
+
+def _write_parquet(chunks,fname):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    writer=None
+    for chunk in chunks:
+        columns={}
+        for key in CONFIG_COLUMNS:
+            codes,categories=chunk[key]
+            # missing values (None) are stored as null indices
+            valid=[c is not None for c in categories]
+            new_code=np.cumsum(valid)-1
+            mask=~np.array(valid)[codes]
+            indices=pa.array(new_code[codes],type=pa.int32(),mask=mask)
+            dictionary=pa.array([c for c in categories if c is not None],
+                                type=PARQUET_TYPES[key])
+            columns[key]=pa.DictionaryArray.from_arrays(indices,dictionary)
+        for key in ROW_COLUMNS:
+            columns[key]=pa.array(chunk[key])
+        table=pa.table(columns)
+        if writer is None:
+            writer=pq.ParquetWriter(fname,table.schema)
+        # each chunk is written as a separate row group
+        writer.write_table(table)
+    if writer is not None:
+        writer.close()
+
+
+def _write_npz(chunks,out_dir):
+    os.makedirs(out_dir,exist_ok=True)
+    for i,chunk in enumerate(chunks):
+        arrays={key:chunk[key] for key in ROW_COLUMNS}
+        for key in CONFIG_COLUMNS:
+            codes,categories=chunk[key]
+            arrays[key]=codes
+            arrays[key+'__categories']=np.array([json.dumps(c)
+                                                    for c in categories])
+        np.savez(os.path.join(out_dir,'part-{:05d}.npz'.format(i)),**arrays)
+
+
+def _write_csv(chunks,fname):
+    with open(fname,'w') as f:
+        f.write(','.join(CONFIG_COLUMNS+ROW_COLUMNS)+'\n')
+        for chunk in chunks:
+            columns=[_decode(*chunk[key]) for key in CONFIG_COLUMNS]
+            columns+=[chunk[key].tolist() for key in ROW_COLUMNS]
+            for row in zip(*columns):
+                f.write(','.join(json.dumps(v) for v in row)+'\n')
+
+
+def get_default_format():
+    """Parquet if pyarrow is available, otherwise chunked npz files"""
+
+    try:
+        import pyarrow.parquet
+        return 'parquet'
+    except ImportError:
+        return 'npz'
+
+
+def export_suite(path,fmt=None,data_dir=None,chunk_rows=65536):
+    """Export all measurements to long-format table in path.
+        - fmt: 'parquet' (single file), 'npz' (folder with one file per
+          chunk) or 'csv' (single file). Default: get_default_format()"""
+
+    if fmt is None:
+        fmt=get_default_format()
+    chunks=iter_chunks(data_dir=data_dir,chunk_rows=chunk_rows)
+    if fmt=='parquet':
+        _write_parquet(chunks,path)
+    elif fmt=='npz':
+        _write_npz(chunks,path)
+    elif fmt=='csv':
+        _write_csv(chunks,path)
+    else:
+        raise ValueError('unknown format',fmt)
+    return path
+
+
+def _csv_chunk(names,lines):
+    """Convert list of CSV lines into a chunk of columns"""
+
+    columns=list(zip(*[[json.loads(v) for v in line.split(',')]
+                            for line in lines]))
+    chunk={}
+    for name,column in zip(names,columns):
+        if name in ROW_COLUMNS:
+            chunk[name]=np.array(column,dtype=float)
+        else:
+            chunk[name]=list(column)
+    for key in ['i_k','i_mu']:
+        chunk[key]=chunk[key].astype(int)
+    return chunk
+
+
+def iter_exported_chunks(path,chunk_rows=65536):
+    """Generator of chunks read back from an exported table, with config
+        columns decoded to lists of values"""
+
+    if os.path.isdir(path):
+        for fname in sorted(glob.glob(os.path.join(path,'part-*.npz'))):
+            with np.load(fname) as data:
+                chunk={key:data[key] for key in ROW_COLUMNS}
+                for key in CONFIG_COLUMNS:
+                    categories=[json.loads(c)
+                                for c in data[key+'__categories']]
+                    chunk[key]=_decode(data[key],categories)
+            yield chunk
+    elif path.endswith('.csv'):
+        with open(path) as f:
+            names=f.readline().strip().split(',')
+            lines=[]
+            for line in f:
+                lines.append(line)
+                if len(lines)==chunk_rows:
+                    yield _csv_chunk(names,lines)
+                    lines=[]
+            if lines:
+                yield _csv_chunk(names,lines)
+    else:
+        import pyarrow.parquet as pq
+        parquet=pq.ParquetFile(path)
+        for i in range(parquet.num_row_groups):
+            table=parquet.read_row_group(i)
+            chunk={key:table.column(key).to_numpy() for key in ROW_COLUMNS}
+            for key in CONFIG_COLUMNS:
+                chunk[key]=table.column(key).to_pylist()
+            yield chunk
+
+
+def _get_header(config):
+    """Dictionary with FITS header keywords, from config values"""
+
+    header={'L_HMPC':config['L_hMpc'],'N_PART':config['n_part'],
+            'SNAPSHOT_NUM':config['snapshot_num'],'N_XY':config['n_xy'],
+            'N_Z':config['n_z'],'AXIS':config['axis'],
+            'LOGMH_MIN':config['logMh_min'],'LOGMH_MAX':config['logMh_max'],
+            'ADD_RSD':config['add_rsd'],'SHOT_NOISE':config['shot_noise'],
+            'MEAN_FLUX':config['mean_flux'],'N_K_BINS':config['n_k_bins'],
+            'N_MU_BINS':config['n_mu_bins'],'K_HMPC_MAX':config['k_hMpc_max']}
+    return header
+
+
+def import_suite(path):
+    """Read exported table, and return dictionary of power dictionaries
+        (same format as read_fits_power) indexed by (power_type,grid)"""
+
+    # collect rows of each measurement (might be split across chunks)
+    rows={}
+    for chunk in iter_exported_chunks(path):
+        keys=list(zip(*[chunk[key] for key in CONFIG_COLUMNS]))
+        # split chunk into groups of consecutive rows from same measurement
+        starts=[0]+[i for i in range(1,len(keys)) if keys[i]!=keys[i-1]]
+        ends=starts[1:]+[len(keys)]
+        for start,end in zip(starts,ends):
+            key=keys[start]
+            rows.setdefault(key,[]).append({col:chunk[col][start:end]
+                                                for col in ROW_COLUMNS})
+
+    suite={}
+    for key,parts in rows.items():
+        config=dict(zip(CONFIG_COLUMNS,key))
+        power_type=config['power_type']
+        power=measured_power.get_power_metadata(_get_header(config),
+                                                power_type)
+        cols={col:np.concatenate([p[col] for p in parts])
+                for col in ROW_COLUMNS}
+        # restore shape of arrays, (n_k,n_mu) or (n_k,)
+        i_k=cols['i_k'].astype(int)
+        i_mu=cols['i_mu'].astype(int)
+        if np.all(i_mu<0):
+            shape=(i_k.max()+1,)
+            index=(i_k,)
+        else:
+            shape=(i_k.max()+1,i_mu.max()+1)
+            index=(i_k,i_mu)
+        arrays={}
+        for col in ['k_hMpc','mu','power','counts']:
+            arrays[col]=np.full(shape,np.nan)
+            arrays[col][index]=cols[col]
+        if power_type=='flux_p1d':
+            power['kp_hMpc']=arrays['k_hMpc']
+            power['p1d_hMpc']=arrays['power']
+        else:
+            power['p3d_hMpc']=arrays['power']
+            power['k_hMpc']=arrays['k_hMpc']
+            power['mu']=arrays['mu']
+            power['counts']=arrays['counts']
+        suite[(power_type,power['grid'])]=power
+
+    return suite
+
+
+if __name__ == '__main__':
+    # export full suite: python export_power.py path [format]
+    path=sys.argv[1]
+    fmt=sys.argv[2] if len(sys.argv)>2 else None
+    export_suite(path,fmt=fmt)
+    print('exported suite to',path)
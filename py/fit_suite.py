@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import power_catalog
+import likelihood_p3d
+import model_p3d
+
+# columns in the table of results
+RESULT_KEYS=['nametag','L_hMpc','n_part','snapshot_num','axis','n_xy','n_z',
+            'logMh_min','logMh_max','z','b_F','beta_F','b_H','chi2','n_data']
+
+# data and model, set up only once in each worker process
+_catalog=None
+_model=None
+
+
+def _init_worker(data_dir):
+    """Load measurements and linear power (once per worker process)"""
+
+    global _catalog,_model
+    _catalog=power_catalog.PowerCatalog(data_dir=data_dir,
+                power_types=likelihood_p3d.P3D_TYPES)
+    _model=model_p3d.KaiserModel()
+
+
+def get_suite_configs(catalog):
+    """List of HaloGrid objects with flux, cross and halo measurements"""
+
+    configs=[]
+    for power in catalog.select('cross_p3d'):
+        halos=power['grid']
+        skewers=likelihood_p3d.get_skewers_from_halos(halos)
+        if (power_catalog.get_power_key(halos,'halo_p3d') in catalog and
+            power_catalog.get_power_key(skewers,'flux_p3d') in catalog):
+            configs.append(halos)
+    return configs
+
+
+def scan_parameters(like,z,shot_noise,ranges,n_grid=16,n_refine=3):
+    """Find best-fit (b_F,beta_F,b_H) with a vectorized grid search,
+        zooming in around the best point a few times"""
+
+    prior=np.array(ranges,dtype=float)
+    ranges=prior.copy()
+    for it in range(n_refine+1):
+        axes=[np.linspace(vmin,vmax,n_grid) for vmin,vmax in ranges]
+        b_F,beta_F,b_H=[p.ravel() for p in np.meshgrid(*axes,indexing='ij')]
+        models=[_model.get_p3d(z,k,mu,b_F,beta_F,b_H,shot_noise=shot_noise)
+                    for k,mu in zip(like.k_hMpc,like.mu)]
+        chi2=like.get_chi2(like.get_vector_from_bins(models))
+        best=np.nanargmin(chi2)
+        best_params=np.array([b_F[best],beta_F[best],b_H[best]])
+        # zoom in, keeping two grid cells on each side of the best point
+        width=2*(ranges[:,1]-ranges[:,0])/(n_grid-1)
+        ranges=np.stack([np.maximum(best_params-width,prior[:,0]),
+                         np.minimum(best_params+width,prior[:,1])],axis=1)
+
+    return best_params,chi2[best]
+
+
+def fit_config(halos,k_max_hMpc):
+    """Fit linear model to flux, cross and halo power of a configuration"""
+
+    like=likelihood_p3d.JointLikelihood([halos],catalog=_catalog,
+                k_max_hMpc=k_max_hMpc)
+    shot_noise=_catalog.get_power(halos,'halo_p3d')['shot_noise']
+    z=halos.get_z()
+    # prior ranges for b_F, beta_F and b_H
+    ranges=[[-0.5,0.0],[0.0,3.0],[0.5,8.0]]
+    params,chi2=scan_parameters(like,z,shot_noise,ranges)
+
+    result={'nametag':halos.get_nametag(),'L_hMpc':halos.sim.L_hMpc,
+            'n_part':halos.sim.n_part,'snapshot_num':halos.snapshot_num,
+            'axis':halos.axis,'n_xy':halos.n_xy,'n_z':halos.n_z,
+            'logMh_min':halos.logMh_min,'logMh_max':halos.logMh_max,'z':z,
+            'b_F':params[0],'beta_F':params[1],'b_H':params[2],
+            'chi2':chi2,'n_data':like.n_data}
+    # make sure values can be written to JSON
+    return {key:(value.item() if isinstance(value,np.generic) else value)
+                for key,value in result.items()}
+
+
+def read_checkpoint(fname):
+    """Return results already stored in checkpoint file (JSON lines)"""
+
+    results={}
+    if os.path.exists(fname):
+        with open(fname) as f:
+            for line in f:
+                # ignore a line that might have been cut by an interruption
+                try:
+                    result=json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                results[result['nametag']]=result
+    return results
+
+
+def fit_suite(checkpoint_fname,workers=4,k_max_hMpc=0.5,data_dir=None):
+    """Fit all configurations in the suite, using a pool of processes.
+        Results are appended to checkpoint_fname as they are completed,
+        and configurations already there are not fitted again."""
+
+    # enumerate configurations (in the main process)
+    _init_worker(data_dir)
+    configs=get_suite_configs(_catalog)
+    results=read_checkpoint(checkpoint_fname)
+    todo=[halos for halos in configs if halos.get_nametag() not in results]
+    print('{} configurations, {} already fitted'.format(len(configs),
+                len(configs)-len(todo)))
+
+    t0=time.perf_counter()
+    with open(checkpoint_fname,'a') as checkpoint:
+        with ProcessPoolExecutor(max_workers=workers,initializer=_init_worker,
+                    initargs=(data_dir,)) as pool:
+            futures={pool.submit(fit_config,halos,k_max_hMpc):halos
+                        for halos in todo}
+            for future in as_completed(futures):
+                halos=futures[future]
+                try:
+                    result=future.result()
+                except Exception as err:
+                    print('failed',halos.get_nametag(),err)
+                    continue
+                checkpoint.write(json.dumps(result)+'\n')
+                checkpoint.flush()
+                results[result['nametag']]=result
+                print('fitted {} ({:.1f} s)'.format(result['nametag'],
+                            time.perf_counter()-t0))
+
+    # single table, sorted by configuration
+    return [results[nametag] for nametag in sorted(results)]
+
+
+def write_table(results,fname):
+    """Write table of results as CSV"""
+
+    with open(fname,'w') as f:
+        f.write(','.join(RESULT_KEYS)+'\n')
+        for result in results:
+            f.write(','.join(str(result[key]) for key in RESULT_KEYS)+'\n')
+
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(
+                description='Fit linear model to all configurations')
+    parser.add_argument('--workers',type=int,default=4)
+    parser.add_argument('--k-max',type=float,default=0.5,
+                help='maximum wavenumber in fits (h/Mpc)')
+    parser.add_argument('--checkpoint',default='fit_suite.jsonl')
+    parser.add_argument('--output',default='fit_suite.csv')
+    parser.add_argument('--data-dir',default=None)
+    args=parser.parse_args()
+
+    results=fit_suite(args.checkpoint,workers=args.workers,
+                k_max_hMpc=args.k_max,data_dir=args.data_dir)
+    write_table(results,args.output)
+    print('wrote',len(results),'results to',args.output)
@@ -0,0 +1,131 @@
+import os
+import time
+import threading
+import contextlib
+
+# Opt-in timing of the stages in reading measurements and evaluating the
+# linear power. Disabled by default; enable it for the whole process by
+# setting the environment variable SHERWOOD_PROFILE, or temporarily with
+#     with instrument.profile() as stats:
+#         ...
+#     print(stats.summary())
+# When disabled, each instrumented stage only costs a flag check.
+enabled=bool(os.environ.get('SHERWOOD_PROFILE'))
+
+
+class Stats(object):
+    """Number of calls, cumulative and max duration of each stage, and
+        bytes read from each file"""
+
+    def __init__(self):
+        # stage name -> [count, total seconds, max seconds]
+        self.stages={}
+        # filename -> bytes read
+        self.bytes_read={}
+        # stages can be recorded from several threads (e.g., read_many)
+        self.lock=threading.Lock()
+
+
+    def reset(self):
+        with self.lock:
+            self.stages.clear()
+            self.bytes_read.clear()
+
+
+    def add_time(self,name,dt):
+        with self.lock:
+            entry=self.stages.get(name)
+            if entry is None:
+                self.stages[name]=[1,dt,dt]
+            else:
+                entry[0]+=1
+                entry[1]+=dt
+                if dt>entry[2]:
+                    entry[2]=dt
+
+
+    def add_bytes(self,fname,nbytes):
+        with self.lock:
+            self.bytes_read[fname]=self.bytes_read.get(fname,0)+nbytes
+
+
+    def get(self,name):
+        """Dictionary with count, total_s, max_s and mean_s of a stage"""
+
+        count,total,max_dt=self.stages.get(name,[0,0.0,0.0])
+        mean=total/count if count>0 else 0.0
+        return {'count':count,'total_s':total,'max_s':max_dt,'mean_s':mean}
+
+
+    def as_dict(self):
+        """All stats as a (JSON serializable) dictionary"""
+
+        return {'stages':{name:self.get(name) for name in sorted(self.stages)},
+                'bytes_read':dict(self.bytes_read)}
+
+
+    def get_total_bytes(self):
+        return sum(self.bytes_read.values())
+
+
+    def summary(self):
+        """One-line report, with stages sorted by cumulative time"""
+
+        names=sorted(self.stages,key=lambda name:-self.stages[name][1])
+        parts=['{} {}x {:.2f}ms (max {:.2f}ms)'.format(name,
+                    self.stages[name][0],1e3*self.stages[name][1],
+                    1e3*self.stages[name][2]) for name in names]
+        parts.append('{:.1f} KiB read from {} files'.format(
+                    self.get_total_bytes()/1024,len(self.bytes_read)))
+        return '; '.join(parts)
+
+
+# stats collected in this process
+stats=Stats()
+
+
+class _Stage(object):
+    __slots__=('name','t0')
+
+    def __init__(self,name):
+        self.name=name
+
+    def __enter__(self):
+        self.t0=time.perf_counter()
+        return self
+
+    def __exit__(self,*args):
+        stats.add_time(self.name,time.perf_counter()-self.t0)
+
+
+_null_stage=contextlib.nullcontext()
+
+
+def stage(name):
+    """Context manager timing a stage (does nothing if disabled)"""
+
+    if not enabled:
+        return _null_stage
+    return _Stage(name)
+
+
+def add_bytes(fname,nbytes):
+    """Record bytes read from a file (does nothing if disabled)"""
+
+    if enabled:
+        stats.add_bytes(fname,nbytes)
+
+
+@contextlib.contextmanager
+def profile(reset=True):
+    """Enable instrumentation within the context, and yield stats object"""
+
+    global enabled
+    previous=enabled
+    if reset:
+        stats.reset()
+    enabled=True
+    try:
+        yield stats
+    finally:
+        enabled=previous
@@ -1,6 +1,8 @@
 import numpy as np
 import os
+from collections import OrderedDict
 import sherwood_simulation as she_sim
+import instrument
 
 def f_of_z(z):
     """Get the dimensionless linear growth rate for a snapshot redshift."""
@@ -10,35 +12,187 @@ def f_of_z(z):
     return growth_rates[z]
 
 
-class PowerInterpolator(object):
-    """Stores power at one redshift, and interpolates."""
+def solve_tridiagonal(lower,diag,upper,rhs):
+    """Solve tridiagonal system (Thomas algorithm), given the sub-diagonal
+        (n-1), diagonal (n) and super-diagonal (n-1) of the matrix"""
+
+    n=len(diag)
+    c=np.empty(n-1)
+    d=np.empty(n)
+    c[0]=upper[0]/diag[0]
+    d[0]=rhs[0]/diag[0]
+    for i in range(1,n):
+        denom=diag[i]-lower[i-1]*c[i-1]
+        if i<n-1:
+            c[i]=upper[i]/denom
+        d[i]=(rhs[i]-lower[i-1]*d[i-1])/denom
+    x=d
+    for i in range(n-2,-1,-1):
+        x[i]-=c[i]*x[i+1]
+    return x
+
+
+def natural_spline_coefficients(x,y):
+    """Coefficients (n-1,4) of natural cubic spline through (x,y) nodes.
+        In interval i, y = c0 + c1*t + c2*t**2 + c3*t**3, with t=x-x[i]."""
+
+    n=len(x)
+    h=np.diff(x)
+    slope=np.diff(y)/h
+
+    # tridiagonal system for second derivatives (zero at both ends)
+    lower=np.zeros(n-1)
+    diag=np.ones(n)
+    upper=np.zeros(n-1)
+    rhs=np.zeros(n)
+    lower[:-1]=h[:-1]
+    diag[1:-1]=2*(h[:-1]+h[1:])
+    upper[1:]=h[1:]
+    rhs[1:-1]=6*(slope[1:]-slope[:-1])
+    M=solve_tridiagonal(lower,diag,upper,rhs)
+
+    coeffs=np.empty([n-1,4])
+    coeffs[:,0]=y[:-1]
+    coeffs[:,1]=slope-h*(2*M[:-1]+M[1:])/6
+    coeffs[:,2]=M[:-1]/2
+    coeffs[:,3]=(M[1:]-M[:-1])/(6*h)
+    return coeffs
 
-    def __init__(self,fname):
-        """Read file containing power at a given redshift."""
 
-        # read data from file (in units of Mpc/h)
+def read_linear_power(fname,use_cache=False):
+    """Return ln(k) and ln(P) from text file with linear power (in Mpc/h).
+        If use_cache, the arrays are cached in a binary file next to the
+        text file, that is used instead as long as the text file is not
+        modified (only used for the tables in data/linear_pk)."""
+
+    if not use_cache:
         data=np.loadtxt(fname)
-        k=data[:,0]
-        P=data[:,1]
+        return np.log(data[:,0]),np.log(data[:,1])
+
+    stat=os.stat(fname)
+    cache_fname=os.path.splitext(fname)[0]+'.npz'
+    try:
+        with np.load(cache_fname) as cache:
+            if (cache['mtime_ns']==stat.st_mtime_ns
+                    and cache['size']==stat.st_size):
+                return cache['lnk'],cache['lnP']
+    except (OSError,KeyError,ValueError):
+        # missing or corrupted cache
+        pass
+
+    lnk,lnP=read_linear_power(fname,use_cache=False)
+
+    # write cache atomically (several processes might be doing the same),
+    # and keep going if the folder is not writable
+    tmp_fname='{}.{}.tmp.npz'.format(os.path.splitext(fname)[0],os.getpid())
+    try:
+        np.savez(tmp_fname,lnk=lnk,lnP=lnP,mtime_ns=stat.st_mtime_ns,
+                    size=stat.st_size)
+        os.replace(tmp_fname,cache_fname)
+    except OSError:
+        pass
+
+    return lnk,lnP
+
+
+def read_class_params(fname):
+    """Read CLASS parameter file (key = value), to keep track of provenance"""
+
+    params={}
+    with open(fname) as f:
+        for line in f:
+            line=line.split('#')[0].strip()
+            if '=' not in line:
+                continue
+            key,value=line.split('=',1)
+            params[key.strip()]=value.strip()
+
+    return params
+
+
+class PowerInterpolator(object):
+    """Stores power at one redshift, and interpolates. Inputs:
+      - fname: text file with (k,P) columns
+      - method: 'linear' (default, np.interp in ln k) or 'spline' (natural
+        cubic spline in ln k)
+      - memo_size: number of k arrays for which to remember the result
+        (0 to disable). Memoized results are returned as read-only.
+      - use_cache: cache the table in a binary file next to fname (see
+        read_linear_power)"""
+
+    def __init__(self,fname,method='linear',memo_size=0,use_cache=False):
+        """Read file containing power at a given redshift."""
 
         # we will do the interpolation in log(k), log(P)
-        self.lnk=np.log(k)
-        self.lnP=np.log(P)
+        self.lnk,self.lnP=read_linear_power(fname,use_cache=use_cache)
 
-    def P_hMpc(self,k_hMpc):
-        """Interpolate power to input wavenumber k_hMpc"""
+        # precompute tables needed by the interpolation method
+        self.method=method
+        if method=='spline':
+            self.spline_coeffs=natural_spline_coefficients(self.lnk,self.lnP)
+        else:
+            assert method=='linear','unknown interpolation method '+method
+
+        # remember results for arrays of k (e.g., fixed measurement grids)
+        self.memo_size=memo_size
+        self.memo=OrderedDict()
+
+
+    def _interp_spline(self,lnk):
+        """Evaluate cubic spline (constant outside of the table)"""
+
+        lnk=np.clip(lnk,self.lnk[0],self.lnk[-1])
+        i=np.clip(np.searchsorted(self.lnk,lnk,side='right')-1,0,
+                    len(self.lnk)-2)
+        t=lnk-self.lnk[i]
+        c=self.spline_coeffs[i]
+        return c[...,0]+t*(c[...,1]+t*(c[...,2]+t*c[...,3]))
+
+
+    def _P_hMpc(self,k_hMpc):
 
         # interpolator works in ln(k)
         lnk = np.log(k_hMpc)
-        lnP = np.interp(lnk,self.lnk,self.lnP)
+        if self.method=='spline':
+            lnP = self._interp_spline(lnk)
+        else:
+            lnP = np.interp(lnk,self.lnk,self.lnP)
         return np.exp(lnP)
 
 
+    def P_hMpc(self,k_hMpc):
+        """Interpolate power to input wavenumber k_hMpc"""
+
+        if instrument.enabled:
+            with instrument.stage('PowerInterpolator.P_hMpc'):
+                return self._P_hMpc_memo(k_hMpc)
+        return self._P_hMpc_memo(k_hMpc)
+
+
+    def _P_hMpc_memo(self,k_hMpc):
+
+        if self.memo_size==0 or not isinstance(k_hMpc,np.ndarray):
+            return self._P_hMpc(k_hMpc)
+
+        # key on the content of the array, not on its identity
+        key=(k_hMpc.shape,k_hMpc.dtype.str,k_hMpc.tobytes())
+        if key in self.memo:
+            self.memo.move_to_end(key)
+            return self.memo[key]
+        P=self._P_hMpc(k_hMpc)
+        P.flags.writeable=False
+        self.memo[key]=P
+        if len(self.memo)>self.memo_size:
+            self.memo.popitem(last=False)
+        return P
+
+
 class LinearDensityModel(object):
     """Object describing the linear density power spectrum at all redshifts."""
 
-    def __init__(self):
-        """Set up model to describe the linear power spectrum."""
+    def __init__(self,interp_method='linear',memo_size=0):
+        """Set up model to describe the linear power spectrum.
+            - interp_method, memo_size: passed to PowerInterpolator """
 
         # make sure the environmental variable is set
         assert ('SHERWOOD' in os.environ),'Define SHERWOOD'
@@ -47,12 +201,30 @@ class LinearDensityModel(object):
         # base directory with linear power files
         basedir+='/data/linear_pk/'
 
+        # cosmological parameters used to compute the linear power
+        self.params=read_class_params(basedir+'/params.ini')
+
         # dictionary containing linear power for all snapshots
         self.linP={}
 
         for snap in range(8,12):
             fname=basedir+'/lin_{}.dat'.format(snap)
-            self.linP[snap]=PowerInterpolator(fname)
+            self.linP[snap]=PowerInterpolator(fname,method=interp_method,
+                        memo_size=memo_size,use_cache=True)
+
+        # stack all tables (on a common ln(k) grid) for batched evaluation
+        self.interp_method=interp_method
+        self.snaps=sorted(self.linP.keys())
+        self.redshifts=np.array([she_sim.redshift_from_snapshot(snap)
+                        for snap in self.snaps])
+        self.lnk=self.linP[self.snaps[0]].lnk
+        for snap in self.snaps:
+            assert np.array_equal(self.linP[snap].lnk,self.lnk),(
+                        'linear power tables with different k grids')
+        self.lnP_table=np.stack([self.linP[snap].lnP for snap in self.snaps])
+        if interp_method=='spline':
+            self.spline_table=np.stack([self.linP[snap].spline_coeffs
+                        for snap in self.snaps])
 
 
     def linP_hMpc(self,z,k_hMpc):
@@ -60,6 +232,14 @@ class LinearDensityModel(object):
             - z: input redshift (must correspond to one of the files read)
             - k_hMpc: input wavenumber or (array) in h/Mpc. """
 
+        if instrument.enabled:
+            with instrument.stage('LinearDensityModel.linP_hMpc'):
+                return self._linP_hMpc(z,k_hMpc)
+        return self._linP_hMpc(z,k_hMpc)
+
+
+    def _linP_hMpc(self,z,k_hMpc):
+
         # make sure input redshift is in the dictionary
         snap=she_sim.snapshot_from_redshift(z)
         assert snap in self.linP,'input snapshot not in list '+str(snap)
@@ -67,3 +247,58 @@ class LinearDensityModel(object):
         # interpolate linear power to input wavenumber (in Mpc/h)
         return self.linP[snap].P_hMpc(k_hMpc)
 
+
+
+    def linP_hMpc_batch(self,z,k_hMpc):
+        """ Compute linear power for arrays of redshifts and wavenumbers.
+            - z: redshift or array of redshifts (each one must correspond
+                to one of the files read), broadcastable against k_hMpc
+            - k_hMpc: array of wavenumbers in h/Mpc, of any shape (e.g.,
+                the full (n_k,n_mu) grid of a P3D measurement)
+            Returns array with the broadcast shape of z and k_hMpc.
+            Uses the same interpolation method as linP_hMpc."""
+
+        if instrument.enabled:
+            with instrument.stage('LinearDensityModel.linP_hMpc_batch'):
+                return self._linP_hMpc_batch(z,k_hMpc)
+        return self._linP_hMpc_batch(z,k_hMpc)
+
+
+    def _linP_hMpc_batch(self,z,k_hMpc):
+
+        z=np.asarray(z,dtype=float)
+        lnk=np.log(np.asarray(k_hMpc,dtype=float))
+
+        # find row in table for each redshift
+        match=(z[...,np.newaxis]==self.redshifts)
+        assert np.all(np.any(match,axis=-1)),'input redshift not in list'
+        row=np.argmax(match,axis=-1)
+
+        # interpolation in ln(k), constant outside of the table
+        n_k=len(self.lnk)
+        lnk=np.clip(lnk,self.lnk[0],self.lnk[-1])
+        i=np.clip(np.searchsorted(self.lnk,lnk,side='right')-1,0,n_k-2)
+        # fancy indexing broadcasts rows (redshifts) against columns (k)
+        if self.interp_method=='spline':
+            t=lnk-self.lnk[i]
+            c=self.spline_table[row,i]
+            lnP=c[...,0]+t*(c[...,1]+t*(c[...,2]+t*c[...,3]))
+        else:
+            w=(lnk-self.lnk[i])/(self.lnk[i+1]-self.lnk[i])
+            lnP=(1.0-w)*self.lnP_table[row,i]+w*self.lnP_table[row,i+1]
+
+        return np.exp(lnP)
+
+
+# models shared within the process, indexed by their options
+_shared_models={}
+
+
+def get_linear_density_model(interp_method='linear',memo_size=0):
+    """Return LinearDensityModel shared by all callers in the process"""
+
+    key=(interp_method,memo_size)
+    if key not in _shared_models:
+        _shared_models[key]=LinearDensityModel(interp_method=interp_method,
+                                                memo_size=memo_size)
+    return _shared_models[key]
@@ -1,114 +1,126 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import sherwood_simulation as she_sim
 import measured_power
 
-# specify simulation from Sherwood suite
-L_hMpc=160
-n_part=2048
-label='L{}_N{}'.format(L_hMpc,n_part)
-sim = she_sim.SherwoodSimulation(L_hMpc=L_hMpc,n_part=n_part)
-
-# specify grid of skewers 
-snapshot_num=9
-n_xy=1024
-n_z=2048
-z=she_sim.redshift_from_snapshot(snapshot_num)
-# combined measurement
-axis=0
-skewers=she_sim.Grid(simulation=sim,snapshot_num=snapshot_num,
-                                n_xy=n_xy,n_z=n_z,axis=axis)
+# size of the figure made by render_measured_p3d
+FIGSIZE=[8,10]
 
-# specify grid of halos
-add_rsd=True
-
-# mass bin
-all_mass=True
-if all_mass:
-    logMh_min=None
-    logMh_max=None
-    mass_label='all'
-else:
-    logMh_min=11.5
-    logMh_max=14.0
-    mass_label='{}_{}'.format(logMh_min,logMh_max)
-halos=she_sim.HaloGrid(simulation=sim,snapshot_num=snapshot_num,
-                          logMh_min=logMh_min,logMh_max=logMh_max,
-                          n_xy=n_xy,n_z=n_z,axis=axis,add_rsd=add_rsd)
 
-# get P3D measurements (standard binning)
-data_F=measured_power.get_power_from_grid(grid=skewers,power_type="flux_p3d")
-data_X=measured_power.get_power_from_grid(grid=halos,power_type="cross_p3d")
-data_H=measured_power.get_power_from_grid(grid=halos,power_type="halo_p3d")
+def plot_p3d(data,ax,label,downsample=5):
+    """Plot k^3 P3D (with Gaussian errors) in every downsample mu bins"""
 
-# show only few mu bins
-downsample=5
-# short-cuts for convenience
-n_mu=data_F['n_mu_bins']
-cm=plt.get_cmap('jet')
-mu_bin_edges = np.linspace(0., 1.,n_mu + 1)
+    import matplotlib.pyplot as plt
+    # short-cuts for convenience
+    n_mu=data['n_mu_bins']
+    cm=plt.get_cmap('jet')
+    mu_bin_edges = np.linspace(0., 1.,n_mu + 1)
 
-def plot_p3d(data,ax,label):
+    # identify bins we want to keep in plot (all mu bins at once)
+    keep=measured_power.get_valid_mask(data)
+    # these are only approximated errorbars for cross-correlations!
+    error=measured_power.get_gaussian_error(data)
+    if data['power_type'] == 'cross_p3d':
+        P3D=-data['p3d_hMpc']
+        error=-error
+    elif data['power_type'] == 'halo_p3d':
+        P3D=measured_power.get_halo_power_no_shot_noise(data)
+    else:
+        P3D=data['p3d_hMpc']
+    kfac=data['k_hMpc']**3
     for i in range(0,n_mu,downsample):
         col=cm(i/n_mu)
-        # identify bins we want to keep in plot
-        nan_mask=np.isnan(data['mu'][:,i])
-        kmax_mask=data['k_hMpc'][:,i][~nan_mask] > data['k_hMpc_max']
-        keep=~nan_mask
-        keep[~nan_mask]=~kmax_mask
-        k=data['k_hMpc'][:,i][keep]
-        mu=data['mu'][:,i][keep]
         if data['power_type'] == 'cross_p3d':
-            P3D=-data['p3d_hMpc'][:,i][keep]
             mu_label=r"%.2f $\leq \mu \leq$ %.2f" % (mu_bin_edges[i],
                                                         mu_bin_edges[i+1])
         else:
-            P3D=data['p3d_hMpc'][:,i][keep]
             mu_label=None
-        # these are only approximated errorbars for cross-correlations!
-        error=P3D/np.sqrt(0.5*data['counts'][:,i][keep])
-        if data['power_type'] == 'halo_p3d':
-            P3D-=data['shot_noise']
-        kfac=k**3
-        ax.fill_between(k,(P3D-error)*kfac,(P3D+error)*kfac,alpha=.3,
-                label=mu_label,color=col)
-        ax.plot(k,(P3D-error)*kfac,lw=3,alpha=.1,color=col)
-        ax.plot(k,(P3D+error)*kfac,lw=3,alpha=.1,color=col)
+        k=data['k_hMpc'][keep[:,i],i]
+        low=((P3D-error)*kfac)[keep[:,i],i]
+        high=((P3D+error)*kfac)[keep[:,i],i]
+        ax.fill_between(k,low,high,alpha=.3,label=mu_label,color=col)
+        ax.plot(k,low,lw=3,alpha=.1,color=col)
+        ax.plot(k,high,lw=3,alpha=.1,color=col)
         ax.set_xscale('log')
         ax.set_yscale('log')
         ax.set_ylabel(label)
     if data['power_type'] == 'cross_p3d':
         ax.legend(loc="best",numpoints=1,fancybox=True)
 
-fig, axs = plt.subplots(4, sharex=True, sharey=False,figsize=[8,10])
-fig.suptitle('Measured power spectra, z={}'.format(z))
-auto_label=r"$k^3 P_F(k,\mu)$"
-cross_label=r"$ -k^3 P_X(k,\mu)$"
-halo_label=r"$k^3 P_H(k,\mu)$"
-plot_p3d(data_F,axs[0],label=auto_label)
-plot_p3d(data_X,axs[1],label=cross_label)
-plot_p3d(data_H,axs[2],label=halo_label)
-plt.xlabel("k (h/Mpc)")
-
-# plot cross-correlation coefficient
-for i in range(0,n_mu,downsample):
-    col=cm(i/n_mu)
-    # identify bins we want to keep in plot
-    nan_mask=np.isnan(data_F['mu'][:,i])
-    kmax_mask=data_F['k_hMpc'][:,i][~nan_mask] > data_F['k_hMpc_max']
-    keep=~nan_mask
-    keep[~nan_mask]=~kmax_mask
-    P_F=data_F['p3d_hMpc'][:,i][keep]
-    P_X=data_X['p3d_hMpc'][:,i][keep]
-    P_H=data_H['p3d_hMpc'][:,i][keep]
-    shot_noise=data_H['shot_noise']
-    k=data_F['k_hMpc'][:,i][keep]
-    axs[3].plot(k,-P_X/np.sqrt(P_F*(P_H-shot_noise)),ls='-',color=col)
-    axs[3].set_xscale('log')
-    axs[3].set_ylim([0,1])
-    axs[3].set_ylabel(r'$- P_X / \sqrt{P_F ~ P_H} (k,\mu)$')
-
-plt.tight_layout()
-plt.savefig('measured_p3d_{}.png'.format(mass_label))
-plt.show()
 
+def render_measured_p3d(fig,data_F,data_X,data_H,downsample=5):
+    """Draw flux, cross and halo P3D, and the cross-correlation coefficient,
+        in figure fig (cleared first, so it can be reused)"""
+
+    import matplotlib.pyplot as plt
+    fig.clf()
+    axs=fig.subplots(4, sharex=True, sharey=False)
+    z=data_F['grid'].get_z()
+    fig.suptitle('Measured power spectra, z={}'.format(z))
+    auto_label=r"$k^3 P_F(k,\mu)$"
+    cross_label=r"$ -k^3 P_X(k,\mu)$"
+    halo_label=r"$k^3 P_H(k,\mu)$"
+    plot_p3d(data_F,axs[0],label=auto_label,downsample=downsample)
+    plot_p3d(data_X,axs[1],label=cross_label,downsample=downsample)
+    plot_p3d(data_H,axs[2],label=halo_label,downsample=downsample)
+    axs[3].set_xlabel("k (h/Mpc)")
+
+    # plot cross-correlation coefficient
+    n_mu=data_F['n_mu_bins']
+    cm=plt.get_cmap('jet')
+    keep=measured_power.get_valid_mask(data_F)
+    r_FH=measured_power.get_cross_coefficient(data_F,data_X,data_H)
+    for i in range(0,n_mu,downsample):
+        col=cm(i/n_mu)
+        k=data_F['k_hMpc'][keep[:,i],i]
+        axs[3].plot(k,r_FH[keep[:,i],i],ls='-',color=col)
+        axs[3].set_xscale('log')
+        axs[3].set_ylim([0,1])
+        axs[3].set_ylabel(r'$- P_X / \sqrt{P_F ~ P_H} (k,\mu)$')
+
+    fig.tight_layout()
+    return fig
+
+
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    # specify simulation from Sherwood suite
+    L_hMpc=160
+    n_part=2048
+    sim = she_sim.SherwoodSimulation(L_hMpc=L_hMpc,n_part=n_part)
+
+    # specify grid of skewers
+    snapshot_num=9
+    n_xy=1024
+    n_z=2048
+    # combined measurement
+    axis=0
+    skewers=she_sim.Grid(simulation=sim,snapshot_num=snapshot_num,
+                                n_xy=n_xy,n_z=n_z,axis=axis)
+
+    # specify grid of halos
+    add_rsd=True
+
+    # mass bin
+    all_mass=True
+    if all_mass:
+        logMh_min=None
+        logMh_max=None
+        mass_label='all'
+    else:
+        logMh_min=11.5
+        logMh_max=14.0
+        mass_label='{}_{}'.format(logMh_min,logMh_max)
+    halos=she_sim.HaloGrid(simulation=sim,snapshot_num=snapshot_num,
+                          logMh_min=logMh_min,logMh_max=logMh_max,
+                          n_xy=n_xy,n_z=n_z,axis=axis,add_rsd=add_rsd)
+
+    # get P3D measurements (standard binning)
+    data_F=measured_power.get_power_from_grid(grid=skewers,
+                power_type="flux_p3d")
+    data_X=measured_power.get_power_from_grid(grid=halos,power_type="cross_p3d")
+    data_H=measured_power.get_power_from_grid(grid=halos,power_type="halo_p3d")
+
+    fig=plt.figure(figsize=FIGSIZE)
+    render_measured_p3d(fig,data_F,data_X,data_H)
+    plt.savefig('measured_p3d_{}.png'.format(mass_label))
+    plt.show()
@@ -0,0 +1,119 @@
+import os
+import sys
+import json
+import struct
+import numpy as np
+import measured_power
+
+# header keywords copied to the metadata table (when present in the file)
+HEADER_KEYS=['L_HMPC','N_PART','SNAPSHOT_NUM','N_XY','N_Z','AXIS',
+            'ADD_RSD','LOGMH_MIN','LOGMH_MAX','SHOT_NOISE','MEAN_FLUX',
+            'N_K_BINS','N_MU_BINS','K_HMPC_MAX']
+
+
+def _aligned(offset):
+    """Round up offset to the alignment of arrays in the store"""
+
+    align=measured_power.STORE_ALIGN
+    return (offset+align-1)//align*align
+
+
+def write_power_store(fname=None,data_dir=None):
+    """Pack all FITS measurements into a single binary store"""
+
+    if data_dir is None:
+        data_dir=measured_power.get_repo_dir()+'/data/'
+    if fname is None:
+        fname=os.path.join(data_dir,'power_store.bin')
+
+    import fitsio
+    # read all measurements, and collect header and columns
+    table=[]
+    arrays=[]
+    for power_type,fits_fname in measured_power.list_fits_files(data_dir):
+        hdul=fitsio.FITS(fits_fname)
+        hdu=hdul[power_type.upper()]
+        header=hdu.read_header()
+        entry={'power_type':power_type,'fname':os.path.basename(fits_fname),
+                'header':{key:header[key] for key in HEADER_KEYS
+                                                    if key in header},
+                'columns':{}}
+        for name in hdu.get_colnames():
+            # store little-endian, contiguous arrays
+            array=np.ascontiguousarray(hdu[name][:],dtype='<f8')
+            entry['columns'][name]={'shape':list(array.shape),
+                                    'dtype':array.dtype.str}
+            arrays.append((entry['columns'][name],array))
+        hdul.close()
+        table.append(entry)
+
+    # the offsets depend on the size of the table, that depends on the
+    # offsets: use placeholders with the largest possible width first
+    for col,array in arrays:
+        col['offset']=2**63-1
+    n0=len(measured_power.STORE_MAGIC)+8
+    offset=_aligned(n0+len(json.dumps(table).encode()))
+    for col,array in arrays:
+        col['offset']=offset
+        offset=_aligned(offset+array.nbytes)
+    table_bytes=json.dumps(table).encode()
+    assert n0+len(table_bytes)<=arrays[0][0]['offset'],'table too long'
+
+    with open(fname,'wb') as f:
+        f.write(measured_power.STORE_MAGIC)
+        f.write(struct.pack('<Q',len(table_bytes)))
+        f.write(table_bytes)
+        for col,array in arrays:
+            f.seek(col['offset'])
+            f.write(array.tobytes())
+
+    return fname
+
+
+def check_power_store(fname=None,data_dir=None,verbose=False):
+    """Compare every entry in the store with the original FITS file.
+        Return list of inconsistent entries (empty if all is fine)."""
+
+    if data_dir is None:
+        data_dir=measured_power.get_repo_dir()+'/data/'
+    if fname is None:
+        fname=os.path.join(data_dir,'power_store.bin')
+
+    store=measured_power.PowerStore(fname)
+    problems=[]
+    fits_files=measured_power.list_fits_files(data_dir)
+    if len(fits_files)!=len(store):
+        problems.append(('number of entries',len(fits_files),len(store)))
+
+    for power_type,fits_fname in fits_files:
+        fits_power=measured_power.read_fits_power(fits_fname,power_type)
+        grid=fits_power['grid']
+        try:
+            store_power=store.get_power(grid,power_type)
+        except (KeyError,AssertionError) as err:
+            problems.append((fits_fname,str(err)))
+            continue
+        for key,value in fits_power.items():
+            if key=='grid':
+                continue
+            if isinstance(value,np.ndarray):
+                same=np.array_equal(value,store_power[key],equal_nan=True)
+            else:
+                same=(value==store_power[key])
+            if not same:
+                problems.append((fits_fname,key))
+        if verbose:
+            print(power_type,grid.get_nametag(),'checked')
+
+    return problems
+
+
+if __name__ == '__main__':
+    # build the store (optional argument: output filename) and check it
+    fname=write_power_store(sys.argv[1] if len(sys.argv)>1 else None)
+    print('wrote',fname,os.path.getsize(fname),'bytes')
+    problems=check_power_store(fname)
+    if problems:
+        print('inconsistent entries:',problems)
+        sys.exit(1)
+    print('consistent with FITS files')
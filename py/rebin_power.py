@@ -0,0 +1,254 @@
+import numpy as np
+import measured_power
+
+# P3D arrays rebinned, and combined with count-weighted means
+REBIN_KEYS=['k_hMpc','mu','p3d_hMpc']
+
+# rebinning matrices already computed, indexed by binning scheme
+_matrices={}
+
+
+def get_interp_index(nodes,x):
+    """Left node and weight for linear interpolation (constant outside)"""
+
+    x=np.asarray(x,dtype=float)
+    if len(nodes)==1:
+        return np.zeros(x.shape,dtype=int),np.zeros(x.shape)
+    i=np.clip(np.searchsorted(nodes,x,side='right')-1,0,len(nodes)-2)
+    w=np.clip((x-nodes[i])/(nodes[i+1]-nodes[i]),0.0,1.0)
+    return i,w
+
+
+def get_mu_centers(n_mu):
+    """Centers of mu wedges, equally spaced in 0<mu<1"""
+
+    return (np.arange(n_mu)+0.5)/n_mu
+
+
+def get_common_grid(powers,values):
+    """Tabulate values of P3D measurements with the same binning on common
+        nodes: k bins valid (and non-empty) in at least one mu wedge of all
+        of them, at the count-weighted mean of ln k over measurements, and
+        centers of mu wedges. Empty mu bins are filled by interpolation in
+        mu. Inputs:
+      - powers: list of measurements, setting valid bins and ln k
+      - values: array (n_powers,n_k,n_mu) to tabulate (e.g., P3D)
+        Returns (lnk_nodes,mu_nodes,table) with table (n_powers,n_k,n_mu)."""
+
+    masks=np.stack([measured_power.get_valid_mask(power)&(power['counts']>0)
+                for power in powers])
+    values=np.asarray(values,dtype=float)
+    mu_nodes=get_mu_centers(values.shape[2])
+    rows=np.all(np.any(masks,axis=2),axis=0)
+    table=np.where(masks,values,np.nan)[:,rows]
+    for i in range(table.shape[0]):
+        for j in range(table.shape[1]):
+            ok=np.isfinite(table[i,j])
+            table[i,j]=np.interp(mu_nodes,mu_nodes[ok],table[i,j,ok])
+
+    weights=np.where(masks,np.stack([power['counts'] for power in powers]),0)
+    lnk=np.log(np.nan_to_num(np.stack([power['k_hMpc'] for power in powers]),
+                nan=1.0))
+    lnk_nodes=np.sum((weights*lnk)[:,rows],axis=(0,2))/np.sum(
+                weights[:,rows],axis=(0,2))
+    return lnk_nodes,mu_nodes,table
+
+
+def get_groups(n_bins,groups=1):
+    """Coarse bin of each of the n_bins fine bins, as an array of indices.
+        - groups: number of consecutive fine bins to merge (int), or array
+          with the coarse bin of each fine bin (-1 to drop a fine bin)"""
+
+    if np.ndim(groups)==0:
+        return np.arange(n_bins)//int(groups)
+    groups=np.asarray(groups,dtype=int)
+    assert groups.shape==(n_bins,),'need one group per bin'
+    return groups
+
+
+def get_rebin_matrix(n_k,n_mu,k_groups=1,mu_groups=1):
+    """Dense (n_coarse,n_fine) matrix with ones where a fine bin (k,mu),
+        flattened as k*n_mu+mu, contributes to a coarse bin. Cached for
+        each binning scheme, and returned as read-only.
+        Returns (matrix,(n_k_coarse,n_mu_coarse))."""
+
+    k_groups=get_groups(n_k,k_groups)
+    mu_groups=get_groups(n_mu,mu_groups)
+    key=(n_k,n_mu,k_groups.tobytes(),mu_groups.tobytes())
+    if key not in _matrices:
+        n_kc=k_groups.max()+1
+        n_muc=mu_groups.max()+1
+        # coarse bin of each fine bin (or -1 if dropped)
+        coarse=k_groups[:,np.newaxis]*n_muc+mu_groups[np.newaxis,:]
+        coarse[k_groups<0,:]=-1
+        coarse[:,mu_groups<0]=-1
+        coarse=coarse.ravel()
+        matrix=np.zeros([n_kc*n_muc,n_k*n_mu])
+        use=(coarse>=0)
+        matrix[coarse[use],np.nonzero(use)[0]]=1.0
+        matrix.flags.writeable=False
+        _matrices[key]=(matrix,(n_kc,n_muc))
+    return _matrices[key]
+
+
+def _get_weights(power):
+    """Number of modes in valid bins (zero elsewhere), as (n_k,n_mu)"""
+
+    mask=measured_power.get_valid_mask(power)
+    counts=np.where(mask,power['counts'],0.0)
+    return counts.reshape(counts.shape[0],-1)
+
+
+def _stack_inputs(powers,columns):
+    """Array (n_columns,n_powers,n_fine) with counts times each column
+        (columns are functions of the power dictionary), zero in invalid
+        bins. Also returns the (n_powers,n_fine) weights."""
+
+    weights=np.stack([_get_weights(power).ravel() for power in powers])
+    inputs=np.empty((len(columns),)+weights.shape)
+    for i,column in enumerate(columns):
+        values=np.stack([np.reshape(column(power),-1) for power in powers])
+        # NaN in empty bins would propagate through the product
+        inputs[i]=np.where(weights>0,weights*values,0.0)
+    return inputs,weights
+
+
+def rebin_many(powers,k_groups=1,mu_groups=1):
+    """Rebin a list of P3D measurements (all with the same binning),
+        combining bins with count-weighted means of k, mu and P, and
+        adding the counts. Uses a single matrix product for all of them.
+        Measurements without mu bins (1D arrays, e.g. halo P3D without
+        RSD) stay 1D.
+        Returns list of power dictionaries with the new binning."""
+
+    powers=list(powers)
+    n_k=powers[0]['k_hMpc'].shape[0]
+    n_mu=powers[0]['k_hMpc'].size//n_k
+    for power in powers:
+        assert power['k_hMpc'].size==n_k*n_mu,'inconsistent binning'
+    matrix,shape=get_rebin_matrix(n_k,n_mu,k_groups,mu_groups)
+
+    columns=[lambda power,key=key:power[key] for key in REBIN_KEYS]
+    inputs,weights=_stack_inputs(powers,columns)
+    # counts and weighted sums, for all measurements at once
+    stacked=np.concatenate([weights[np.newaxis],inputs])
+    sums=stacked.reshape(-1,n_k*n_mu)@matrix.T
+    sums=sums.reshape((len(REBIN_KEYS)+1,len(powers))+shape)
+    counts=sums[0]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        means=sums[1:]/counts
+
+    rebinned=[]
+    for i,power in enumerate(powers):
+        # keep the rank of the input arrays
+        rank_shape=shape if np.ndim(power['k_hMpc'])>1 else shape[:1]
+        new=dict(power)
+        for j,key in enumerate(REBIN_KEYS):
+            new[key]=means[j,i].reshape(rank_shape)
+        new['counts']=counts[i].reshape(rank_shape)
+        new['n_k_bins']=shape[0]
+        new['n_mu_bins']=shape[1]
+        rebinned.append(new)
+    return rebinned
+
+
+def rebin_power(power,k_groups=1,mu_groups=1):
+    """Rebin a single P3D measurement (see rebin_many)"""
+
+    return rebin_many([power],k_groups=k_groups,mu_groups=mu_groups)[0]
+
+
+def get_legendre_wedge_average(ell,mu_edges):
+    """Average of Legendre polynomial of order ell (0, 2 or 4) in each mu
+        wedge, computed exactly from its integral"""
+
+    if ell==0:
+        integral=lambda mu:mu
+    elif ell==2:
+        integral=lambda mu:0.5*(mu**3-mu)
+    elif ell==4:
+        integral=lambda mu:(7*mu**5-10*mu**3+3*mu)/8
+    else:
+        raise ValueError('unsupported multipole',ell)
+    mu_edges=np.asarray(mu_edges,dtype=float)
+    return np.diff(integral(mu_edges))/np.diff(mu_edges)
+
+
+def get_multipole_matrix(n_k,n_mu,ells=(0,2,4),k_groups=1):
+    """Dense matrix projecting (n_k,n_mu) wedges, flattened, onto k groups
+        (first block of rows) and onto each multipole (one block of rows
+        per ell). Wedges are equally spaced in 0<mu<1. Cached for each
+        scheme, and returned as read-only.
+        Returns (matrix,n_k_coarse)."""
+
+    k_groups=get_groups(n_k,k_groups)
+    key=('multipoles',n_k,n_mu,tuple(ells),k_groups.tobytes())
+    if key not in _matrices:
+        # all wedges of a k bin (group) are combined
+        sums,(n_kc,n_muc)=get_rebin_matrix(n_k,n_mu,k_groups,
+                        mu_groups=np.zeros(n_mu,dtype=int))
+        mu_edges=np.linspace(0.0,1.0,n_mu+1)
+        blocks=[sums]
+        for ell in ells:
+            L=get_legendre_wedge_average(ell,mu_edges)
+            # same mu wedges in every k bin of the flattened array
+            blocks.append(sums*(2*ell+1)*np.tile(L,n_k))
+        matrix=np.concatenate(blocks)
+        matrix.flags.writeable=False
+        _matrices[key]=(matrix,n_kc)
+    return _matrices[key]
+
+
+def get_multipoles_many(powers,ells=(0,2,4),k_groups=1):
+    """Legendre multipoles of a list of P3D measurements, from their mu
+        wedges, as a sum over modes:
+            P_ell(k) = (2 ell+1) sum_j N_j P_j <L_ell>_j / sum_j N_j
+        where j runs over valid wedges (and k bins in the same k group),
+        N_j are the counts and <L_ell>_j the average of the Legendre
+        polynomial in each wedge. The sum only separates the multipoles if
+        all wedges are present: in k bins (groups) where some wedge has no
+        valid modes the monopole would leak into ell>0, so the multipoles
+        are NaN there, and full_mu is False. Uses a single matrix product
+        for all measurements. Returns list of dictionaries with
+        power_type, grid, k_hMpc (count-weighted mean), counts, full_mu,
+        and p{ell}_hMpc for each ell."""
+
+    powers=list(powers)
+    n_k=powers[0]['k_hMpc'].shape[0]
+    n_mu=powers[0]['k_hMpc'].size//n_k
+    for power in powers:
+        assert power['k_hMpc'].size==n_k*n_mu,'inconsistent binning'
+    matrix,n_kc=get_multipole_matrix(n_k,n_mu,ells,k_groups)
+
+    columns=[lambda power:power['k_hMpc'],lambda power:power['p3d_hMpc']]
+    inputs,weights=_stack_inputs(powers,columns)
+    stacked=np.concatenate([weights[np.newaxis],inputs])
+    sums=stacked.reshape(-1,n_k*n_mu)@matrix.T
+    sums=sums.reshape(3,len(powers),len(ells)+1,n_kc)
+    # counts and k are summed with the first block, P with the others
+    counts=sums[0,:,0]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        k_hMpc=sums[1,:,0]/counts
+        poles=sums[2,:,1:]/counts[:,np.newaxis]
+    # k groups with valid modes in every mu wedge
+    wedges,_=get_rebin_matrix(n_k,n_mu,k_groups)
+    wedge_counts=(weights@wedges.T).reshape(len(powers),n_kc,n_mu)
+    full_mu=np.all(wedge_counts>0,axis=2)
+    poles[~np.broadcast_to(full_mu[:,np.newaxis],poles.shape)]=np.nan
+
+    multipoles=[]
+    for i,power in enumerate(powers):
+        multipole={'power_type':power['power_type'],'grid':power['grid'],
+                    'k_hMpc':k_hMpc[i],'counts':counts[i],
+                    'full_mu':full_mu[i]}
+        for j,ell in enumerate(ells):
+            multipole['p{}_hMpc'.format(ell)]=poles[i,j]
+        multipoles.append(multipole)
+    return multipoles
+
+
+def get_multipoles(power,ells=(0,2,4),k_groups=1):
+    """Legendre multipoles of a single P3D measurement (see
+        get_multipoles_many)"""
+
+    return get_multipoles_many([power],ells=ells,k_groups=k_groups)[0]
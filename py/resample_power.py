@@ -0,0 +1,310 @@
+import numpy as np
+import measured_power
+import model_density
+import likelihood_p3d
+
+# percentiles reported by default (median and 1, 2 sigma intervals)
+PERCENTILES=[2.5,16,50,84,97.5]
+
+
+def _cross_coefficient(resampler,P):
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return -P['cross_p3d']/np.sqrt(P['flux_p3d']
+                    *(P['halo_p3d']-resampler.shot_noise))
+
+
+def _flux_linear_ratio(resampler,P):
+    return P['flux_p3d']/resampler.linP
+
+
+def _cross_linear_ratio(resampler,P):
+    return -P['cross_p3d']/resampler.linP
+
+
+def _halo_linear_ratio(resampler,P):
+    return (P['halo_p3d']-resampler.shot_noise)/resampler.linP
+
+
+# derived quantities, functions of (resampler,draws of each power type),
+# where draws are arrays of shape (n_draws,n_bins)
+DERIVED={'cross_coefficient':_cross_coefficient,
+        'flux_linear_ratio':_flux_linear_ratio,
+        'cross_linear_ratio':_cross_linear_ratio,
+        'halo_linear_ratio':_halo_linear_ratio}
+
+
+class StreamingStats(object):
+    """Mean, covariance and percentiles of draws of a vector, accumulated
+        one block at a time (draws are not stored). NaN values are
+        ignored, and the covariance uses pairs of values that are finite.
+        Percentiles are computed from histograms (n_hist bins per entry),
+        whose range is set by the first block, and widened (by merging
+        pairs of bins) when later values fall outside of it, so that the
+        percentiles do not depend on the size of the blocks."""
+
+    def __init__(self,n_dim,n_hist=2048):
+
+        assert n_hist%2==0,'n_hist must be even'
+        self.n_dim=n_dim
+        self.n_hist=n_hist
+        self.n_draws=0
+        # sums are computed relative to the mean of the first block
+        self.shift=None
+        # finite values, sum(x), sum(x x^T) and pairwise number of finite
+        self.count=np.zeros(n_dim)
+        self.sum_x=np.zeros([n_dim,n_dim])
+        self.sum_xx=np.zeros([n_dim,n_dim])
+        self.count_pairs=np.zeros([n_dim,n_dim])
+        # histograms for percentiles
+        self.hist_min=None
+        self.hist_width=None
+        self.hist=np.zeros([n_dim,n_hist],dtype=np.int64)
+
+
+    def _set_range(self,values,cols):
+        # entries without finite values (cols lists the others) start at 0
+        low=np.zeros(self.n_dim)
+        span=np.zeros(self.n_dim)
+        if len(cols)>0:
+            low[cols],high=np.nanpercentile(values[:,cols],[0.1,99.9],axis=0)
+            span[cols]=high-low[cols]
+        # constant (or undefined) entries get a small, non-zero range
+        span=np.where(span>0,span,1e-12)
+        self.hist_min=low-0.5*span
+        self.hist_width=2*span/self.n_hist
+
+
+    def _widen_range(self,low,high):
+        """Double the bin width of the histograms that do not cover
+            [low,high], until they do. Pairs of bins are merged, and the
+            range is extended above (or below, if low is not covered)."""
+
+        half=self.n_hist//2
+        while True:
+            below=(low<self.hist_min)
+            above=(high>=self.hist_min+self.n_hist*self.hist_width)
+            widen=below|above
+            if not widen.any():
+                return
+            merged=self.hist[widen].reshape(-1,half,2).sum(axis=2)
+            hist=np.zeros([len(merged),self.n_hist],dtype=self.hist.dtype)
+            down=below[widen]
+            hist[~down,:half]=merged[~down]
+            hist[down,half:]=merged[down]
+            self.hist[widen]=hist
+            self.hist_min=np.where(below,
+                        self.hist_min-self.n_hist*self.hist_width,self.hist_min)
+            self.hist_width=np.where(widen,2*self.hist_width,self.hist_width)
+
+
+    def add(self,draws):
+        """Accumulate block of draws, with shape (n_draws,n_dim)"""
+
+        draws=np.asarray(draws,dtype=float).reshape(-1,self.n_dim)
+        finite=np.isfinite(draws)
+        # reductions ignoring NaN are only done for entries with at least
+        # one finite value (all-NaN columns are valid input, e.g. masked)
+        values=np.where(finite,draws,np.nan)
+        cols=np.flatnonzero(finite.any(axis=0))
+        if self.shift is None:
+            self.shift=np.zeros(self.n_dim)
+            self.shift[cols]=np.nanmean(values[:,cols],axis=0)
+            self._set_range(values,cols)
+        x=np.where(finite,draws-self.shift,0.0)
+        self.n_draws+=len(draws)
+        self.sum_xx+=x.T@x
+        if finite.all():
+            self.count+=len(draws)
+            self.sum_x+=x.sum(axis=0)[:,np.newaxis]
+            self.count_pairs+=len(draws)
+        else:
+            f=finite.astype(float)
+            self.count+=f.sum(axis=0)
+            # sum_x[i,j] is the sum of x_i over draws where x_j is finite
+            self.sum_x+=x.T@f
+            self.count_pairs+=f.T@f
+
+        # make sure that the histograms cover all finite values
+        low=np.full(self.n_dim,np.nan)
+        high=np.full(self.n_dim,np.nan)
+        low[cols]=np.nanmin(values[:,cols],axis=0)
+        high[cols]=np.nanmax(values[:,cols],axis=0)
+        self._widen_range(low,high)
+
+        # histogram of all entries at once (a single unbuffered add, that
+        # does not depend on the size of the histograms)
+        index=np.floor((draws-self.hist_min)/self.hist_width)
+        index=np.clip(np.nan_to_num(index,nan=-1),0,self.n_hist-1)
+        index=index.astype(np.int64)+self.n_hist*np.arange(self.n_dim)
+        np.add.at(self.hist.reshape(-1),index[finite],1)
+
+
+    def get_mean(self):
+        with np.errstate(divide='ignore',invalid='ignore'):
+            return self.shift+np.diag(self.sum_x)/self.count
+
+
+    def get_cov(self):
+        """Covariance (n_dim,n_dim), from pairs of finite values"""
+
+        n=self.count_pairs
+        with np.errstate(divide='ignore',invalid='ignore'):
+            return (self.sum_xx-self.sum_x*self.sum_x.T/n)/(n-1)
+
+
+    def get_std(self):
+        return np.sqrt(np.diag(self.get_cov()))
+
+
+    def get_percentiles(self,q=PERCENTILES):
+        """Percentiles, array of shape (len(q),n_dim)"""
+
+        cdf=np.cumsum(self.hist,axis=1)
+        total=cdf[:,-1]
+        values=np.full([len(q),self.n_dim],np.nan)
+        rows=np.arange(self.n_dim)
+        for i,percent in enumerate(q):
+            target=percent/100*total
+            # first histogram bin reaching the target, and fraction of it
+            ibin=np.argmax(cdf>=target[:,np.newaxis],axis=1)
+            before=np.where(ibin>0,cdf[rows,ibin-1],0)
+            in_bin=self.hist[rows,ibin]
+            with np.errstate(divide='ignore',invalid='ignore'):
+                frac=np.clip((target-before)/in_bin,0,1)
+            value=self.hist_min+self.hist_width*(ibin+np.nan_to_num(frac))
+            values[i]=np.where(total>0,value,np.nan)
+        return values
+
+
+class PowerResampler(object):
+    """Monte Carlo realizations of flux, cross and halo P3D measured in a
+        configuration, from the Gaussian model based on the number of
+        modes (see likelihood_p3d.get_gaussian_covariance). Power types
+        are drawn jointly in each valid (k,mu) bin, and bins are
+        independent. Inputs:
+      - halos: HaloGrid (the flux is measured in the same base grid)
+      - catalog: PowerCatalog to get measurements from (optional)
+      - k_max_hMpc: only use bins with k below this value (optional)
+      - linear_model: LinearDensityModel for ratios (default shared one)"""
+
+    def __init__(self,halos,catalog=None,k_max_hMpc=None,linear_model=None):
+
+        self.halos=halos
+        skewers=likelihood_p3d.get_skewers_from_halos(halos)
+        grids={'flux_p3d':skewers,'cross_p3d':halos,'halo_p3d':halos}
+        if catalog is None:
+            power={pt:measured_power.get_power_from_grid(grids[pt],pt,
+                        use_cache=True) for pt in likelihood_p3d.P3D_TYPES}
+        else:
+            power={pt:catalog.get_power(grids[pt],pt)
+                        for pt in likelihood_p3d.P3D_TYPES}
+        self.shape=power['flux_p3d']['p3d_hMpc'].shape
+        self.shot_noise=power['halo_p3d']['shot_noise']
+
+        # use bins that are valid and non-empty in all measurements
+        mask=np.ones(self.shape,dtype=bool)
+        for pt in likelihood_p3d.P3D_TYPES:
+            assert power[pt]['p3d_hMpc'].shape==self.shape,'inconsistent bins'
+            mask&=measured_power.get_valid_mask(power[pt])
+            mask&=(power[pt]['counts']>0)
+        if k_max_hMpc is not None:
+            mask&=(power['flux_p3d']['k_hMpc']<k_max_hMpc)
+        self.mask=mask
+        self.k_hMpc=power['flux_p3d']['k_hMpc'][mask]
+        self.mu=power['flux_p3d']['mu'][mask]
+        self.n_bins=len(self.k_hMpc)
+
+        # (n_bins,3) mean, and square root of (n_bins,3,3) covariance
+        P={pt:power[pt]['p3d_hMpc'][mask] for pt in likelihood_p3d.P3D_TYPES}
+        self.mean=np.stack([P[pt] for pt in likelihood_p3d.P3D_TYPES],axis=-1)
+        counts=power['cross_p3d']['counts'][mask]
+        cov=likelihood_p3d.get_gaussian_covariance(P['flux_p3d'],
+                    P['cross_p3d'],P['halo_p3d'],counts)
+        # eigenvalues are clipped, in case noise makes |r|>1 in a bin
+        eigval,eigvec=np.linalg.eigh(cov)
+        self.sqrt_cov=eigvec*np.sqrt(np.clip(eigval,0,None))[:,np.newaxis,:]
+
+        if linear_model is None:
+            linear_model=model_density.get_linear_density_model()
+        self.linP=linear_model.linP_hMpc_batch(halos.get_z(),self.k_hMpc)
+
+
+    def get_block_size(self,n_quantities,memory_bytes,n_hist=2048):
+        """Number of draws per block that fit in the memory budget, after
+            the statistics of each quantity. Raises ValueError if the
+            budget does not fit the statistics and a single draw."""
+
+        # histograms and three (n_bins,n_bins) sums in each StreamingStats,
+        # the covariance returned, and the temporary arrays of one update
+        fixed_bytes=8*self.n_bins*(n_quantities*(n_hist+4*self.n_bins)
+                    +n_hist+2*self.n_bins)
+        # normal deviates and powers (3 each) plus each quantity, with
+        # a few temporary arrays per quantity in StreamingStats.add
+        bytes_per_draw=8*self.n_bins*(6+4*n_quantities)
+        if memory_bytes<fixed_bytes+bytes_per_draw:
+            raise ValueError('memory budget of {} bytes is too small for {} '
+                    'quantities with {} bins, use at least {} bytes'.format(
+                    memory_bytes,n_quantities,self.n_bins,
+                    fixed_bytes+bytes_per_draw))
+        return int((memory_bytes-fixed_bytes)//bytes_per_draw)
+
+
+    def iter_blocks(self,n_draws,seed=0,block_size=1000):
+        """Generator of dictionaries with (n_block,n_bins) draws of each
+            power type. The sequence of draws does not depend on the
+            block size, for a given seed."""
+
+        rng=np.random.default_rng(seed)
+        n_done=0
+        while n_done<n_draws:
+            n_block=min(block_size,n_draws-n_done)
+            normal=rng.standard_normal((n_block,self.n_bins,3))
+            draws=self.mean+np.einsum('bij,nbj->nbi',self.sqrt_cov,normal)
+            yield {pt:draws[...,i]
+                    for i,pt in enumerate(likelihood_p3d.P3D_TYPES)}
+            n_done+=n_block
+
+
+    def run(self,n_draws=10000,quantities=None,seed=0,
+                memory_bytes=64*1024**2,percentiles=PERCENTILES,n_hist=2048):
+        """Draw realizations and reduce them to statistics, block by block.
+          - quantities: list of names (power types or keys of DERIVED) or
+            dictionary of functions (resampler,draws)->(n_block,n_bins).
+            Default: all power types and derived quantities
+          - memory_bytes: approximate memory budget, for the statistics
+            of all quantities and each block of draws
+          - n_hist: number of histogram bins used for the percentiles
+        Returns dictionary indexed by quantity, with mean, std, cov
+        (n_bins,n_bins) and percentiles (len(percentiles),n_bins)."""
+
+        if quantities is None:
+            quantities=likelihood_p3d.P3D_TYPES+list(DERIVED)
+        if not isinstance(quantities,dict):
+            quantities={name:(DERIVED[name] if name in DERIVED else
+                        (lambda resampler,P,name=name:P[name]))
+                        for name in quantities}
+
+        block_size=self.get_block_size(len(quantities),memory_bytes,n_hist)
+        stats={name:StreamingStats(self.n_bins,n_hist) for name in quantities}
+        for draws in self.iter_blocks(n_draws,seed=seed,
+                    block_size=block_size):
+            for name,func in quantities.items():
+                stats[name].add(func(self,draws))
+
+        results={}
+        for name,stat in stats.items():
+            results[name]={'mean':stat.get_mean(),'std':stat.get_std(),
+                    'cov':stat.get_cov(),'percentiles':
+                    stat.get_percentiles(percentiles),
+                    'n_finite':stat.count}
+        results['block_size']=block_size
+        return results
+
+
+    def to_grid(self,values):
+        """Scatter values in valid bins to a (n_k,n_mu) array (NaN outside)"""
+
+        values=np.asarray(values)
+        grid=np.full(values.shape[:-1]+self.shape,np.nan)
+        grid[...,self.mask]=values
+        return grid
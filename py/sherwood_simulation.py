@@ -1,4 +1,4 @@
-import numpy as np
+import sys
 
 
 def redshift_from_snapshot(snap):
@@ -19,32 +19,85 @@ def snapshot_from_redshift(z):
     return switcher.get(z,"Unknown snapshot "+str(z))
 
 
-class SherwoodSimulation(object):
+class _FrozenObject(object):
+    """Base class for immutable, hashable value types with __slots__.
+        Subclasses define _get_fields(), returning a tuple with the
+        arguments of their constructor."""
+
+    __slots__=('_hash',)
+
+    def _set(self,name,value):
+        """Set attribute (only to be used during construction)"""
+        object.__setattr__(self,name,value)
+
+    def __setattr__(self,name,value):
+        raise AttributeError('{} is immutable'.format(type(self).__name__))
+
+    def __delattr__(self,name):
+        raise AttributeError('{} is immutable'.format(type(self).__name__))
+
+    def __eq__(self,other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return self._get_fields()==other._get_fields()
+
+    def __hash__(self):
+        # compute hash only once
+        try:
+            return self._hash
+        except AttributeError:
+            self._set('_hash',hash(self._get_fields()))
+            return self._hash
+
+    def __reduce__(self):
+        # needed for pickling, since __setattr__ is disabled
+        return (type(self),self._get_fields())
+
+    def __repr__(self):
+        return '{}{}'.format(type(self).__name__,self._get_fields())
+
+
+class SherwoodSimulation(_FrozenObject):
     """Object describing one of the Sherwood simulations."""
 
+    __slots__=('L_hMpc','n_part')
+
     def __init__(self,L_hMpc=80,n_part=1024):
         """Specify simulation (box size and number of particles) """
 
         # store information about the simulation
-        self.L_hMpc=L_hMpc
-        self.n_part=n_part
+        self._set('L_hMpc',L_hMpc)
+        self._set('n_part',n_part)
+
 
+    def _get_fields(self):
+        return (self.L_hMpc,self.n_part)
 
-class Grid(object):
+
+class Grid(_FrozenObject):
     """Define regular grid in a simulated box. Inputs:
       - simulation: SherwoodSimulation object with basic info about sim.
       - snapshot_num: snapshot number (8, 9, 10 or 11)
       - n_xy: number of cells per in transverse directions (x,y)
       - n_z: number of cells along the line of sight (if None, use n_xy)
-      - axis: box axis along which we set line of sight (1,2,3)"""
+      - axis: box axis along which we set line of sight (1,2,3)
+    Grids are immutable, and can be used as keys in dictionaries."""
+
+    __slots__=('sim','snapshot_num','n_xy','n_z','axis','_nametag')
 
     def __init__(self,simulation,snapshot_num=9,n_xy=1024,n_z=2048,axis=0):
 
-        self.sim = simulation
-        self.snapshot_num = snapshot_num
-        self.n_xy = n_xy
-        self.n_z = n_z
-        self.axis = axis
+        self._set('sim',simulation)
+        self._set('snapshot_num',snapshot_num)
+        self._set('n_xy',n_xy)
+        self._set('n_z',n_z)
+        self._set('axis',axis)
+        # nametag is only computed the first time it is needed
+        self._set('_nametag',None)
+
+
+    def _get_fields(self):
+        return (self.sim,self.snapshot_num,self.n_xy,self.n_z,self.axis)
 
 
     def get_z(self):
@@ -56,8 +109,7 @@ class Grid(object):
         return z
 
 
-    def get_nametag(self):
-        """String identifying base grid, useful to create unique filenames"""
+    def _make_nametag(self):
 
         # add information about simulation box
         nametag='{}_{}'.format(self.sim.L_hMpc,self.sim.n_part)
@@ -69,6 +121,16 @@ class Grid(object):
         return nametag
 
 
+    def get_nametag(self):
+        """String identifying base grid, useful to create unique filenames"""
+
+        # compute (and intern) nametag only once
+        if self._nametag is None:
+            self._set('_nametag',sys.intern(self._make_nametag()))
+
+        return self._nametag
+
+
 
 class HaloGrid(Grid):
     """Define regular grid of halo density from simulation. Inputs:
@@ -81,21 +143,28 @@ class HaloGrid(Grid):
       - axis: box axis to use for redshift direction (1,2,3)
       - add_rsd: set to true to add redshift-space distortions. """
 
+    __slots__=('logMh_min','logMh_max','add_rsd')
+
     def __init__(self,simulation,snapshot_num=9,logMh_min=None,logMh_max=None,
                 n_xy=1024,n_z=2048,axis=0,add_rsd=True):
 
         super().__init__(simulation,snapshot_num,n_xy=n_xy,n_z=n_z,axis=axis)
 
-        self.logMh_min = logMh_min
-        self.logMh_max = logMh_max
-        self.add_rsd = add_rsd
+        self._set('logMh_min',logMh_min)
+        self._set('logMh_max',logMh_max)
+        self._set('add_rsd',add_rsd)
 
 
-    def get_nametag(self):
-        """String identifying halo grid, useful to create unique filenames"""
+    def _get_fields(self):
+        # same order as arguments in constructor
+        return (self.sim,self.snapshot_num,self.logMh_min,self.logMh_max,
+                self.n_xy,self.n_z,self.axis,self.add_rsd)
+
+
+    def _make_nametag(self):
 
         # get base nametag
-        nametag=super().get_nametag()
+        nametag=super()._make_nametag()
         # add mass bin (might be None) 
         if self.logMh_min is None: str_logMh_min='None'
         else: str_logMh_min='{:.2f}'.format(self.logMh_min)
@@ -108,4 +177,3 @@ class HaloGrid(Grid):
 
         return nametag
 
-